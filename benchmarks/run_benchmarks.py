@@ -0,0 +1,300 @@
+"""Benchmark the I/O paths of ioSPI on synthetic data.
+
+Each benchmark is run at several scales and reports its best wall time,
+its throughput and the peak memory it allocates. Results can be saved as
+a JSON baseline and compared against a previous baseline, in which case
+the script exits with a non-zero status if any benchmark got slower than
+the allowed tolerance.
+
+Usage, from the root of the repository with ioSPI installed
+-----------------------------------------------------------
+    python benchmarks/run_benchmarks.py --scales small medium \
+        --save benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from ioSPI import atomic_models, micrographs, particle_metadata
+
+SCALES = {
+    "small": {"n_atoms": 1000, "n_frames": 16, "side_len": 128, "n_rows": 10000},
+    "medium": {"n_atoms": 10000, "n_frames": 64, "side_len": 256, "n_rows": 100000},
+    "large": {"n_atoms": 100000, "n_frames": 256, "side_len": 512, "n_rows": 1000000},
+}
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark.
+
+    The decorated function takes a scale dictionary and a temporary
+    directory, and returns a pair (run, n_bytes) where run is the
+    zero-argument callable to time and n_bytes the amount of data it
+    processes, used to compute throughput.
+    """
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def _write_coordinates(scale, root):
+    path = os.path.join(root, "coordinates.pdb")
+    coordinates = np.random.rand(scale["n_atoms"], 3) * 100
+    atomic_models.write_cartesian_coordinates(path, coordinates)
+    return path, coordinates
+
+
+def _write_micrograph(scale, root):
+    data = np.random.rand(
+        scale["n_frames"], scale["side_len"], scale["side_len"]
+    ).astype(np.float32)
+    micrographs.write_micrograph_to_mrc(root, data, 0)
+    return os.path.join(root, "0000.mrcs"), data
+
+
+def _write_starfile(scale, root):
+    names = particle_metadata.get_starfile_metadata_names(
+        type("Config", (), {"ctf": True, "shift": True})
+    )
+    accumulator = particle_metadata.MetadataAccumulator(names)
+    batch = {name: np.random.rand(scale["n_rows"]) for name in names}
+    batch["__rlnImageName"] = np.char.add(
+        np.arange(1, scale["n_rows"] + 1).astype(str), "@particles.mrcs"
+    )
+    accumulator.add_batch(batch)
+    metadata = accumulator.to_dataframe()
+    particle_metadata.write_metadata_to_starfile(root, metadata)
+    return os.path.join(root, "metadata.star"), metadata
+
+
+@benchmark("atomic_models.read_atomic_model")
+def bench_read_atomic_model(scale, root):
+    """Read a PDB file of n_atoms atoms."""
+    path, _ = _write_coordinates(scale, root)
+    return (
+        lambda: atomic_models.read_atomic_model(path, clean=False, assemble=False),
+        os.path.getsize(path),
+    )
+
+
+@benchmark("atomic_models.extract_atomic_parameter")
+def bench_extract_atomic_parameter(scale, root):
+    """Extract cartesian coordinates of n_atoms atoms."""
+    path, coordinates = _write_coordinates(scale, root)
+    model = atomic_models.read_atomic_model(path, clean=False, assemble=False)
+    atoms = atomic_models.extract_gemmi_atoms(model)
+    return (
+        lambda: atomic_models.extract_atomic_parameter(atoms, "cartesian_coordinates"),
+        coordinates.nbytes,
+    )
+
+
+@benchmark("atomic_models.write_cartesian_coordinates")
+def bench_write_cartesian_coordinates(scale, root):
+    """Write n_atoms coordinates to a PDB file."""
+    path, coordinates = _write_coordinates(scale, root)
+    return (
+        lambda: atomic_models.write_cartesian_coordinates(path, coordinates),
+        coordinates.nbytes,
+    )
+
+
+@benchmark("micrographs.read_micrograph_from_mrc")
+def bench_read_micrograph_from_mrc(scale, root):
+    """Read an .mrcs stack of n_frames frames."""
+    path, data = _write_micrograph(scale, root)
+    return lambda: micrographs.read_micrograph_from_mrc(path), data.nbytes
+
+
+@benchmark("micrographs.write_micrograph_to_mrc")
+def bench_write_micrograph_to_mrc(scale, root):
+    """Write an .mrcs stack of n_frames frames."""
+    _, data = _write_micrograph(scale, root)
+    return lambda: micrographs.write_micrograph_to_mrc(root, data, 0), data.nbytes
+
+
+@benchmark("micrographs.write_data_dict_to_hdf5")
+def bench_write_data_dict_to_hdf5(scale, root):
+    """Write a stack of n_frames frames and a few scalars to HDF5."""
+    _, data = _write_micrograph(scale, root)
+    path = os.path.join(root, "data.hdf5")
+    data_dict = {"images": data, "pixel_size": 1.0, "config": {"seed": 0}}
+    return lambda: micrographs.write_data_dict_to_hdf5(path, data_dict), data.nbytes
+
+
+@benchmark("micrographs.write_data_dict_to_hdf5[lists]")
+def bench_write_data_dict_to_hdf5_lists(scale, root):
+    """Write n_rows per-particle records holding a scalar and a small array."""
+    path = os.path.join(root, "data.hdf5")
+    particles = [
+        {"defocus": float(i), "shift": np.random.rand(2)}
+        for i in range(scale["n_rows"])
+    ]
+    return (
+        lambda: micrographs.write_data_dict_to_hdf5(path, {"particles": particles}),
+        scale["n_rows"] * 24,
+    )
+
+
+@benchmark("particle_metadata.write_metadata_to_starfile")
+def bench_write_metadata_to_starfile(scale, root):
+    """Write n_rows rows of relion metadata."""
+    path, metadata = _write_starfile(scale, root)
+    return (
+        lambda: particle_metadata.write_metadata_to_starfile(root, metadata),
+        os.path.getsize(path),
+    )
+
+
+@benchmark("particle_metadata.read_starfile")
+def bench_read_starfile(scale, root):
+    """Parse n_rows rows of relion metadata."""
+    path, _ = _write_starfile(scale, root)
+    return (
+        lambda: particle_metadata.read_starfile(path, use_sidecar=False),
+        os.path.getsize(path),
+    )
+
+
+@benchmark("particle_metadata.read_starfile[sidecar]")
+def bench_read_starfile_sidecar(scale, root):
+    """Read n_rows rows of relion metadata from a fresh sidecar."""
+    path, _ = _write_starfile(scale, root)
+    particle_metadata.write_starfile_sidecar(path)
+    return lambda: particle_metadata.read_starfile(path), os.path.getsize(path)
+
+
+@benchmark("import ioSPI")
+def bench_import(scale, root):
+    """Import all ioSPI submodules in a fresh interpreter."""
+    code = "from ioSPI import atomic_models, datasets, micrographs, particle_metadata"
+    return lambda: subprocess.run([sys.executable, "-c", code], check=True), 0
+
+
+def run_benchmark(setup, scale, repeat):
+    """Run a benchmark and measure its time and memory.
+
+    Parameters
+    ----------
+    setup : callable
+        Registered benchmark function.
+    scale : dict
+        Sizes of the synthetic data.
+    repeat : int
+        Number of timed runs. The best time is reported.
+
+    Returns
+    -------
+    result : dict
+        Best wall time in seconds, throughput in MB/s and
+        peak allocated memory in MB.
+    """
+    with tempfile.TemporaryDirectory() as root:
+        run, n_bytes = setup(scale, root)
+        run()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    best = min(times)
+    return {
+        "time_s": best,
+        "throughput_mb_s": n_bytes / best / 1e6,
+        "peak_memory_mb": peak / 1e6,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the benchmarks slower than their baseline.
+
+    Parameters
+    ----------
+    results : dict
+        Results of run_benchmark, keyed by scale and benchmark name.
+    baseline : dict
+        Previous results, with the same structure.
+    tolerance : float
+        Allowed relative increase of the wall time.
+
+    Returns
+    -------
+    regressions : list of str
+    """
+    regressions = []
+    for scale, scale_results in results.items():
+        for name, result in scale_results.items():
+            reference = baseline.get(scale, {}).get(name)
+            if reference is None:
+                continue
+            ratio = result["time_s"] / reference["time_s"]
+            if ratio > 1 + tolerance:
+                regressions.append(f"{scale} {name}: {ratio:.2f}x slower")
+    return regressions
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=SCALES)
+    parser.add_argument("--select", default="", help="run benchmarks matching this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write results to this JSON baseline")
+    parser.add_argument("--compare", help="compare results to this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    np.random.seed(0)
+    results = {}
+    for scale_name in args.scales:
+        results[scale_name] = {}
+        for name, setup in BENCHMARKS.items():
+            if args.select not in name:
+                continue
+            result = run_benchmark(setup, SCALES[scale_name], args.repeat)
+            results[scale_name][name] = result
+            print(
+                f"{scale_name:>6} {name:<50} {result['time_s'] * 1e3:10.2f} ms "
+                f"{result['throughput_mb_s']:10.1f} MB/s "
+                f"{result['peak_memory_mb']:10.1f} MB peak"
+            )
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(
+                {"python": platform.python_version(), "results": results},
+                file,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
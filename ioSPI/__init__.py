@@ -1 +1,25 @@
 __version__ = "0.0.1"
+
+import importlib
+
+__all__ = [
+    "aio",
+    "atomic_models",
+    "content_store",
+    "datasets",
+    "instrumentation",
+    "micrographs",
+    "particle_metadata",
+]
+
+
+def __getattr__(name):
+    """Import submodules of ioSPI on first access."""
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    """List the submodules of ioSPI."""
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,53 @@
+"""Defer imports of heavy dependencies until they are first used."""
+
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on first attribute access.
+
+    Unlike importlib.util.LazyLoader, this also defers the import of
+    compiled extension modules such as gemmi.
+
+    Parameters
+    ----------
+    name : str
+        Absolute name of the module, e.g. "h5py".
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        """Import the module and cache its attributes on the stand-in."""
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attribute):
+        """Import the module, then return one of its attributes."""
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        """List the attributes of the module."""
+        return dir(self._load())
+
+
+def lazy_import(name):
+    """Return a stand-in for a module, imported when first used.
+
+    Parameters
+    ----------
+    name : str
+        Absolute name of the module, e.g. "h5py".
+
+    Returns
+    -------
+    module : LazyModule
+    """
+    return LazyModule(name)
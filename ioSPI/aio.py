@@ -0,0 +1,451 @@
+"""Asynchronous counterparts of the ioSPI I/O functions.
+
+File I/O functions are wrapped into coroutines that run in a thread pool
+managed by this module, so that they do not block the event loop.
+AsyncOSFProject talks to the OSF API over non-blocking HTTP, which
+requires the aiohttp package, and limits the number of concurrent
+requests with a semaphore.
+
+Example
+-------
+>>> from ioSPI import aio
+>>> async def main():
+...     async with aio.AsyncOSFProject(token=token) as project:
+...         await project.download_many(remote_paths, local_dir="data")
+...     return await asyncio.gather(
+...         *(aio.read_micrograph_from_mrc(path) for path in paths)
+...     )
+"""
+
+import asyncio
+import functools
+import os
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from ioSPI import atomic_models, micrographs, particle_metadata
+
+DEFAULT_MAX_WORKERS = 32
+
+_executor = None
+_executor_lock = threading.Lock()
+_max_workers = DEFAULT_MAX_WORKERS
+
+
+def get_executor():
+    """Return the thread pool running file I/O, creating it if needed."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_max_workers, thread_name_prefix="ioSPI-aio"
+            )
+        return _executor
+
+
+def set_max_workers(max_workers):
+    """Set the number of threads running file I/O.
+
+    The current thread pool, if any, is shut down after its running tasks.
+
+    Parameters
+    ----------
+    max_workers : int
+    """
+    global _max_workers
+    _max_workers = max_workers
+    shutdown(wait=False)
+
+
+def shutdown(wait=True):
+    """Shut down the thread pool running file I/O.
+
+    A new pool is created by the next awaited call.
+
+    Parameters
+    ----------
+    wait : bool, default = True
+        If True, wait for running tasks to complete.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """Run a blocking function in the thread pool and await its result.
+
+    Parameters
+    ----------
+    func : callable
+    *args, **kwargs
+        Arguments of func.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs)
+    )
+
+
+def _awaitable(func):
+    """Return a coroutine function running a blocking function in the pool."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_executor(func, *args, **kwargs)
+
+    wrapper.__doc__ = (
+        f"Awaitable {func.__module__}.{func.__name__}, run in the thread pool.\n\n"
+        f"    See {func.__module__}.{func.__name__}."
+    )
+    return wrapper
+
+
+read_atomic_model = _awaitable(atomic_models.read_atomic_model)
+write_atomic_model = _awaitable(atomic_models.write_atomic_model)
+write_cartesian_coordinates = _awaitable(atomic_models.write_cartesian_coordinates)
+read_micrograph_from_mrc = _awaitable(micrographs.read_micrograph_from_mrc)
+read_mrc_header = _awaitable(micrographs.read_mrc_header)
+write_micrograph_to_mrc = _awaitable(micrographs.write_micrograph_to_mrc)
+write_data_dict_to_hdf5 = _awaitable(micrographs.write_data_dict_to_hdf5)
+read_data_dict_from_hdf5 = _awaitable(micrographs.read_data_dict_from_hdf5)
+read_starfile = _awaitable(particle_metadata.read_starfile)
+write_metadata_to_starfile = _awaitable(particle_metadata.write_metadata_to_starfile)
+
+
+class AsyncOSFProject:
+    """List, download and upload files of an OSF project without blocking.
+
+    Requests go to the OSF API v2 and the WaterButler file service with
+    aiohttp. At most max_concurrency requests or transfers run at once.
+
+    Parameters
+    ----------
+    token : str, default = None
+        Personal token from osf.io.
+        See: https://osf.io/settings/tokens
+    project_id : str, default = "xbr2m"
+        Identifier of the project, found on the OSF project page.
+    storage : str, default = "osfstorage"
+        Storage provider of the project.
+    max_concurrency : int, default = 16
+        Maximum number of concurrent requests.
+    chunk_size : int, default = 1 << 20
+        Number of bytes streamed at once in transfers.
+    api_url : str, default = "https://api.osf.io/v2"
+    files_url : str, default = "https://files.osf.io/v1"
+
+    See Also
+    --------
+    datasets.OSFProject
+    OSF API documentation : https://developer.osf.io/
+    """
+
+    def __init__(
+        self,
+        token=None,
+        project_id="xbr2m",
+        storage="osfstorage",
+        max_concurrency=16,
+        chunk_size=1 << 20,
+        api_url="https://api.osf.io/v2",
+        files_url="https://files.osf.io/v1",
+    ):
+        if token is None:
+            raise TypeError("token must be provided.")
+        self.token = token
+        self.project_id = project_id
+        self.storage = storage
+        self.chunk_size = chunk_size
+        self.api_url = api_url.rstrip("/")
+        self.files_url = files_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._session = None
+        self._folders = {}
+
+    async def __aenter__(self):
+        """Enter the asynchronous runtime context."""
+        return self
+
+    async def __aexit__(self, *args):
+        """Close the HTTP session when exiting the runtime context."""
+        await self.close()
+
+    async def close(self):
+        """Close the HTTP session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        """Return the HTTP session, creating it on first use."""
+        if self._session is None:
+            try:
+                import aiohttp
+            except ImportError as error:
+                raise ImportError(
+                    "AsyncOSFProject requires aiohttp: pip install aiohttp"
+                ) from error
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Bearer {self.token}"},
+                raise_for_status=True,
+            )
+        return self._session
+
+    def _get_semaphore(self):
+        """Return the semaphore limiting concurrent requests, creating it if needed.
+
+        It is created in the running event loop, since before Python 3.10
+        semaphores are bound to the current loop when they are created.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def _root_files_url(self):
+        """Return the API url listing the files at the root of the storage."""
+        return f"{self.api_url}/nodes/{self.project_id}/files/{self.storage}/"
+
+    @property
+    def _root_upload_url(self):
+        """Return the WaterButler url of the root folder of the storage."""
+        return f"{self.files_url}/resources/{self.project_id}/providers/{self.storage}/"
+
+    async def _list_folder(self, url):
+        """Return the entries of a folder, following pagination."""
+        if url in self._folders:
+            return self._folders[url]
+        entries = []
+        session = self._get_session()
+        next_url = url
+        while next_url is not None:
+            async with self._get_semaphore(), session.get(next_url) as response:
+                page = await response.json()
+            entries.extend(page["data"])
+            next_url = page.get("links", {}).get("next")
+        self._folders[url] = entries
+        return entries
+
+    @staticmethod
+    def _folder_url(entry):
+        """Return the API url listing the files of a folder entry."""
+        return entry["relationships"]["files"]["links"]["related"]["href"]
+
+    async def _resolve(self, remote_path):
+        """Return the API entry of a remote file or folder, or None."""
+        url = self._root_files_url
+        names = [name for name in remote_path.strip("/").split("/") if name]
+        entry = None
+        for i_name, name in enumerate(names):
+            entries = await self._list_folder(url)
+            entry = next(
+                (item for item in entries if item["attributes"]["name"] == name), None
+            )
+            if entry is None:
+                return None
+            if entry["attributes"]["kind"] == "folder":
+                url = self._folder_url(entry)
+            elif i_name < len(names) - 1:
+                return None
+        return entry
+
+    async def _walk(self, url, prefix):
+        """Return the paths of all files under a folder."""
+        paths = []
+        subfolders = []
+        for entry in await self._list_folder(url):
+            path = prefix + "/" + entry["attributes"]["name"]
+            if entry["attributes"]["kind"] == "folder":
+                subfolders.append(self._walk(self._folder_url(entry), path))
+            else:
+                paths.append(path)
+        for subfolder_paths in await asyncio.gather(*subfolders):
+            paths.extend(subfolder_paths)
+        return paths
+
+    async def ls(self):
+        """List all files in the project.
+
+        Returns
+        -------
+        paths : list of str
+            Paths of the files, prefixed by the storage name,
+            e.g. osfstorage/randomrot1D_nodisorder/file.txt.
+        """
+        self._folders.clear()
+        return sorted(await self._walk(self._root_files_url, self.storage))
+
+    async def download(self, remote_path=None, local_path=None):
+        """Download a file from the project and save it locally.
+
+        The file is streamed to a temporary file next to local_path,
+        which is renamed once the download is complete.
+
+        Parameters
+        ----------
+        remote_path : str, default = None
+            Path of the file in the project storage,
+            e.g. randomrot1D_nodisorder/file.txt.
+        local_path : str, default = None
+            Local path where the file will be saved.
+        """
+        if remote_path is None:
+            raise TypeError("remote_path must be provided.")
+        if local_path is None:
+            raise TypeError("local_path must be provided.")
+        entry = await self._resolve(remote_path)
+        if entry is None or entry["attributes"]["kind"] != "file":
+            raise FileNotFoundError(f"{remote_path} is not a file of the project.")
+
+        tmp_path = local_path + ".part"
+        session = self._get_session()
+        try:
+            async with self._get_semaphore(), session.get(
+                entry["links"]["download"]
+            ) as response:
+                file = await run_in_executor(open, tmp_path, "wb")
+                try:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        await run_in_executor(file.write, chunk)
+                finally:
+                    await run_in_executor(file.close)
+            os.replace(tmp_path, local_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def _read_chunks(self, local_path):
+        """Yield the content of a local file in chunks, read in the pool."""
+        file = await run_in_executor(open, local_path, "rb")
+        try:
+            while True:
+                chunk = await run_in_executor(file.read, self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await run_in_executor(file.close)
+
+    async def _make_folders(self, folder_path):
+        """Return the WaterButler url of a remote folder, creating it if needed."""
+        upload_url = self._root_upload_url
+        list_url = self._root_files_url
+        session = self._get_session()
+        for name in [name for name in folder_path.strip("/").split("/") if name]:
+            entries = await self._list_folder(list_url)
+            entry = next(
+                (item for item in entries if item["attributes"]["name"] == name), None
+            )
+            if entry is None:
+                query = urllib.parse.urlencode({"kind": "folder", "name": name})
+                async with self._get_semaphore(), session.put(f"{upload_url}?{query}"):
+                    pass
+                self._folders.pop(list_url, None)
+                entries = await self._list_folder(list_url)
+                entry = next(
+                    item for item in entries if item["attributes"]["name"] == name
+                )
+            upload_url = entry["links"]["upload"]
+            list_url = self._folder_url(entry)
+        return upload_url, list_url
+
+    async def upload(self, local_path=None, remote_path=None):
+        """Upload a file to the project, replacing any file at the same path.
+
+        Missing remote folders are created.
+
+        Parameters
+        ----------
+        local_path : str, default = None
+            Local path of the file to upload.
+        remote_path : str, default = None
+            Path of the file in the project storage,
+            e.g. randomrot1D_nodisorder/file.txt.
+        """
+        if local_path is None:
+            raise TypeError("local_path must be provided.")
+        if remote_path is None:
+            raise TypeError("remote_path must be provided.")
+        folder_path, name = os.path.split(remote_path.strip("/"))
+        folder_url, list_url = await self._make_folders(folder_path)
+        entry = await self._resolve(remote_path)
+        if entry is None:
+            query = urllib.parse.urlencode({"kind": "file", "name": name})
+            url = f"{folder_url}?{query}"
+        else:
+            url = entry["links"]["upload"] + "?kind=file"
+
+        session = self._get_session()
+        async with self._get_semaphore(), session.put(
+            url, data=self._read_chunks(local_path)
+        ):
+            pass
+        self._folders.pop(list_url, None)
+
+    async def remove(self, remote_path=None):
+        """Remove a file of the project.
+
+        Parameters
+        ----------
+        remote_path : str, default = None
+            Path of the file in the project storage.
+        """
+        if remote_path is None:
+            raise TypeError("remote_path must be provided.")
+        entry = await self._resolve(remote_path)
+        if entry is None:
+            raise FileNotFoundError(f"{remote_path} is not a file of the project.")
+        session = self._get_session()
+        async with self._get_semaphore(), session.delete(entry["links"]["delete"]):
+            pass
+        self._folders.clear()
+
+    async def download_many(self, remote_paths, local_dir="."):
+        """Download files concurrently into a local directory.
+
+        Parameters
+        ----------
+        remote_paths : list of str
+            Paths of the files in the project storage.
+        local_dir : str, default = "."
+            Directory where the files are saved, under their remote path.
+
+        Returns
+        -------
+        local_paths : list of str
+        """
+        local_paths = [
+            os.path.join(local_dir, path.strip("/")) for path in remote_paths
+        ]
+        for local_path in local_paths:
+            os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        await asyncio.gather(
+            *(
+                self.download(remote_path, local_path)
+                for remote_path, local_path in zip(remote_paths, local_paths)
+            )
+        )
+        return local_paths
+
+    async def upload_many(self, local_paths, remote_dir=""):
+        """Upload files concurrently into a remote directory.
+
+        Parameters
+        ----------
+        local_paths : list of str
+        remote_dir : str, default = ""
+            Directory of the project storage receiving the files.
+        """
+        if remote_dir:
+            await self._make_folders(remote_dir)
+        await asyncio.gather(
+            *(
+                self.upload(path, remote_dir.rstrip("/") + "/" + os.path.basename(path))
+                for path in local_paths
+            )
+        )
@@ -3,10 +3,19 @@
 import itertools
 import os
 
-import gemmi
 import numpy as np
 
+from ioSPI._lazy import lazy_import
+from ioSPI.instrumentation import instrumented
 
+gemmi = lazy_import("gemmi")
+mrcfile = lazy_import("mrcfile")
+
+# h^2 / (2 pi m0 e) in V.A^2, converting electron form factors to potentials
+POTENTIAL_PREFACTOR = 47.87801
+
+
+@instrumented(reads="path")
 def read_atomic_model(path, i_model=0, clean=True, assemble=True):
     """Read PDB or mmCIF file.
 
@@ -184,6 +193,33 @@ def extract_gemmi_atoms(model, chains=None, split_chains=False):
     return atoms
 
 
+def extract_residue_indices(model, chains=None):
+    """
+    Return the index of the residue of each atom of a Gemmi model.
+
+    Atoms are in the order of extract_gemmi_atoms(model, chains), and
+    residues are numbered from 0 across all selected chains.
+
+    Parameters
+    ----------
+    model : Gemmi Class
+        Gemmi model
+    chains : list of strings
+        chains to select, optional.
+        If not provided, retrieve atoms from all chains.
+
+    Returns
+    -------
+    residue_indices : numpy.ndarray
+        Residue index of each atom, of shape (n_atoms,).
+    """
+    if chains is None:
+        chains = [ch.name for ch in model]
+
+    residue_sizes = [len(res) for ch in model if ch.name in chains for res in ch]
+    return np.repeat(np.arange(len(residue_sizes)), residue_sizes)
+
+
 def extract_atomic_parameter(atoms, parameter_type, split_chains=False):
     """
     Interpret Gemmi atoms and extract a single parameter type.
@@ -193,7 +229,8 @@ def extract_atomic_parameter(atoms, parameter_type, split_chains=False):
     atoms : list (of list(s)) of Gemmi atoms
         Gemmi atom objects associated with each chain
     parameter_type : string
-        'cartesian_coordinates', 'form_factor_a', or 'form_factor_b'
+        'cartesian_coordinates', 'electron_form_factor_a',
+        'electron_form_factor_b', or 'atom_name'
     split_chains : bool
         Optional, default: False
         if True, keep the atoms from different chains in separate lists
@@ -213,6 +250,8 @@ def extract_atomic_parameter(atoms, parameter_type, split_chains=False):
         atomic_parameter = [at.element.c4322.a for ch in atoms for at in ch]
     elif parameter_type == "electron_form_factor_b":
         atomic_parameter = [at.element.c4322.b for ch in atoms for at in ch]
+    elif parameter_type == "atom_name":
+        atomic_parameter = [at.name for ch in atoms for at in ch]
     else:
         raise ValueError("Atomic parameter type not recognized.")
 
@@ -227,7 +266,8 @@ def extract_atomic_parameter(atoms, parameter_type, split_chains=False):
     return atomic_parameter
 
 
-def write_atomic_model(path, model=gemmi.Model("model")):
+@instrumented(writes="path")
+def write_atomic_model(path, model=None):
     """Write Gemmi model to PDB or mmCIF file.
 
     Use Gemmi library to write an atomic model to file.
@@ -237,8 +277,8 @@ def write_atomic_model(path, model=gemmi.Model("model")):
     path : string
         Path to PDB or mmCIF file.
     model : Gemmi Class
-        Optional, default: gemmi.Model()
-        Gemmi model
+        Optional, default: None
+        Gemmi model. If None, an empty gemmi.Model("model") is written.
 
     Reference
     ---------
@@ -250,6 +290,8 @@ def write_atomic_model(path, model=gemmi.Model("model")):
     is_cif = path.lower().endswith(".cif")
     if not (is_pdb or is_cif):
         raise ValueError("File format not recognized.")
+    if model is None:
+        model = gemmi.Model("model")
 
     structure = gemmi.Structure()
     structure.add_model(model, pos=-1)
@@ -261,7 +303,8 @@ def write_atomic_model(path, model=gemmi.Model("model")):
         structure.write_pdb(path)
 
 
-def write_cartesian_coordinates(path, cartesian_coordinates_np=np.random.rand(10, 3)):
+@instrumented(writes="path")
+def write_cartesian_coordinates(path, cartesian_coordinates_np=None):
     """Write Numpy array of cartesian coordinates to PDB or mmCIF file.
 
     Parameters
@@ -269,8 +312,9 @@ def write_cartesian_coordinates(path, cartesian_coordinates_np=np.random.rand(10
     path : string
         Path to PDB or mmCIF file
     cartesian_coordinates_np : numpy array
-        Optional, default: np.random.rand(10,3)
+        Optional, default: None
         Second axis must be of dimension 3.
+        If None, use np.random.rand(10,3).
 
     -------
 
@@ -279,6 +323,8 @@ def write_cartesian_coordinates(path, cartesian_coordinates_np=np.random.rand(10
     is_cif = path.lower().endswith(".cif")
     if not (is_pdb or is_cif):
         raise ValueError("File format not recognized.")
+    if cartesian_coordinates_np is None:
+        cartesian_coordinates_np = np.random.rand(10, 3)
 
     if cartesian_coordinates_np.shape[1] != 3:
         raise ValueError(
@@ -307,3 +353,456 @@ def write_cartesian_coordinates(path, cartesian_coordinates_np=np.random.rand(10
         structure.make_mmcif_document().write_file(path)
     if is_pdb:
         structure.write_pdb(path)
+
+
+def build_potential_map(
+    coordinates,
+    form_factor_a,
+    form_factor_b,
+    shape,
+    voxel_size=1.0,
+    origin=(0.0, 0.0, 0.0),
+    b_factor=0.0,
+    tolerance=1e-4,
+    chunk_size=4096,
+):
+    """Build the electron scattering potential of atoms on a 3D grid.
+
+    Each atom contributes the real-space transform of its 5-Gaussian
+    electron form factor (Peng, 1996):
+    V(r) = C sum_i a_i (4 pi / B_i)^(3/2) exp(-4 pi^2 r^2 / B_i),
+    with B_i = b_i + b_factor and C = POTENTIAL_PREFACTOR,
+    evaluated only on the voxels within the atom's cutoff radius,
+    beyond which its widest Gaussian drops below tolerance.
+    Atoms are processed in chunks of atoms sharing the same cutoff,
+    so that the cost scales with the number of atoms, not of voxels.
+
+    Parameters
+    ----------
+    coordinates : array-like
+        Cartesian coordinates (x, y, z) of the atoms in Angstrom,
+        of shape (n_atoms, 3).
+    form_factor_a : array-like
+        Gaussian amplitudes a_i of each atom, of shape (n_atoms, 5),
+        e.g. from extract_atomic_parameter(atoms, "electron_form_factor_a").
+    form_factor_b : array-like
+        Gaussian widths b_i of each atom in Angstrom^2, of shape (n_atoms, 5),
+        e.g. from extract_atomic_parameter(atoms, "electron_form_factor_b").
+    shape : tuple of int
+        Shape (nz, ny, nx) of the grid.
+    voxel_size : float
+        Optional, default: 1.0
+        Side of the voxels in Angstrom.
+    origin : tuple of float
+        Optional, default: (0, 0, 0)
+        Coordinates (x, y, z) of the center of voxel (0, 0, 0) in Angstrom.
+    b_factor : float
+        Optional, default: 0.0
+        Isotropic B-factor in Angstrom^2 added to all Gaussian widths.
+    tolerance : float
+        Optional, default: 1e-4
+        Relative value of the widest Gaussian at the cutoff radius.
+    chunk_size : int
+        Optional, default: 4096
+        Number of atoms processed at once, bounding memory usage.
+
+    Returns
+    -------
+    potential : numpy.ndarray
+        Potential in Volts on the grid, of shape (nz, ny, nx).
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    widths = np.asarray(form_factor_b, dtype=np.float64) + b_factor
+    amplitudes = np.asarray(form_factor_a, dtype=np.float64)
+    amplitudes = POTENTIAL_PREFACTOR * amplitudes * (4 * np.pi / widths) ** 1.5
+    origin = np.asarray(origin, dtype=np.float64)
+    shape = tuple(int(side) for side in shape)
+
+    potential = np.zeros(shape, dtype=np.float64)
+    flat_potential = potential.reshape(-1)
+    cutoffs = np.sqrt(widths.max(axis=1) * np.log(1 / tolerance)) / (2 * np.pi)
+    radii = np.ceil(cutoffs / voxel_size).astype(np.int64)
+
+    # voxel indices are ordered (z, y, x), coordinates (x, y, z)
+    grid_positions = (coordinates - origin) / voxel_size
+    centers = np.rint(grid_positions[:, ::-1]).astype(np.int64)
+    for radius in np.unique(radii):
+        steps = np.arange(-radius, radius + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"), -1)
+        offsets = offsets.reshape(-1, 3)
+        offsets = offsets[(offsets**2).sum(axis=1) <= (radius + 0.5) ** 2]
+
+        atoms = np.flatnonzero(radii == radius)
+        for start in range(0, len(atoms), chunk_size):
+            chunk = atoms[start : start + chunk_size]
+            voxels = centers[chunk, None, :] + offsets[None, :, :]
+            inside = np.all((voxels >= 0) & (voxels < shape), axis=-1)
+            squared_distances = (
+                (voxels[..., ::-1] - grid_positions[chunk, None, :]) ** 2
+            ).sum(axis=-1) * voxel_size**2
+            inside &= squared_distances <= cutoffs[chunk, None] ** 2
+
+            values = np.zeros(squared_distances.shape)
+            for i_gaussian in range(widths.shape[1]):
+                width = widths[chunk, i_gaussian, None]
+                values += amplitudes[chunk, i_gaussian, None] * np.exp(
+                    -4 * np.pi**2 * squared_distances / width
+                )
+            flat_indices = np.ravel_multi_index(tuple(voxels[inside].T), shape)
+            np.add.at(flat_potential, flat_indices, values[inside])
+
+    return potential
+
+
+@instrumented(writes="path")
+def write_potential_map(path, potential, voxel_size=1.0, origin=(0.0, 0.0, 0.0)):
+    """Write a 3D potential map to an .mrc file.
+
+    Parameters
+    ----------
+    path : string
+        Path to .mrc file.
+    potential : numpy.ndarray
+        Potential of shape (nz, ny, nx), e.g. from build_potential_map.
+    voxel_size : float
+        Optional, default: 1.0
+        Side of the voxels in Angstrom.
+    origin : tuple of float
+        Optional, default: (0, 0, 0)
+        Coordinates (x, y, z) of the center of voxel (0, 0, 0) in Angstrom.
+    """
+    with mrcfile.new(path, overwrite=True) as mrc:
+        mrc.set_data(np.asarray(potential, dtype=np.float32))
+        mrc.voxel_size = voxel_size
+        mrc.header.origin = tuple(origin)
+
+
+def euler_angles_to_rotation_matrices(angles):
+    """Convert relion Euler angles to rotation matrices.
+
+    Follows the ZYZ convention of relion (rlnAngleRot, rlnAngleTilt,
+    rlnAnglePsi), in which a particle in pose A projects along z
+    the rotated coordinates A r of its reference coordinates r.
+
+    Parameters
+    ----------
+    angles : array-like
+        Euler angles (rot, tilt, psi) in degrees, of shape (n_poses, 3).
+
+    Returns
+    -------
+    rotations : numpy.ndarray
+        Rotation matrices of shape (n_poses, 3, 3).
+    """
+    angles = np.deg2rad(np.asarray(angles, dtype=np.float64).reshape(-1, 3))
+    cos_rot, cos_tilt, cos_psi = np.cos(angles).T
+    sin_rot, sin_tilt, sin_psi = np.sin(angles).T
+
+    rotations = np.empty((len(angles), 3, 3))
+    rotations[:, 0, 0] = cos_psi * cos_tilt * cos_rot - sin_psi * sin_rot
+    rotations[:, 0, 1] = cos_psi * cos_tilt * sin_rot + sin_psi * cos_rot
+    rotations[:, 0, 2] = -cos_psi * sin_tilt
+    rotations[:, 1, 0] = -sin_psi * cos_tilt * cos_rot - cos_psi * sin_rot
+    rotations[:, 1, 1] = -sin_psi * cos_tilt * sin_rot + cos_psi * cos_rot
+    rotations[:, 1, 2] = sin_psi * sin_tilt
+    rotations[:, 2, 0] = sin_tilt * cos_rot
+    rotations[:, 2, 1] = sin_tilt * sin_rot
+    rotations[:, 2, 2] = cos_tilt
+    return rotations
+
+
+def _prepare_transforms(coordinates, rotations, angles, shifts, project, dtype):
+    """Validate the inputs of transform_coordinates and cast them to dtype."""
+    coordinates = np.asarray(coordinates)
+    if coordinates.ndim != 2 or coordinates.shape[1] != 3:
+        raise ValueError(
+            "Numpy array of cartesian coordinates should be of shape (Natom, 3)."
+        )
+    if dtype is None:
+        dtype = np.result_type(coordinates.dtype, np.float32)
+    if (rotations is None) == (angles is None):
+        raise ValueError("Exactly one of rotations and angles should be given.")
+    if angles is not None:
+        angles = np.asarray(angles)
+        if angles.ndim not in (1, 2) or angles.shape[-1] != 3:
+            raise ValueError("angles should be of shape (n_poses, 3).")
+        rotations = euler_angles_to_rotation_matrices(angles)
+    else:
+        rotations = np.asarray(rotations)
+        if rotations.ndim == 2:
+            rotations = rotations[np.newaxis]
+        if rotations.ndim != 3 or rotations.shape[1:] != (3, 3):
+            raise ValueError("rotations should be of shape (n_poses, 3, 3).")
+    n_dims = 2 if project else 3
+    # (x A^T) = (A x)^T: keeping only the first columns of A^T projects along z
+    rotations_t = rotations.astype(dtype, copy=False).transpose(0, 2, 1)[..., :n_dims]
+
+    if shifts is not None:
+        shifts = np.asarray(shifts, dtype=dtype).reshape(len(rotations), -1)
+        shifts = shifts[:, :n_dims]
+    return coordinates.astype(dtype, copy=False), rotations_t, shifts, dtype
+
+
+def _transform_chunk(coordinates, rotations_t, shifts, out):
+    """Transform coordinates by a chunk of poses, writing into out."""
+    np.matmul(coordinates, rotations_t, out=out)
+    if shifts is not None:
+        out[..., : shifts.shape[1]] += shifts[:, None, :]
+    return out
+
+
+def iter_transform_coordinates(
+    coordinates,
+    rotations=None,
+    shifts=None,
+    project=False,
+    chunk_size=64,
+    dtype=None,
+    angles=None,
+):
+    """Yield rigid-body transforms of cartesian coordinates, chunk by chunk.
+
+    Only one chunk of transformed coordinates is held in memory at once,
+    e.g. to project many poses of a large assembly and consume them
+    on the fly. See transform_coordinates for the parameters.
+
+    Yields
+    ------
+    start : int
+        Index of the first pose of the chunk.
+    transformed : numpy.ndarray
+        Transformed coordinates of shape (n_chunk_poses, n_atoms, 3),
+        or (n_chunk_poses, n_atoms, 2) if project is True.
+    """
+    coordinates, rotations_t, shifts, dtype = _prepare_transforms(
+        coordinates, rotations, angles, shifts, project, dtype
+    )
+    for start in range(0, len(rotations_t), chunk_size):
+        stop = start + chunk_size
+        chunk_rotations_t = rotations_t[start:stop]
+        out = np.empty(
+            (len(chunk_rotations_t), len(coordinates), rotations_t.shape[-1]),
+            dtype=dtype,
+        )
+        chunk_shifts = None if shifts is None else shifts[start:stop]
+        yield start, _transform_chunk(coordinates, chunk_rotations_t, chunk_shifts, out)
+
+
+def transform_coordinates(
+    coordinates,
+    rotations=None,
+    shifts=None,
+    project=False,
+    chunk_size=64,
+    dtype=None,
+    out=None,
+    angles=None,
+):
+    """Apply many rigid-body transforms to cartesian coordinates at once.
+
+    Poses are processed in chunks of chunk_size, each with a single
+    batched matrix product written directly into the output, without
+    intermediate arrays. The output itself holds all poses: to bound
+    memory, pass a numpy.memmap as out, or iterate over chunks with
+    iter_transform_coordinates.
+
+    Parameters
+    ----------
+    coordinates : array-like
+        Cartesian coordinates of the atoms, of shape (n_atoms, 3),
+        e.g. from extract_atomic_parameter(atoms, "cartesian_coordinates").
+    rotations : array-like
+        Optional, default: None
+        Rotation matrices of shape (n_poses, 3, 3), or a single rotation
+        matrix of shape (3, 3). Exactly one of rotations and angles
+        should be given.
+    shifts : array-like
+        Optional, default: None
+        Translations applied after rotation, of shape (n_poses, 3),
+        or (n_poses, 2) for in-plane shifts such as rlnOriginX/Y.
+    project : bool
+        Optional, default: False
+        If True, project the transformed coordinates along z
+        and return only their (x, y) components.
+    chunk_size : int
+        Optional, default: 64
+        Number of poses transformed by each matrix product.
+    dtype : str or numpy.dtype
+        Optional, default: None
+        Data type of the output. If None, use the type of coordinates,
+        promoted to float.
+    out : numpy.ndarray
+        Optional, default: None
+        Array, e.g. a numpy.memmap, receiving the transformed coordinates.
+        If None, a new array is allocated.
+    angles : array-like
+        Optional, default: None
+        Relion Euler angles in degrees of shape (n_poses, 3), or (3,)
+        for a single pose, see euler_angles_to_rotation_matrices.
+
+    Returns
+    -------
+    transformed : numpy.ndarray
+        Transformed coordinates of shape (n_poses, n_atoms, 3),
+        or (n_poses, n_atoms, 2) if project is True.
+    """
+    if out is not None and dtype is None:
+        dtype = out.dtype
+    coordinates, rotations_t, shifts, dtype = _prepare_transforms(
+        coordinates, rotations, angles, shifts, project, dtype
+    )
+    shape = (len(rotations_t), len(coordinates), rotations_t.shape[-1])
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"out should be of shape {shape}.")
+    for start in range(0, len(rotations_t), chunk_size):
+        stop = start + chunk_size
+        _transform_chunk(
+            coordinates,
+            rotations_t[start:stop],
+            None if shifts is None else shifts[start:stop],
+            out[start:stop],
+        )
+    return out
+
+
+def coarse_grain(
+    coordinates,
+    method="centroid",
+    residue_indices=None,
+    atom_names=None,
+    form_factor_a=None,
+    form_factor_b=None,
+    grid_size=4.0,
+):
+    """Reduce atoms to coarse-grained beads.
+
+    Each atom is assigned to a bead, either its residue or, for the "grid"
+    method, the cubic cell of side grid_size containing it. Beads are
+    placed at the centroid of their atoms, or at the C-alpha atom of their
+    residue for the "ca" method. All sums over atoms are vectorized with
+    np.bincount, so that assemblies of millions of atoms are reduced in
+    seconds.
+
+    If form factors are given, each bead gets the summed electron form
+    factor of its atoms: the amplitudes of each Gaussian are summed and
+    its widths averaged, weighted by amplitude. The spread of the atoms
+    around the bead is added to the widths as an isotropic B-factor
+    8 pi^2 <d^2> / 3, where <d^2> is the mean squared distance of the atoms
+    to the bead, so that the potential of the beads from build_potential_map
+    approximates the potential of the atoms blurred at the bead scale.
+
+    Parameters
+    ----------
+    coordinates : array-like
+        Cartesian coordinates (x, y, z) of the atoms in Angstrom,
+        of shape (n_atoms, 3).
+    method : str
+        Optional, default: "centroid"
+        "ca" for one bead per residue at its C-alpha atom, "centroid" for
+        one bead per residue at the centroid of its atoms, or "grid" for
+        one bead per occupied cell of a cubic grid.
+    residue_indices : array-like
+        Optional, default: None
+        Residue index of each atom, e.g. from extract_residue_indices.
+        Required by the "ca" and "centroid" methods.
+    atom_names : array-like
+        Optional, default: None
+        Name of each atom, e.g. from
+        extract_atomic_parameter(atoms, "atom_name").
+        Required by the "ca" method. Residues without a "CA" atom
+        are placed at their centroid.
+    form_factor_a : array-like
+        Optional, default: None
+        Gaussian amplitudes of each atom, of shape (n_atoms, 5),
+        e.g. from extract_atomic_parameter(atoms, "electron_form_factor_a").
+    form_factor_b : array-like
+        Optional, default: None
+        Gaussian widths of each atom in Angstrom^2, of shape (n_atoms, 5),
+        e.g. from extract_atomic_parameter(atoms, "electron_form_factor_b").
+    grid_size : float
+        Optional, default: 4.0
+        Side of the cells of the "grid" method in Angstrom.
+
+    Returns
+    -------
+    bead_coordinates : numpy.ndarray
+        Cartesian coordinates of the beads, of shape (n_beads, 3),
+        which can be written with write_cartesian_coordinates.
+    bead_form_factor_a : numpy.ndarray or None
+        Gaussian amplitudes of the beads, of shape (n_beads, 5),
+        or None if form factors are not given.
+    bead_form_factor_b : numpy.ndarray or None
+        Gaussian widths of the beads, of shape (n_beads, 5),
+        or None if form factors are not given.
+    labels : numpy.ndarray
+        Index of the bead of each atom, of shape (n_atoms,).
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    if coordinates.ndim != 2 or coordinates.shape[1] != 3:
+        raise ValueError(
+            "Numpy array of cartesian coordinates should be of shape (Natom, 3)."
+        )
+
+    if method in ("ca", "centroid"):
+        if residue_indices is None:
+            raise ValueError(f"Method {method} requires residue_indices.")
+        _, labels = np.unique(np.asarray(residue_indices), return_inverse=True)
+    elif method == "grid":
+        cells = np.floor((coordinates - coordinates.min(axis=0)) / grid_size)
+        cells = cells.astype(np.int64)
+        cell_keys = np.ravel_multi_index(cells.T, tuple(cells.max(axis=0) + 1))
+        _, labels = np.unique(cell_keys, return_inverse=True)
+    else:
+        raise ValueError("Coarse-graining method not recognized.")
+    labels = labels.reshape(-1)
+
+    n_beads = labels.max() + 1 if len(labels) else 0
+    counts = np.bincount(labels, minlength=n_beads)
+    bead_coordinates = np.stack(
+        [
+            np.bincount(labels, weights=coordinates[:, i_dim], minlength=n_beads)
+            for i_dim in range(3)
+        ],
+        axis=1,
+    )
+    bead_coordinates /= counts[:, None]
+
+    if method == "ca":
+        if atom_names is None:
+            raise ValueError("Method ca requires atom_names.")
+        is_ca = np.char.strip(np.asarray(atom_names, dtype=str)) == "CA"
+        bead_coordinates[labels[is_ca]] = coordinates[is_ca]
+
+    if form_factor_a is None or form_factor_b is None:
+        return bead_coordinates, None, None, labels
+
+    form_factor_a = np.asarray(form_factor_a, dtype=np.float64)
+    form_factor_b = np.asarray(form_factor_b, dtype=np.float64)
+    squared_distances = ((coordinates - bead_coordinates[labels]) ** 2).sum(axis=1)
+    spread_b_factor = (
+        8
+        * np.pi**2
+        * np.bincount(labels, weights=squared_distances, minlength=n_beads)
+        / counts
+        / 3
+    )
+
+    bead_form_factor_a = np.empty((n_beads, form_factor_a.shape[1]))
+    bead_form_factor_b = np.empty((n_beads, form_factor_b.shape[1]))
+    for i_gaussian in range(form_factor_a.shape[1]):
+        amplitudes = form_factor_a[:, i_gaussian]
+        summed_amplitudes = np.bincount(labels, weights=amplitudes, minlength=n_beads)
+        weighted_widths = np.bincount(
+            labels, weights=amplitudes * form_factor_b[:, i_gaussian], minlength=n_beads
+        )
+        bead_form_factor_a[:, i_gaussian] = summed_amplitudes
+        bead_form_factor_b[:, i_gaussian] = np.divide(
+            weighted_widths,
+            summed_amplitudes,
+            out=np.zeros(n_beads),
+            where=summed_amplitudes != 0,
+        )
+    bead_form_factor_b += spread_b_factor[:, None]
+    return bead_coordinates, bead_form_factor_a, bead_form_factor_b, labels
@@ -0,0 +1,280 @@
+"""Command-line interface for bulk conversion and inspection with ioSPI.
+
+Every subcommand accepts glob patterns, runs its files through a pool of
+--jobs workers and reports progress on stderr as files complete.
+
+Examples
+--------
+    iospi inspect "Micrographs/*.mrc" --jobs 16 > inventory.csv
+    iospi pdb2npy "models/*.cif" --output-dir coordinates
+    iospi mrc2hdf5 "Extract/*.mrcs" --output particles.hdf5 --jobs 8
+    iospi star-merge "Extract/*/*.star" --output particles.star
+    iospi star-split particles.star --by rlnMicrographName --output-dir split
+    iospi osf upload "results/*.star" --remote-dir results
+"""
+
+import argparse
+import glob
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from ioSPI import atomic_models, datasets, micrographs, particle_metadata
+
+
+def _expand(patterns):
+    """Return the sorted paths matching glob patterns, keeping their order."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+
+def _progress(i_done, n_total, message):
+    """Report progress on stderr."""
+    print(f"[{i_done}/{n_total}] {message}", file=sys.stderr, flush=True)
+
+
+def _run_pool(function, items, jobs, processes=False):
+    """Apply a function to items in a pool, yielding results as they complete.
+
+    Parameters
+    ----------
+    function : callable
+        Function of a single item.
+    items : list
+    jobs : int
+        Number of workers.
+    processes : bool, default = False
+        If True, use processes rather than threads.
+
+    Yields
+    ------
+    item, result
+    """
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=jobs) as executor:
+        futures = {executor.submit(function, item): item for item in items}
+        for i_done, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            result = future.result()
+            _progress(i_done, len(items), item)
+            yield item, result
+
+
+def inspect_mrc(args):
+    """Write the headers of .mrc files as CSV on stdout, in input order.
+
+    Files whose header cannot be read get a row with an error message,
+    and make the command exit with status 1.
+    """
+    paths = _expand(args.paths)
+    n_done = [0]
+
+    def callback(path):
+        n_done[0] += 1
+        _progress(n_done[0], len(paths), path)
+
+    headers = micrographs.scan_mrc_headers(paths, n_jobs=args.jobs, callback=callback)
+    # Nullable dtypes keep integer columns integer when some files failed.
+    headers.convert_dtypes().to_csv(sys.stdout, index=False)
+    return int(headers["error"].notna().any())
+
+
+def _convert_atomic_model(path, output_dir, clean, assemble):
+    """Save the cartesian coordinates of an atomic model as a .npy file."""
+    model = atomic_models.read_atomic_model(path, clean=clean, assemble=assemble)
+    atoms = atomic_models.extract_gemmi_atoms(model)
+    coordinates = np.asarray(
+        atomic_models.extract_atomic_parameter(atoms, "cartesian_coordinates")
+    )
+    name = os.path.splitext(os.path.basename(path))[0] + ".npy"
+    out_path = os.path.join(output_dir, name)
+    np.save(out_path, coordinates)
+    return out_path
+
+
+def _convert_atomic_model_args(item):
+    """Unpack the arguments of _convert_atomic_model for process pools."""
+    return _convert_atomic_model(*item)
+
+
+def pdb2npy(args):
+    """Convert PDB or mmCIF files to .npy arrays of cartesian coordinates."""
+    paths = _expand(args.paths)
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    clashes = sorted(name for name, count in Counter(names).items() if count > 1)
+    if clashes:
+        raise ValueError(
+            f"Several inputs would be saved as {clashes[0]}.npy in "
+            f"{args.output_dir}; convert them to different directories."
+        )
+    os.makedirs(args.output_dir, exist_ok=True)
+    items = [(path, args.output_dir, args.clean, args.assemble) for path in paths]
+    for _ in _run_pool(_convert_atomic_model_args, items, args.jobs, processes=True):
+        pass
+
+
+def mrc2hdf5(args):
+    """Convert .mrc files into a single chunked HDF5 dataset."""
+    paths = _expand(args.paths)
+    n_done = [0]
+
+    def callback(path):
+        n_done[0] += 1
+        _progress(n_done[0], len(paths), path)
+
+    micrographs.convert_mrc_to_hdf5(
+        paths,
+        args.output,
+        dataset_name=args.dataset,
+        n_jobs=args.jobs,
+        chunk_frames=args.chunk_frames,
+        resume=not args.overwrite,
+        callback=callback,
+    )
+
+
+def _write_starfile(path, data):
+    """Write starfile content to a path."""
+    directory, filename = os.path.split(path)
+    particle_metadata.write_metadata_to_starfile(directory or ".", data, filename)
+
+
+def star_merge(args):
+    """Concatenate starfiles into a single starfile."""
+    paths = _expand(args.paths)
+    data = particle_metadata.read_starfiles(paths, n_jobs=args.jobs, block=args.block)
+    _write_starfile(args.output, data)
+    _progress(len(paths), len(paths), args.output)
+
+
+def star_split(args):
+    """Split the rows of a starfile into one starfile per value of a column."""
+    content = particle_metadata.read_starfile(args.path)
+    table = content[args.block] if isinstance(content, dict) else content
+    column = particle_metadata.find_metadata_column(table, args.by)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    groups = list(table.groupby(column, sort=False))
+
+    def write_group(group):
+        value, rows = group
+        name = os.path.splitext(os.path.basename(str(value)))[0] + ".star"
+        data = rows.reset_index(drop=True)
+        if isinstance(content, dict):
+            data = {**content, args.block: data}
+        _write_starfile(os.path.join(args.output_dir, name), data)
+        return name
+
+    for _ in _run_pool(write_group, groups, args.jobs):
+        pass
+
+
+def osf(args):
+    """List, download or upload files of an OSF project."""
+    project = datasets.OSFProject(
+        username=args.username,
+        token=args.token,
+        project_id=args.project,
+        osfclient_path=args.osfclient_path,
+    )
+    if args.action == "ls":
+        sys.stdout.writelines(project.ls())
+        return
+
+    if args.action == "upload":
+        paths = _expand(args.paths)
+
+        def transfer(path):
+            remote_path = os.path.join(args.remote_dir, os.path.basename(path))
+            project.upload(local_path=path, remote_path=remote_path)
+
+    else:
+        paths = args.paths
+        os.makedirs(args.local_dir, exist_ok=True)
+
+        def transfer(path):
+            local_path = os.path.join(args.local_dir, os.path.basename(path))
+            project.download(remote_path=path, local_path=local_path)
+
+    for _ in _run_pool(transfer, paths, args.jobs):
+        pass
+
+
+def build_parser():
+    """Return the argument parser of the iospi command."""
+    parser = argparse.ArgumentParser(prog="iospi", description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, function, help, paths_help):
+        subparser = subparsers.add_parser(name, help=help, description=help)
+        if paths_help is not None:
+            subparser.add_argument("paths", nargs="+", help=paths_help)
+        subparser.add_argument(
+            "--jobs", "-j", type=int, default=None, help="number of parallel workers"
+        )
+        subparser.set_defaults(function=function)
+        return subparser
+
+    add_command("inspect", inspect_mrc, "Print .mrc headers as CSV.", ".mrc files")
+
+    subparser = add_command(
+        "pdb2npy", pdb2npy, "Convert atomic models to .npy.", "PDB or mmCIF files"
+    )
+    subparser.add_argument("--output-dir", default=".")
+    subparser.add_argument("--no-clean", dest="clean", action="store_false")
+    subparser.add_argument("--no-assemble", dest="assemble", action="store_false")
+
+    subparser = add_command(
+        "mrc2hdf5", mrc2hdf5, "Convert .mrc files to HDF5.", ".mrc files"
+    )
+    subparser.add_argument("--output", required=True, help=".hdf5 file or .zarr")
+    subparser.add_argument("--dataset", default="micrographs")
+    subparser.add_argument("--chunk-frames", type=int, default=1)
+    subparser.add_argument(
+        "--overwrite", action="store_true", help="do not resume a conversion"
+    )
+
+    subparser = add_command("star-merge", star_merge, "Merge starfiles.", "starfiles")
+    subparser.add_argument("--output", required=True)
+    subparser.add_argument("--block", default="particles")
+
+    subparser = add_command("star-split", star_split, "Split a starfile.", None)
+    subparser.add_argument("path", help="starfile")
+    subparser.add_argument("--by", default="rlnMicrographName")
+    subparser.add_argument("--output-dir", default=".")
+    subparser.add_argument("--block", default="particles")
+
+    subparser = add_command("osf", osf, "Transfer files with OSF.", None)
+    subparser.add_argument("action", choices=["ls", "download", "upload"])
+    subparser.add_argument(
+        "paths", nargs="*", help="local files to upload or remote files to download"
+    )
+    subparser.add_argument("--username", default=os.environ.get("IOSPI_OSF_USERNAME"))
+    subparser.add_argument("--token", default=os.environ.get("IOSPI_OSF_TOKEN"))
+    subparser.add_argument("--project", default="xbr2m")
+    subparser.add_argument("--osfclient-path", default=None)
+    subparser.add_argument("--remote-dir", default="")
+    subparser.add_argument("--local-dir", default=".")
+    return parser
+
+
+def main(argv=None):
+    """Run the iospi command.
+
+    Parameters
+    ----------
+    argv : list of str, default = None
+        Command-line arguments. If None, use sys.argv.
+    """
+    args = build_parser().parse_args(argv)
+    return args.function(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
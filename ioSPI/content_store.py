@@ -0,0 +1,291 @@
+"""Store identical outputs once, addressed by the hash of their content.
+
+Parameter sweeps often write the same arrays many times, e.g. with the
+same seed and configuration. A ContentStore keeps one object per unique
+content under its root directory, and each output path becomes a hard
+link, or a symbolic link across filesystems, to that object.
+
+Example
+-------
+>>> from ioSPI import content_store, micrographs
+>>> store = content_store.ContentStore("store")
+>>> micrographs.write_micrograph_to_mrc("run_0", micrograph, 0, store=store)
+>>> micrographs.write_micrograph_to_mrc("run_1", micrograph, 0, store=store)
+>>> store.stats()["objects"]
+1
+"""
+
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ioSPI.instrumentation import record_cache
+
+HASH_CHUNK_SIZE = 1 << 24
+
+
+def hash_array(array, digest, chunk_size=HASH_CHUNK_SIZE):
+    """Add the dtype, shape and data of an array to a hash.
+
+    The data of contiguous arrays is hashed from their own buffer,
+    without copies. Other arrays are hashed one sub-array at a time,
+    so that only one sub-array is copied at once.
+
+    Parameters
+    ----------
+    array : numpy.ndarray
+    digest : hashlib hash object
+        Hash to update, e.g. hashlib.sha256().
+    chunk_size : int, default = HASH_CHUNK_SIZE
+        Number of bytes hashed at once.
+    """
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    _hash_buffer(array, digest, chunk_size)
+
+
+def _hash_buffer(array, digest, chunk_size):
+    """Add the data of an array to a hash, in C order."""
+    if array.flags.c_contiguous:
+        buffer = memoryview(array.reshape(-1).view(np.uint8))
+        for start in range(0, len(buffer), chunk_size):
+            digest.update(buffer[start : start + chunk_size])
+    elif array.ndim > 1:
+        for sub_array in array:
+            _hash_buffer(sub_array, digest, chunk_size)
+    else:
+        digest.update(np.ascontiguousarray(array).view(np.uint8))
+
+
+def hash_data(data, digest):
+    """Add arrays, scalars and nested dictionaries to a hash.
+
+    Parameters
+    ----------
+    data : numpy.ndarray, dict, list, tuple or scalar
+    digest : hashlib hash object
+        Hash to update, e.g. hashlib.sha256().
+    """
+    if isinstance(data, (np.ndarray, np.generic)):
+        hash_array(np.asarray(data), digest)
+    elif isinstance(data, dict):
+        digest.update(b"{")
+        for key in sorted(data, key=str):
+            digest.update(repr(key).encode())
+            hash_data(data[key], digest)
+        digest.update(b"}")
+    elif isinstance(data, (list, tuple)):
+        digest.update(b"[")
+        for item in data:
+            hash_data(item, digest)
+        digest.update(b"]")
+    else:
+        digest.update(f"{type(data).__name__}:{data!r}".encode())
+
+
+def release(path):
+    """Remove a path if it is a link to a stored object.
+
+    Writers call this before overwriting an output path, so that writing
+    new content there does not modify an object shared with other outputs.
+
+    Parameters
+    ----------
+    path : str
+    """
+    if os.path.islink(path) or (os.path.isfile(path) and os.stat(path).st_nlink > 1):
+        os.remove(path)
+
+
+class ContentStore:
+    """Directory of objects addressed by the hash of their content.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the store. Objects are kept in root/objects, and the
+        output paths linked to each object are listed in root/references.
+    algorithm : str, default = "sha256"
+        Name of the hashlib algorithm used for keys.
+    """
+
+    def __init__(self, root, algorithm="sha256"):
+        self.root = root
+        self.algorithm = algorithm
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def __contains__(self, key):
+        """Return True if the store holds an object for a key."""
+        return os.path.isfile(self.object_path(key))
+
+    def key(self, *data):
+        """Return the key of content described by arrays, scalars and dicts.
+
+        Parameters
+        ----------
+        *data
+            Everything that determines the content of the output, e.g.
+            the name of the writer, its arrays and its options.
+
+        Returns
+        -------
+        key : str
+            Hex digest of the data.
+        """
+        digest = hashlib.new(self.algorithm)
+        hash_data(list(data), digest)
+        return digest.hexdigest()
+
+    def object_path(self, key):
+        """Return the path of the object of a key."""
+        return os.path.join(self.root, "objects", key[:2], key[2:])
+
+    def put(self, key, path, write):
+        """Write an output through the store.
+
+        If the store has no object for the key, the content is written once
+        by calling write with a temporary path, and moved into the store.
+        The output path is then linked to the object.
+
+        Parameters
+        ----------
+        key : str
+            Key of the content, see key.
+        path : str
+            Output path.
+        write : callable
+            Function writing the content to the path it is given.
+
+        Returns
+        -------
+        new : bool
+            True if the content was written, False if it was already stored.
+        """
+        object_path = self.object_path(key)
+        new = key not in self
+        record_cache(not new)
+        if new:
+            tmp_path = os.path.join(self.root, "tmp", uuid.uuid4().hex)
+            try:
+                write(tmp_path)
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(tmp_path, object_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self.link(key, path)
+        return new
+
+    def link(self, key, path):
+        """Make a path a link to the object of a key.
+
+        A hard link is used where possible, and a symbolic link otherwise,
+        e.g. when the path is on another filesystem.
+
+        Parameters
+        ----------
+        key : str
+        path : str
+        """
+        object_path = self.object_path(key)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(object_path, path)
+        except OSError:
+            os.symlink(os.path.abspath(object_path), path)
+        with self._lock, open(os.path.join(self.root, "references"), "a") as file:
+            file.write(f"{key}\t{os.path.abspath(path)}\n")
+
+    def keys(self):
+        """Return the keys of all stored objects."""
+        objects_root = os.path.join(self.root, "objects")
+        return sorted(
+            prefix + name
+            for prefix in os.listdir(objects_root)
+            for name in os.listdir(os.path.join(objects_root, prefix))
+        )
+
+    def references(self):
+        """Return the output paths linked to each object.
+
+        Returns
+        -------
+        references : dict
+            List of output paths for each key. An output path linked
+            several times only counts for its most recent key.
+        """
+        keys = {}
+        path = os.path.join(self.root, "references")
+        if os.path.isfile(path):
+            with open(path) as file:
+                for line in file:
+                    key, output_path = line.rstrip("\n").split("\t", 1)
+                    keys[output_path] = key
+        references = {}
+        for output_path, key in keys.items():
+            references.setdefault(key, []).append(output_path)
+        return references
+
+    def stats(self):
+        """Return the number of objects and references and the stored bytes.
+
+        Returns
+        -------
+        stats : dict
+            objects, references, stored_bytes, and referenced_bytes, the
+            size the outputs would take without the store.
+        """
+        sizes = {key: os.path.getsize(self.object_path(key)) for key in self.keys()}
+        references = self.references()
+        return {
+            "objects": len(sizes),
+            "references": sum(len(paths) for paths in references.values()),
+            "stored_bytes": sum(sizes.values()),
+            "referenced_bytes": sum(
+                sizes.get(key, 0) * len(paths) for key, paths in references.items()
+            ),
+        }
+
+    def upload(self, project, remote_dir="objects", n_jobs=None):
+        """Upload the objects not uploaded yet to an OSF project.
+
+        Each unique content is uploaded once, whatever its number of
+        references. Uploaded keys are recorded in root/uploaded.
+
+        Parameters
+        ----------
+        project : datasets.OSFProject
+        remote_dir : str, default = "objects"
+            Remote directory of the objects, named by their key.
+        n_jobs : int, default = None
+            Number of parallel uploads. If None, use the number of CPUs.
+
+        Returns
+        -------
+        uploaded : list of str
+            Keys of the uploaded objects.
+        """
+        uploaded_path = os.path.join(self.root, "uploaded")
+        done = set()
+        if os.path.isfile(uploaded_path):
+            with open(uploaded_path) as file:
+                done = set(file.read().split())
+        keys = [key for key in self.keys() if key not in done]
+
+        def upload_object(key):
+            project.upload(
+                local_path=self.object_path(key),
+                remote_path=remote_dir.rstrip("/") + "/" + key,
+            )
+            with self._lock, open(uploaded_path, "a") as file:
+                file.write(key + "\n")
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(upload_object, keys))
+        return keys
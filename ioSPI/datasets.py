@@ -1,8 +1,28 @@
 """Module to house methods related to datasets (micrographs, meta-data, etc.)."""
 
+import fnmatch
+import glob
 import io
+import json
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from ioSPI import atomic_models, micrographs, particle_metadata
+from ioSPI._lazy import lazy_import
+from ioSPI.instrumentation import instrumented
+
+h5py = lazy_import("h5py")
+
+MANIFEST_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+
+FILE_KINDS = {
+    "micrographs": (".mrc", ".mrcs", ".mrc.gz", ".mrcs.gz", ".mrc.bz2", ".mrcs.bz2"),
+    "metadata": (".star",),
+    "hdf5": (".hdf5", ".h5"),
+    "atomic_model": (".pdb", ".ent", ".cif", ".mmcif"),
+}
 
 
 class OSFProject:
@@ -62,6 +82,7 @@ class OSFProject:
             out_file.write(f"token = {token}\n")
         print("OSF config written to .osfcli.config!")
 
+    @instrumented()
     def ls(self):
         """List all files in the project."""
         print(f"Listing files from OSF project: {self.project_id}...")
@@ -75,6 +96,7 @@ class OSFProject:
 
         return io.StringIO(file_list).readlines()
 
+    @instrumented(writes="local_path")
     def download(self, remote_path: str = None, local_path: str = None):
         """Download a file from an OSF project and save it locally.
 
@@ -106,6 +128,7 @@ class OSFProject:
         )
         print("Done!")
 
+    @instrumented(reads="local_path")
     def upload(self, local_path: str = None, remote_path: str = None):
         """Upload a file to an OSF project.
 
@@ -141,6 +164,7 @@ class OSFProject:
         )
         print("Done!")
 
+    @instrumented()
     def remove(self, remote_path: str = None):
         """Remove a file in an OSF project.
 
@@ -166,3 +190,414 @@ class OSFProject:
             stdout=subprocess.PIPE,
         )
         print("Done!")
+
+
+def get_file_kind(path):
+    """Return the kind of a dataset file from its extension.
+
+    Parameters
+    ----------
+    path : str
+        File name.
+
+    Returns
+    -------
+    kind : str
+        One of the keys of FILE_KINDS, or "other".
+    """
+    name = path.lower()
+    for kind, extensions in FILE_KINDS.items():
+        if name.endswith(extensions):
+            return kind
+    return "other"
+
+
+def _hdf5_schema(path):
+    """Return the shape and dtype of every dataset of an HDF5 file."""
+    schema = {}
+
+    def visit(name, node):
+        if isinstance(node, h5py.Dataset):
+            schema[name] = {"shape": list(node.shape), "dtype": str(node.dtype)}
+
+    with h5py.File(path, "r") as file:
+        file.visititems(visit)
+    return schema
+
+
+def _starfile_schema(path):
+    """Return the number of rows and the column dtypes of each starfile block."""
+    content = particle_metadata.read_starfile(path, use_sidecar=False)
+    if not isinstance(content, dict):
+        content = {"": content}
+    return {
+        block: {
+            "n_rows": len(table),
+            "columns": {column: str(dtype) for column, dtype in table.dtypes.items()},
+        }
+        for block, table in content.items()
+    }
+
+
+def describe_file(path, checksum=True):
+    """Return the manifest entry of a file.
+
+    Parameters
+    ----------
+    path : str
+        Local path of the file.
+    checksum : bool, default = True
+        If True, record the sha256 checksum of the file.
+
+    Returns
+    -------
+    entry : dict
+        kind, size and sha256 of the file, and depending on its kind,
+        the "header" of a micrograph stack (frame count, shape, dtype),
+        the "blocks" of a starfile (row count and column dtypes per block)
+        or the "datasets" of an HDF5 file (shape and dtype per dataset).
+    """
+    kind = get_file_kind(path)
+    entry = {"kind": kind, "size": os.path.getsize(path)}
+    if checksum:
+        entry["sha256"] = particle_metadata.file_checksum(path)
+    if kind == "micrographs":
+        header = micrographs.read_mrc_header(path)
+        entry["header"] = {
+            key: header[key] for key in ("n_frames", "nx", "ny", "dtype", "mode")
+        }
+    elif kind == "metadata":
+        entry["blocks"] = _starfile_schema(path)
+    elif kind == "hdf5":
+        entry["datasets"] = _hdf5_schema(path)
+    return entry
+
+
+class Dataset:
+    """Collection of files described by a manifest.
+
+    The manifest records the size, checksum and schema of every file of
+    the dataset (frame counts of micrograph stacks, columns of starfiles,
+    datasets of HDF5 files), so that a dataset opens without rescanning
+    its files. Files are stored under a local root directory and, if a
+    project is given, fetched from OSF only when they are first needed.
+
+    Parameters
+    ----------
+    root : str
+        Local directory holding the files of the dataset.
+    files : dict, default = None
+        Manifest entries keyed by path relative to root, see describe_file.
+    project : OSFProject, default = None
+        OSF project to fetch missing files from.
+    remote_root : str, default = ""
+        Directory of the dataset in the storage of the OSF project.
+
+    Example
+    -------
+    >>> dataset = Dataset.create("simulation", n_jobs=8)
+    >>> dataset = Dataset.open("simulation", project=project)
+    >>> dataset.select(kind="metadata")
+    >>> stack = dataset.load("0000.mrcs")
+    """
+
+    def __init__(self, root, files=None, project=None, remote_root=""):
+        self.root = root
+        self.files = {} if files is None else dict(files)
+        self.project = project
+        self.remote_root = remote_root
+
+    def __len__(self):
+        """Return the number of files of the dataset."""
+        return len(self.files)
+
+    def __iter__(self):
+        """Iterate over the relative paths of the files of the dataset."""
+        return iter(self.files)
+
+    def __contains__(self, name):
+        """Return True if a relative path is part of the dataset."""
+        return name in self.files
+
+    @property
+    def manifest_path(self):
+        """Local path of the manifest."""
+        return os.path.join(self.root, MANIFEST_FILENAME)
+
+    @classmethod
+    def create(
+        cls, root, paths=None, n_jobs=None, checksum=True, project=None, remote_root=""
+    ):
+        """Scan local files, then write the manifest of the dataset.
+
+        Parameters
+        ----------
+        root : str
+            Local directory holding the files of the dataset.
+        paths : list of str, default = None
+            Paths of the files relative to root, or glob patterns matching
+            them. If None, use all the files under root.
+        n_jobs : int, default = None
+            Number of threads scanning files. If None, use the number of CPUs.
+        checksum : bool, default = True
+            If True, record the sha256 checksum of every file.
+        project : OSFProject, default = None
+        remote_root : str, default = ""
+
+        Returns
+        -------
+        dataset : Dataset
+        """
+        dataset = cls(root, project=project, remote_root=remote_root)
+        dataset.add(_find_files(root, paths), n_jobs=n_jobs, checksum=checksum)
+        dataset.save()
+        return dataset
+
+    @classmethod
+    def open(cls, path, project=None):
+        """Open a dataset from its manifest, without scanning its files.
+
+        Parameters
+        ----------
+        path : str
+            Manifest file, or directory holding a manifest.json file.
+        project : OSFProject, default = None
+            OSF project to fetch missing files from.
+
+        Returns
+        -------
+        dataset : Dataset
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, MANIFEST_FILENAME)
+        with open(path) as file:
+            manifest = json.load(file)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(
+                f"Unsupported manifest version {manifest.get('version')} in {path}."
+            )
+        return cls(
+            os.path.dirname(path) or ".",
+            files=manifest["files"],
+            project=project,
+            remote_root=manifest.get("remote_root", ""),
+        )
+
+    def save(self):
+        """Write the manifest to the root directory of the dataset."""
+        os.makedirs(self.root, exist_ok=True)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "remote_root": self.remote_root,
+            "files": self.files,
+        }
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def add(self, names, n_jobs=None, checksum=True):
+        """Scan local files in parallel and add them to the manifest.
+
+        The manifest is not saved, see save.
+
+        Parameters
+        ----------
+        names : list of str
+            Paths of the files relative to the root of the dataset.
+        n_jobs : int, default = None
+            Number of threads scanning files. If None, use the number of CPUs.
+        checksum : bool, default = True
+            If True, record the sha256 checksum of every file.
+        """
+        names = list(names)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            entries = executor.map(
+                lambda name: describe_file(self.local_path(name), checksum=checksum),
+                names,
+            )
+            self.files.update(zip(names, entries))
+
+    def select(self, kind=None, pattern=None):
+        """Return the relative paths of the files matching a kind and a pattern.
+
+        Parameters
+        ----------
+        kind : str, default = None
+            Kind of file, see FILE_KINDS. If None, match all kinds.
+        pattern : str, default = None
+            Glob pattern on relative paths. If None, match all paths.
+
+        Returns
+        -------
+        names : list of str
+        """
+        return [
+            name
+            for name, entry in self.files.items()
+            if (kind is None or entry["kind"] == kind)
+            and (pattern is None or fnmatch.fnmatch(name, pattern))
+        ]
+
+    def local_path(self, name):
+        """Return the local path of a file of the dataset."""
+        return os.path.join(self.root, name)
+
+    def remote_path(self, name):
+        """Return the path of a file of the dataset in the OSF project storage."""
+        if not self.remote_root:
+            return name
+        return self.remote_root.rstrip("/") + "/" + name
+
+    def _check(self, name, checksum):
+        """Return the problem with a local file, or None if it is intact."""
+        path = self.local_path(name)
+        entry = self.files[name]
+        if not os.path.isfile(path):
+            return "missing"
+        if os.path.getsize(path) != entry["size"]:
+            return "size mismatch"
+        if (
+            checksum
+            and "sha256" in entry
+            and particle_metadata.file_checksum(path) != entry["sha256"]
+        ):
+            return "checksum mismatch"
+        return None
+
+    def verify(self, names=None, n_jobs=None, checksum=True):
+        """Check in parallel that local files match the manifest.
+
+        Parameters
+        ----------
+        names : list of str, default = None
+            Relative paths of the files to check. If None, check all files.
+        n_jobs : int, default = None
+            Number of threads. If None, use the number of CPUs.
+        checksum : bool, default = True
+            If True, compare checksums. Otherwise, only compare sizes.
+
+        Returns
+        -------
+        problems : dict
+            For each file that does not match the manifest, "missing",
+            "size mismatch" or "checksum mismatch".
+        """
+        names = list(self.files if names is None else names)
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = executor.map(lambda name: self._check(name, checksum), names)
+            return {name: problem for name, problem in zip(names, results) if problem}
+
+    def fetch(self, names=None, n_jobs=None, verify=True):
+        """Download the files missing locally from the OSF project.
+
+        Parameters
+        ----------
+        names : list of str, default = None
+            Relative paths of the files needed. If None, fetch all files.
+        n_jobs : int, default = None
+            Number of parallel downloads. If None, use the number of CPUs.
+        verify : bool, default = True
+            If True, raise a ValueError if a downloaded file does not match
+            its checksum.
+
+        Returns
+        -------
+        fetched : list of str
+            Relative paths of the downloaded files.
+        """
+        names = list(self.files if names is None else names)
+        missing = [name for name in names if not os.path.isfile(self.local_path(name))]
+        if missing and self.project is None:
+            raise FileNotFoundError(
+                f"{len(missing)} files are missing and no OSF project is set, "
+                f"e.g. {self.local_path(missing[0])}."
+            )
+
+        def download(name):
+            os.makedirs(os.path.dirname(self.local_path(name)) or ".", exist_ok=True)
+            self.project.download(
+                remote_path=self.remote_path(name), local_path=self.local_path(name)
+            )
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(download, missing))
+        if verify and missing:
+            problems = self.verify(missing, n_jobs=n_jobs)
+            if problems:
+                raise ValueError(f"Fetched files do not match the manifest: {problems}")
+        return missing
+
+    def path(self, name, fetch=True):
+        """Return the local path of a file, fetching it first if needed.
+
+        Parameters
+        ----------
+        name : str
+            Relative path of the file.
+        fetch : bool, default = True
+            If True, download the file if it is missing locally.
+
+        Returns
+        -------
+        path : str
+        """
+        if name not in self.files:
+            raise KeyError(f"{name} is not part of the dataset.")
+        if fetch:
+            self.fetch([name])
+        return self.local_path(name)
+
+    def load(self, name, **kwargs):
+        """Read a file of the dataset, fetching it first if needed.
+
+        Micrograph stacks are read with micrographs.read_micrograph_from_mrc,
+        starfiles with particle_metadata.read_starfile, HDF5 files with
+        micrographs.read_data_dict_from_hdf5 and atomic models with
+        atomic_models.read_atomic_model, to which kwargs are passed.
+
+        Parameters
+        ----------
+        name : str
+            Relative path of the file.
+
+        Returns
+        -------
+        content : numpy.ndarray, pandas.DataFrame, dict or gemmi.Model
+        """
+        path = self.path(name)
+        kind = self.files[name]["kind"]
+        if kind == "micrographs":
+            return micrographs.read_micrograph_from_mrc(path, **kwargs)
+        if kind == "metadata":
+            return particle_metadata.read_starfile(path, **kwargs)
+        if kind == "hdf5":
+            return micrographs.read_data_dict_from_hdf5(path, **kwargs)
+        if kind == "atomic_model":
+            return atomic_models.read_atomic_model(path, **kwargs)
+        raise ValueError(f"Cannot load {name} of kind {kind}.")
+
+
+def _find_files(root, patterns=None):
+    """Return the paths relative to root of the files matching glob patterns."""
+    if patterns is None:
+        names = []
+        for directory, _, filenames in os.walk(root):
+            names.extend(
+                os.path.relpath(os.path.join(directory, filename), root)
+                for filename in filenames
+            )
+    else:
+        names = []
+        for pattern in patterns:
+            names.extend(
+                os.path.relpath(path, root)
+                for path in glob.glob(os.path.join(root, pattern), recursive=True)
+                if os.path.isfile(path)
+            )
+    return sorted(
+        name.replace(os.sep, "/")
+        for name in set(names)
+        if name != MANIFEST_FILENAME
+        and not name.endswith(".star" + particle_metadata.SIDECAR_EXTENSION)
+    )
@@ -0,0 +1,218 @@
+"""Record timing and I/O statistics of ioSPI functions.
+
+Instrumentation is off by default, in which case instrumented functions
+only pay for one boolean check. When it is on, every call to a public I/O
+function produces an event recording its wall time, the bytes it read and
+wrote, the number of files it touched and its cache hits and misses.
+Events are emitted as DEBUG records of the "ioSPI.instrumentation" logger,
+with the event dictionary in the ``iospi_event`` attribute of the record,
+and are aggregated per function in an in-memory counter registry.
+
+Example
+-------
+>>> from ioSPI import instrumentation, micrographs
+>>> with instrumentation.enabled():
+...     micrographs.read_micrograph_from_mrc("0000.mrcs")
+>>> instrumentation.get_counters()["micrographs.read_micrograph_from_mrc"]
+"""
+
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("ioSPI.instrumentation")
+
+COUNTER_FIELDS = (
+    "calls",
+    "errors",
+    "wall_time",
+    "bytes_read",
+    "bytes_written",
+    "files",
+    "cache_hits",
+    "cache_misses",
+)
+
+_enabled = False
+_counters = {}
+_counters_lock = threading.Lock()
+_current_event = contextvars.ContextVar("ioSPI_instrumentation_event", default=None)
+
+
+def enable():
+    """Turn instrumentation on."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Turn instrumentation off."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Return True if instrumentation is on."""
+    return _enabled
+
+
+@contextlib.contextmanager
+def enabled():
+    """Turn instrumentation on within a context."""
+    previous = _enabled
+    enable()
+    try:
+        yield
+    finally:
+        if not previous:
+            disable()
+
+
+def get_counters():
+    """Return the statistics aggregated per instrumented function.
+
+    Returns
+    -------
+    counters : dict of dict
+        For each function name, the total of each field of COUNTER_FIELDS
+        over all its instrumented calls.
+    """
+    with _counters_lock:
+        return {name: dict(counter) for name, counter in _counters.items()}
+
+
+def reset_counters():
+    """Clear the counter registry."""
+    with _counters_lock:
+        _counters.clear()
+
+
+def record_io(bytes_read=0, bytes_written=0, files=0):
+    """Add I/O statistics to the event of the current instrumented call.
+
+    Does nothing if instrumentation is off or no instrumented call is running.
+
+    Parameters
+    ----------
+    bytes_read : int, default = 0
+    bytes_written : int, default = 0
+    files : int, default = 0
+        Number of files opened.
+    """
+    event = _current_event.get()
+    if event is None:
+        return
+    event["bytes_read"] += bytes_read
+    event["bytes_written"] += bytes_written
+    event["files"] += files
+
+
+def record_cache(hit):
+    """Count a cache hit or miss in the event of the current instrumented call.
+
+    Parameters
+    ----------
+    hit : bool
+        True for a cache hit, False for a miss.
+    """
+    event = _current_event.get()
+    if event is None:
+        return
+    event["cache_hits" if hit else "cache_misses"] += 1
+
+
+def _file_size(path):
+    """Return the size of a file, or 0 if it is not a regular file."""
+    try:
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+    except (OSError, TypeError, ValueError):
+        return 0
+
+
+def _publish(event):
+    """Log an event and add it to the counter registry."""
+    with _counters_lock:
+        counter = _counters.setdefault(
+            event["name"], {field: 0 for field in COUNTER_FIELDS}
+        )
+        counter["calls"] += 1
+        counter["errors"] += int(event["error"] is not None)
+        for field in COUNTER_FIELDS[2:]:
+            counter[field] += event[field]
+    logger.debug(
+        "%s took %.6f s, read %d B, wrote %d B",
+        event["name"],
+        event["wall_time"],
+        event["bytes_read"],
+        event["bytes_written"],
+        extra={"iospi_event": event},
+    )
+
+
+def instrumented(reads=None, writes=None):
+    """Decorate a function to record an event for each of its calls.
+
+    Parameters
+    ----------
+    reads : str, default = None
+        Name of the argument holding the path of a file read by the
+        function, whose size is counted as bytes read.
+    writes : str, default = None
+        Name of the argument holding the path of a file written by the
+        function, whose size after the call is counted as bytes written.
+
+    Returns
+    -------
+    decorator : callable
+    """
+
+    def decorator(func):
+        module = func.__module__.rsplit(".", 1)[-1]
+        name = f"{module}.{func.__qualname__}"
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            event = {
+                "name": name,
+                "wall_time": 0.0,
+                "bytes_read": 0,
+                "bytes_written": 0,
+                "files": 0,
+                "cache_hits": 0,
+                "cache_misses": 0,
+                "error": None,
+            }
+            if reads is not None and reads in arguments:
+                size = _file_size(arguments[reads])
+                event["bytes_read"] += size
+                event["files"] += int(size > 0)
+
+            token = _current_event.set(event)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as error:
+                event["error"] = repr(error)
+                raise
+            finally:
+                event["wall_time"] = time.perf_counter() - start
+                _current_event.reset(token)
+                if writes is not None and writes in arguments:
+                    size = _file_size(arguments[writes])
+                    event["bytes_written"] += size
+                    event["files"] += int(size > 0)
+                _publish(event)
+
+        return wrapper
+
+    return decorator
@@ -1,15 +1,106 @@
 """Read and write micrographs."""
 
+import bz2
+import glob
+import gzip
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import h5py
-import mrcfile
 import numpy as np
 
+from ioSPI import content_store, particle_metadata
+from ioSPI._lazy import lazy_import
+from ioSPI.instrumentation import instrumented, record_cache, record_io
+
+h5py = lazy_import("h5py")
+mrcfile = lazy_import("mrcfile")
+pd = lazy_import("pandas")
+
+
+HDF5_TYPE_ATTRIBUTE = "iospi_type"
+
+
+def _is_scalar(value):
+    """Return True for numbers, bools, strings and numpy scalars."""
+    return isinstance(value, (int, float, complex, str, bytes, np.generic))
+
+
+def _populate_hdf5_with_list(h5file, name, values):
+    """Save a list in bulk, as a few datasets.
+
+    Lists of scalars, and nested lists forming a regular numeric array,
+    are saved as one array, lists of arrays of the same shape and dtype
+    as one stacked array, and lists of arrays of different shapes as a
+    group holding their concatenated flattened "values", the "offsets" of
+    each array in values and their "shapes". Lists of dicts with the same
+    keys are saved as a group with one list per key, and lists of None as
+    an empty group recording their length.
+
+    Parameters
+    ----------
+    h5file : h5py.File
+        .hdf5 file to write to.
+    name : str
+        Path of the list in the file.
+    values : list or tuple
+    """
+    if all(isinstance(value, str) for value in values) and values:
+        h5file.create_dataset(name, data=np.array(values, dtype=h5py.string_dtype()))
+    elif all(value is None for value in values) and values:
+        group = h5file.create_group(name)
+        group.attrs[HDF5_TYPE_ATTRIBUTE] = "none"
+        group.attrs["length"] = len(values)
+    elif all(_is_scalar(value) for value in values):
+        array = np.asarray(values)
+        if array.dtype.kind in "US" and not all(
+            isinstance(value, bytes) for value in values
+        ):
+            raise ValueError(
+                f"Cannot save list of strings mixed with other types in {name}"
+            )
+        h5file[name] = array
+    elif all(isinstance(value, (list, tuple)) for value in values):
+        try:
+            array = np.asarray(values)
+        except ValueError:
+            array = None
+        if array is None or array.dtype.kind not in "biufc":
+            raise ValueError(
+                f"Cannot save nested lists other than numeric arrays in {name}"
+            )
+        h5file[name] = array
+    elif all(isinstance(value, np.ndarray) for value in values):
+        shapes = {value.shape for value in values}
+        if len(shapes) == 1 and len({value.dtype for value in values}) == 1:
+            h5file[name] = np.stack(values)
+        elif len({len(shape) for shape in shapes}) == 1:
+            group = h5file.create_group(name)
+            group.attrs[HDF5_TYPE_ATTRIBUTE] = "ragged"
+            group["values"] = np.concatenate([value.reshape(-1) for value in values])
+            group["offsets"] = np.cumsum([0] + [value.size for value in values])
+            group["shapes"] = np.array([value.shape for value in values])
+        else:
+            raise ValueError(f"Cannot save arrays of different ndim in {name}")
+    elif all(isinstance(value, dict) for value in values) and (
+        len({tuple(value) for value in values}) == 1
+    ):
+        group = h5file.create_group(name)
+        group.attrs[HDF5_TYPE_ATTRIBUTE] = "records"
+        columns = {key: [value[key] for value in values] for key in values[0]}
+        _populate_hdf5_with_dict(h5file, name + "/", columns)
+    else:
+        raise ValueError(f"Cannot save list of mixed types in {name}")
+
 
 def _populate_hdf5_with_dict(h5file, path, dic):
     """Recursively save dictionary contents to group.
 
+    Arrays, numpy scalars of any dtype, numbers, bools and strings are
+    saved as datasets, None as an empty attribute of the group, and
+    lists and tuples in bulk, see _populate_hdf5_with_list.
+
     Parameters
     ----------
     h5file : h5py.File
@@ -20,32 +111,227 @@ def _populate_hdf5_with_dict(h5file, path, dic):
         Dictionary containing data.
     """
     for k, v in dic.items():
-        if isinstance(v, (np.ndarray, np.int64, np.float64, int, float, str, bytes)):
+        if isinstance(v, np.ndarray) or _is_scalar(v):
             h5file[path + k] = v
-        elif isinstance(v, type(None)):
-            h5file[path + k] = str("None")
+        elif v is None:
+            group = h5file.require_group(path) if path.strip("/") else h5file
+            group.attrs[k] = h5py.Empty("f")
         elif isinstance(v, dict):
             _populate_hdf5_with_dict(h5file, path + k + "/", v)
+        elif isinstance(v, (list, tuple)):
+            _populate_hdf5_with_list(h5file, path + k, v)
         else:
             raise ValueError("Cannot save %s type" % type(v))
 
 
-def read_micrograph_from_mrc(path):
+def _read_hdf5_group(group):
+    """Recursively read the contents of a group saved by _populate_hdf5_with_dict.
+
+    Parameters
+    ----------
+    group : h5py.Group
+
+    Returns
+    -------
+    dic : dict
+    """
+    dic = {}
+    for k, v in group.items():
+        if isinstance(v, h5py.Dataset):
+            if h5py.check_string_dtype(v.dtype) is not None:
+                dic[k] = v.asstr()[()]
+            else:
+                dic[k] = v[()]
+        elif v.attrs.get(HDF5_TYPE_ATTRIBUTE) == "none":
+            dic[k] = [None] * int(v.attrs["length"])
+        elif v.attrs.get(HDF5_TYPE_ATTRIBUTE) == "ragged":
+            values = v["values"][()]
+            offsets = v["offsets"][()]
+            dic[k] = [
+                values[start:stop].reshape(shape)
+                for start, stop, shape in zip(offsets[:-1], offsets[1:], v["shapes"])
+            ]
+        else:
+            dic[k] = _read_hdf5_group(v)
+    for k, v in group.attrs.items():
+        if isinstance(v, h5py.Empty):
+            dic[k] = None
+    return dic
+
+
+QUANTIZATION_LABEL = "ioSPI quantization scale=%.9g offset=%.9g"
+
+QUANTIZED_DTYPES = ("int8", "int16")
+
+
+def _detect_compression(path):
+    """Return "gzip", "bzip2" or None from the first bytes of a file."""
+    with open(path, "rb") as file:
+        magic = file.read(3)
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    if magic == b"BZh":
+        return "bzip2"
+    return None
+
+
+def _open_maybe_compressed(path):
+    """Open a file for binary reading, decompressing gzip or bzip2 files."""
+    opener = {"gzip": gzip.open, "bzip2": bz2.open, None: open}
+    return opener[_detect_compression(path)](path, "rb")
+
+
+def _open_mrc(path):
+    """Open an .mrc file for reading, memory-mapped unless it is compressed.
+
+    Compressed files cannot be memory-mapped, and are decompressed
+    into memory instead.
+    """
+    if _detect_compression(path) is None:
+        return mrcfile.mmap(path, "r", permissive=True)
+    return mrcfile.open(path, "r", permissive=True)
+
+
+def _add_label(header, label):
+    """Add a label to an MRC header, overwriting the last one if it is full."""
+    n_labels = int(header.nlabl)
+    if n_labels < len(header.label):
+        header.label[n_labels] = label
+        header.nlabl = n_labels + 1
+    else:
+        header.label[-1] = label
+
+
+def _read_quantization(header):
+    """Return the (scale, offset) recorded in the labels of an MRC header.
+
+    Returns None if the data was not quantized by write_micrograph_to_mrc.
+    """
+    for label in header.label[: int(header.nlabl)]:
+        label = label.decode("ascii", errors="ignore").strip()
+        if label.startswith("ioSPI quantization"):
+            fields = dict(field.split("=") for field in label.split()[2:])
+            return float(fields["scale"]), float(fields["offset"])
+    return None
+
+
+def _quantize(data, dtype):
+    """Map data linearly onto the full range of an integer dtype.
+
+    Returns the quantized data, and the scale and offset such that
+    data is approximately quantized * scale + offset.
+    """
+    info = np.iinfo(dtype)
+    low, high = float(data.min()), float(data.max())
+    scale = (high - low) / (info.max - info.min) if high > low else 1.0
+    offset = low - info.min * scale
+    quantized = np.rint((data - offset) / scale).clip(info.min, info.max)
+    return quantized.astype(dtype), scale, offset
+
+
+def _bin_frame(frame, bin_factor):
+    """Average non-overlapping bin_factor x bin_factor blocks of a frame.
+
+    Rows and columns that do not fill a whole block are discarded.
+    """
+    ny, nx = (side // bin_factor for side in frame.shape)
+    frame = frame[: ny * bin_factor, : nx * bin_factor]
+    return frame.reshape(ny, bin_factor, nx, bin_factor).mean(axis=(1, 3))
+
+
+def _fourier_crop_frame(frame, shape):
+    """Downsample a frame by keeping only its lowest spatial frequencies.
+
+    The output is rescaled so that the mean intensity is preserved.
+    """
+    ny, nx = frame.shape
+    out_ny, out_nx = shape
+    if out_ny > ny or out_nx > nx:
+        raise ValueError("Fourier crop shape must not exceed the frame shape.")
+    spectrum = np.fft.rfft2(frame)
+    rows = np.r_[0 : (out_ny + 1) // 2, ny - out_ny // 2 : ny]
+    cropped = spectrum[rows, : out_nx // 2 + 1]
+    return np.fft.irfft2(cropped, s=shape) * (out_ny * out_nx) / (ny * nx)
+
+
+@instrumented(reads="path")
+def read_micrograph_from_mrc(
+    path, roi=None, bin_factor=1, fourier_crop=None, dtype=None
+):
     """Return micrograph from an input .mrc file.
 
+    Gzip and bzip2 compressed files are decompressed transparently.
+    When any read-time option is given, uncompressed files are
+    memory-mapped and the options are applied frame by frame, so that
+    memory usage scales with the size of the output rather than the size
+    of the file.
+
     Parameters
     ----------
     path : str
         File name for .mrc file to turn into micrograph
+    roi : tuple of int, default = None
+        Region of interest (y_start, y_stop, x_start, x_stop) kept
+        in each frame. If None, keep the whole frame.
+    bin_factor : int, default = 1
+        Side of the square blocks averaged in real space, after cropping.
+    fourier_crop : int or tuple of int, default = None
+        Output frame shape (ny, nx) obtained by Fourier cropping,
+        after cropping and binning. If None, no Fourier cropping is done.
+    dtype : str or numpy.dtype, default = None
+        Output data type, e.g. "float16" or "float32".
+        If None, keep the data type of the file,
+        or float32 if the frames are binned or Fourier cropped.
+        Data quantized by write_micrograph_to_mrc is dequantized
+        when the output data type is floating point.
+
+    Returns
+    -------
+    micrograph : numpy.ndarray
+        Frames of shape (n_frames, ny, nx).
     """
-    with mrcfile.open(path, "r", permissive=True) as mrc:
-        micrograph = mrc.data
-    if len(micrograph.shape) == 2:
-        micrograph = micrograph[np.newaxis, ...]
+    if roi is None and bin_factor == 1 and fourier_crop is None and dtype is None:
+        with mrcfile.open(path, "r", permissive=True) as mrc:
+            micrograph = mrc.data
+        if len(micrograph.shape) == 2:
+            micrograph = micrograph[np.newaxis, ...]
+        return micrograph
+
+    if isinstance(fourier_crop, int):
+        fourier_crop = (fourier_crop, fourier_crop)
+    with _open_mrc(path) as mrc:
+        data = mrc.data
+        quantization = _read_quantization(mrc.header)
+        if data.ndim == 2:
+            data = data[np.newaxis, ...]
+        if roi is not None:
+            data = data[:, roi[0] : roi[1], roi[2] : roi[3]]
+
+        frame_shape = data.shape[1:]
+        if bin_factor != 1:
+            frame_shape = tuple(side // bin_factor for side in frame_shape)
+        if fourier_crop is not None:
+            frame_shape = tuple(fourier_crop)
+        if dtype is None:
+            resampled = bin_factor != 1 or fourier_crop is not None
+            dtype = np.float32 if resampled else data.dtype
+        if np.dtype(dtype).kind != "f":
+            quantization = None
+
+        micrograph = np.empty((data.shape[0],) + frame_shape, dtype=dtype)
+        for i_frame, frame in enumerate(data):
+            if quantization is not None:
+                frame = frame * quantization[0] + quantization[1]
+            if bin_factor != 1:
+                frame = _bin_frame(frame, bin_factor)
+            if fourier_crop is not None:
+                frame = _fourier_crop_frame(frame, fourier_crop)
+            micrograph[i_frame] = frame
     return micrograph
 
 
-def write_data_dict_to_hdf5(path, data_dict):
+@instrumented(writes="path")
+def write_data_dict_to_hdf5(path, data_dict, store=None):
     """Convert arbitrary dictionary data to hdf5 file format.
 
     Parameters
@@ -54,25 +340,976 @@ def write_data_dict_to_hdf5(path, data_dict):
         Dictionary of data to save.
     path : str
         Relative path to h5 file.
+    store : content_store.ContentStore
+        Optional, default: None
+        If given, the file is written once per unique data_dict into the
+        store, and path is a link to the stored file.
     """
     dic = {"data": data_dict}
-    with h5py.File(path, "w") as file:
-        _populate_hdf5_with_dict(file, "/", dic)
+
+    def write(file_path):
+        with h5py.File(file_path, "w") as file:
+            _populate_hdf5_with_dict(file, "/", dic)
+
+    if store is None:
+        content_store.release(path)
+        write(path)
+    else:
+        store.put(store.key("write_data_dict_to_hdf5", dic), path, write)
+
+
+@instrumented(reads="path")
+def read_data_dict_from_hdf5(path):
+    """Read a dictionary saved with write_data_dict_to_hdf5.
+
+    Lists of scalars and lists of arrays of the same shape are read back
+    as arrays, lists of arrays of different shapes as lists of arrays,
+    and lists of dicts with the same keys as dicts of columns.
+
+    Parameters
+    ----------
+    path : str
+        Relative path to h5 file.
+
+    Returns
+    -------
+    data_dict : dict
+    """
+    with h5py.File(path, "r") as file:
+        return _read_hdf5_group(file["data"])
 
 
-def write_micrograph_to_mrc(path, micrograph, iterations):
+@instrumented()
+def write_micrograph_to_mrc(
+    path, micrograph, iterations, dtype="float32", compression=None, store=None
+):
     """Save the projection batch as an mrcs file in the output directory.
 
     Parameters
     ----------
     path: str
         path to save data
-    micrograph: torch.Tensor
-        projection from the simulator (batch_size,1, side_len, side_len)
+    micrograph: torch.Tensor or numpy.ndarray
+        projection from the simulator (batch_size,1, side_len, side_len).
+        Contiguous float32 CPU tensors, including pinned ones, and arrays
+        are written from their own buffer, without intermediate copies.
     iterations: int
         iteration number of the loop. Used in naming the mrcs file.`
+    dtype: str
+        Optional, default: "float32"
+        Stored data type: "float32", "float16" (MRC mode 12),
+        or "int8" and "int16", for which the data is linearly quantized
+        and the scale and offset are recorded in a header label.
+    compression: str
+        Optional, default: None
+        "gzip" or "bzip2" to compress the file, whose name then gets
+        a ".gz" or ".bz2" suffix.
+    store: content_store.ContentStore
+        Optional, default: None
+        If given, the file is written once per unique micrograph, dtype
+        and compression into the store, and the mrcs file is a link to
+        the stored file.
     """
     image_path = os.path.join(path, str(iterations).zfill(4) + ".mrcs")
-    micrograph = micrograph.detach().cpu().numpy()
-    with mrcfile.new(image_path, overwrite="True") as m:
-        m.set_data(micrograph.astype("float32"))
+    if compression is not None:
+        image_path += {"gzip": ".gz", "bzip2": ".bz2"}[compression]
+    if not isinstance(micrograph, np.ndarray):
+        micrograph = micrograph.detach().cpu().numpy()
+
+    label = None
+    if dtype in QUANTIZED_DTYPES:
+        micrograph, scale, offset = _quantize(micrograph, dtype)
+        label = QUANTIZATION_LABEL % (scale, offset)
+    elif dtype not in ("float32", "float16"):
+        raise ValueError("Cannot save %s type" % dtype)
+
+    def write(file_path):
+        with mrcfile.new(file_path, overwrite="True", compression=compression) as m:
+            m.set_data(micrograph.astype(dtype, copy=False))
+            if label is not None:
+                _add_label(m.header, label)
+
+    if store is None:
+        content_store.release(image_path)
+        write(image_path)
+        record_io(bytes_written=os.path.getsize(image_path), files=1)
+    else:
+        key = store.key("write_micrograph_to_mrc", micrograph, dtype, compression)
+        if store.put(key, image_path, write):
+            record_io(bytes_written=os.path.getsize(image_path), files=1)
+
+
+class Hdf5Reader:
+    """Read datasets of an .hdf5 file from many threads or processes.
+
+    h5py file handles must not be shared across forked processes, and all
+    h5py calls of a process are serialized by a global lock. This reader
+    opens the file lazily in each process and thread that uses it, keeps
+    that handle open for later reads, and never pickles it, so that each
+    DataLoader worker reads through its own handle.
+
+    Parameters
+    ----------
+    path : str
+        Path to the .hdf5 file, e.g. written by write_data_dict_to_hdf5.
+    **kwargs
+        Arguments of h5py.File, e.g. rdcc_nbytes to size the chunk cache.
+    """
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._files = []
+
+    def __getstate__(self):
+        """Return the state of the reader for pickling, without open files."""
+        return {"path": self.path, "kwargs": self.kwargs}
+
+    def __setstate__(self, state):
+        """Restore the reader from its pickled state."""
+        self.__init__(state["path"], **state["kwargs"])
+
+    def __enter__(self):
+        """Enter the runtime context."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the files when exiting the runtime context."""
+        self.close()
+
+    def _file(self):
+        """Return the handle of the current process and thread."""
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            self._local.pid = pid
+            self._local.file = h5py.File(self.path, "r", **self.kwargs)
+            with self._lock:
+                self._files.append((pid, self._local.file))
+        return self._local.file
+
+    def close(self):
+        """Close the handles opened by the current process."""
+        pid = os.getpid()
+        with self._lock:
+            for file_pid, file in self._files:
+                if file_pid == pid:
+                    file.close()
+            self._files = [item for item in self._files if item[0] != pid]
+        self._local = threading.local()
+
+    def shape(self, name):
+        """Return the shape of a dataset.
+
+        Parameters
+        ----------
+        name : str
+            Path of the dataset in the file, e.g. "data/images".
+
+        Returns
+        -------
+        shape : tuple of int
+        """
+        return self._file()[name].shape
+
+    @instrumented()
+    def read(self, name, indices=None):
+        """Read entries of a dataset along its first axis.
+
+        Indices are sorted and deduplicated, and consecutive runs are read
+        as slices, so that the file is accessed contiguously whatever the
+        order of the requested indices.
+
+        Parameters
+        ----------
+        name : str
+            Path of the dataset in the file, e.g. "data/images".
+        indices : int, slice or array-like of int, default = None
+            Entries to read. If None, read the whole dataset.
+
+        Returns
+        -------
+        data : numpy.ndarray
+            Entries in the requested order.
+        """
+        dataset = self._file()[name]
+        if indices is None:
+            data = dataset[()]
+            record_io(bytes_read=data.nbytes)
+            return data
+        if isinstance(indices, slice) or np.isscalar(indices):
+            data = dataset[indices]
+            record_io(bytes_read=np.asarray(data).nbytes)
+            return data
+
+        indices = np.arange(dataset.shape[0])[indices]
+        unique, inverse = np.unique(indices, return_inverse=True)
+        data = np.empty((len(unique),) + dataset.shape[1:], dtype=dataset.dtype)
+        run_starts = np.flatnonzero(np.diff(unique, prepend=-2) != 1)
+        run_stops = np.append(run_starts[1:], len(unique))
+        for start, stop in zip(run_starts, run_stops):
+            data[start:stop] = dataset[unique[start] : unique[stop - 1] + 1]
+        record_io(bytes_read=data.nbytes)
+        return data[inverse.reshape(-1)]
+
+
+def _is_valid_mode(mode):
+    """Return True if an integer is a valid MRC mode."""
+    try:
+        mrcfile.utils.dtype_from_mode(mode)
+    except ValueError:
+        return False
+    return True
+
+
+@instrumented()
+def read_mrc_header(path):
+    """Return the metadata of an .mrc file, reading only its main header.
+
+    Gzip and bzip2 compressed files are decompressed on the fly,
+    and only up to the end of the header.
+
+    Parameters
+    ----------
+    path : str
+        File name of the .mrc file.
+
+    Returns
+    -------
+    header : dict
+        path, nx, ny, n_frames, mode, dtype, voxel_size_x, voxel_size_y,
+        voxel_size_z, extended_header_size and file_size of the file.
+    """
+    with _open_maybe_compressed(path) as file:
+        raw = file.read(mrcfile.dtypes.HEADER_DTYPE.itemsize)
+    record_io(bytes_read=len(raw), files=1)
+    if len(raw) < mrcfile.dtypes.HEADER_DTYPE.itemsize:
+        raise ValueError(f"{path} is too short to be an MRC file.")
+    header = np.frombuffer(raw, dtype=mrcfile.dtypes.HEADER_DTYPE)
+    try:
+        byte_order = mrcfile.utils.byte_order_from_machine_stamp(header["machst"][0])
+    except ValueError:
+        # Zero or unknown machine stamps are common: like mrcfile in
+        # permissive mode, assume little-endian unless the mode is invalid.
+        byte_order = "<"
+        mode = header["mode"].view("<i4")[0]
+        if not _is_valid_mode(mode) and _is_valid_mode(mode.byteswap()):
+            byte_order = ">"
+    header = header.view(mrcfile.dtypes.HEADER_DTYPE.newbyteorder(byte_order))
+    header = header.view(np.recarray)[0]
+
+    n_frames = int(header.nz)
+    cella = header.cella
+    return {
+        "path": path,
+        "nx": int(header.nx),
+        "ny": int(header.ny),
+        "n_frames": n_frames,
+        "mode": int(header.mode),
+        "dtype": str(mrcfile.utils.dtype_from_mode(header.mode)),
+        "voxel_size_x": float(cella.x) / max(int(header.mx), 1),
+        "voxel_size_y": float(cella.y) / max(int(header.my), 1),
+        "voxel_size_z": float(cella.z) / max(int(header.mz), 1),
+        "extended_header_size": int(header.nsymbt),
+        "file_size": os.path.getsize(path),
+    }
+
+
+@instrumented()
+def scan_mrc_headers(paths, n_jobs=None, callback=None):
+    """Read the headers of many .mrc files in parallel.
+
+    Parameters
+    ----------
+    paths : str or list of str
+        File names of the .mrc files, or a glob pattern matching them.
+    n_jobs : int, default = None
+        Number of threads. If None, use the ThreadPoolExecutor default.
+    callback : callable, default = None
+        Function called with the path of each file once its header is read,
+        in the order of paths, e.g. to report progress.
+
+    Returns
+    -------
+    headers : pandas.DataFrame
+        One row per file, with the fields returned by read_mrc_header,
+        and error, the message of the error raised when reading the header
+        of the file, or None. Fields of files with errors are missing.
+    """
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+
+    def read_header(path):
+        try:
+            return {**read_mrc_header(path), "error": None}
+        except (OSError, ValueError, EOFError) as error:
+            return {"path": path, "error": f"{type(error).__name__}: {error}"}
+
+    headers = []
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for header in executor.map(read_header, paths):
+            headers.append(header)
+            if callback is not None:
+                callback(header["path"])
+    columns = [
+        "path",
+        "nx",
+        "ny",
+        "n_frames",
+        "mode",
+        "dtype",
+        "voxel_size_x",
+        "voxel_size_y",
+        "voxel_size_z",
+        "extended_header_size",
+        "file_size",
+        "error",
+    ]
+    return pd.DataFrame(headers, columns=columns)
+
+
+def _check_headers(headers):
+    """Raise a ValueError if headers scanned by scan_mrc_headers have errors."""
+    failed = headers[headers["error"].notna()]
+    if len(failed):
+        raise ValueError(
+            f"Could not read the header of {len(failed)} file(s), "
+            f"e.g. {failed['path'].iloc[0]}: {failed['error'].iloc[0]}"
+        )
+    return headers
+
+
+@instrumented()
+def read_micrograph_to_tensor(path):
+    """Return a torch tensor backed by a memory map of an .mrc file.
+
+    The file is mapped copy-on-write: no data is read until it is accessed,
+    and in-place modifications of the tensor are not written back to disk.
+
+    Parameters
+    ----------
+    path : str
+        File name of an uncompressed .mrc file.
+
+    Returns
+    -------
+    micrograph : torch.Tensor
+        Frames of shape (n_frames, ny, nx).
+    """
+    import torch
+
+    if _detect_compression(path) is not None:
+        raise ValueError("Only uncompressed mrc files can be memory-mapped.")
+    with mrcfile.open(path, "r", permissive=True, header_only=True) as mrc:
+        header = mrc.header
+        dtype = mrcfile.utils.data_dtype_from_header(header)
+        offset = header.nbytes + int(header.nsymbt)
+        shape = (int(header.nz), int(header.ny), int(header.nx))
+    data = np.memmap(path, dtype=dtype, mode="c", offset=offset, shape=shape)
+    if not dtype.isnative:
+        data = data.astype(dtype.newbyteorder("="))
+    return torch.from_numpy(data)
+
+
+class VirtualMrcStack:
+    """Many .mrc(s) files viewed as a single stack of frames.
+
+    Only file headers are scanned to build a cumulative frame-offset index,
+    which can be saved to disk to reopen the stack without rescanning.
+    Frames are read from memory-mapped files, keeping at most
+    max_open_files of them open at once. Gzip and bzip2 compressed files
+    are decompressed into memory when opened.
+
+    Parameters
+    ----------
+    paths : str or list of str
+        File names of the .mrc(s) files, or a glob pattern matching them.
+    n_frames : array-like of int, default = None
+        Number of frames in each file. If None, headers are scanned
+        with scan_mrc_headers.
+    max_open_files : int, default = 128
+        Maximum number of memory-mapped files kept open.
+    """
+
+    def __init__(self, paths, n_frames=None, max_open_files=128):
+        if isinstance(paths, str):
+            paths = sorted(glob.glob(paths))
+        self.paths = list(paths)
+        # Frame shape and dtype of each file, from headers or opened files.
+        self._frame_info = {}
+        if n_frames is None:
+            headers = _check_headers(scan_mrc_headers(self.paths))
+            n_frames = headers["n_frames"].to_numpy()
+            for file_id, (ny, nx, dtype) in enumerate(
+                zip(headers["ny"], headers["nx"], headers["dtype"])
+            ):
+                self._frame_info[file_id] = ((int(ny), int(nx)), np.dtype(dtype))
+        self.n_frames = np.asarray(n_frames, dtype=np.int64)
+        if len(self.n_frames) != len(self.paths):
+            raise ValueError("n_frames must have one entry per file.")
+        self.offsets = np.concatenate([[0], np.cumsum(self.n_frames)])
+        self.max_open_files = max_open_files
+        self._handles = OrderedDict()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        """Return the state of the stack for pickling, without open files."""
+        state = self.__dict__.copy()
+        state["_handles"] = OrderedDict()
+        return state
+
+    @classmethod
+    def from_index(cls, index_path, **kwargs):
+        """Reopen a stack from an index saved with save_index.
+
+        Parameters
+        ----------
+        index_path : str
+            File name of the .npz index.
+
+        Returns
+        -------
+        stack : VirtualMrcStack
+        """
+        with np.load(index_path, allow_pickle=False) as index:
+            paths = [str(path) for path in index["paths"]]
+            n_frames = index["n_frames"]
+        return cls(paths, n_frames=n_frames, **kwargs)
+
+    def save_index(self, index_path):
+        """Save the frame-offset index of the stack.
+
+        Parameters
+        ----------
+        index_path : str
+            File name of the .npz index.
+        """
+        with open(index_path, "wb") as file:
+            np.savez(file, paths=np.array(self.paths), n_frames=self.n_frames)
+
+    def __len__(self):
+        """Return the total number of frames."""
+        return int(self.offsets[-1])
+
+    def __enter__(self):
+        """Enter the runtime context."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the files when exiting the runtime context."""
+        self.close()
+
+    def close(self):
+        """Close all memory-mapped files."""
+        for mrc in self._handles.values():
+            mrc.close()
+        self._handles = OrderedDict()
+
+    def locate(self, indices):
+        """Map global frame indices to files and local frame indices.
+
+        Parameters
+        ----------
+        indices : int or array-like of int
+            Global frame indices. Negative indices count from the end.
+
+        Returns
+        -------
+        file_ids : int or numpy.ndarray of int
+            Index of the file holding each frame, in paths.
+        local_indices : int or numpy.ndarray of int
+            Index of each frame in its file.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if ((indices < 0) | (indices >= len(self))).any():
+            raise IndexError("Frame index out of range.")
+        file_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        return file_ids, indices - self.offsets[file_ids]
+
+    def _data(self, file_id):
+        """Return the memory-mapped data of a file, opening it if needed.
+
+        Files opened by another process, e.g. before a fork, are not reused.
+        """
+        if self._pid != os.getpid():
+            self._handles = OrderedDict()
+            self._pid = os.getpid()
+        record_cache(file_id in self._handles)
+        if file_id in self._handles:
+            self._handles.move_to_end(file_id)
+        else:
+            if len(self._handles) >= self.max_open_files:
+                _, mrc = self._handles.popitem(last=False)
+                mrc.close()
+            self._handles[file_id] = _open_mrc(self.paths[file_id])
+        data = self._handles[file_id].data
+        if data.ndim == 2:
+            data = data[np.newaxis, ...]
+        self._frame_info[file_id] = (data.shape[1:], data.dtype)
+        return data
+
+    def _file_frame_info(self, file_id):
+        """Return the frame shape and dtype of a file, opening it if needed."""
+        if file_id not in self._frame_info:
+            self._data(file_id)
+        return self._frame_info[file_id]
+
+    @instrumented()
+    def __getitem__(self, index):
+        """Return frames of the stack.
+
+        Frames of files with different dtypes are promoted to a common
+        dtype, with numpy.result_type.
+
+        Parameters
+        ----------
+        index : int, slice or array-like of int or bool
+            Global frame index or indices.
+
+        Returns
+        -------
+        frames : numpy.ndarray
+            Frame of shape (ny, nx) for an integer index,
+            frames of shape (n_index, ny, nx) otherwise.
+        """
+        if np.isscalar(index):
+            file_id, local_index = self.locate(index)
+            return np.array(self._data(int(file_id))[local_index])
+
+        if isinstance(index, slice):
+            indices = np.arange(*index.indices(len(self)))
+        else:
+            indices = np.asarray(index)
+            if indices.dtype == bool:
+                if len(indices) != len(self):
+                    raise IndexError("Boolean index does not match the stack length.")
+                indices = np.flatnonzero(indices)
+        file_ids, local_indices = self.locate(indices.reshape(-1))
+        if len(file_ids) == 0:
+            if len(self.paths) == 0:
+                return np.empty((0, 0, 0), dtype=np.float32)
+            frame_shape, dtype = self._file_frame_info(0)
+            return np.empty((0,) + frame_shape, dtype=dtype)
+
+        infos = [self._file_frame_info(int(i)) for i in np.unique(file_ids)]
+        if len({frame_shape for frame_shape, _ in infos}) != 1:
+            raise ValueError("Selected frames have different shapes.")
+        frames = np.empty(
+            (len(file_ids),) + infos[0][0],
+            dtype=np.result_type(*(dtype for _, dtype in infos)),
+        )
+
+        order = np.lexsort((local_indices, file_ids))
+        boundaries = np.flatnonzero(np.diff(file_ids[order])) + 1
+        for group in np.split(order, boundaries):
+            data = self._data(int(file_ids[group[0]]))
+            frames[group] = data[local_indices[group]]
+        return frames
+
+
+class MicrographDataset:
+    """Map-style dataset of frames, usable with torch.utils.data.DataLoader.
+
+    Frames are read through a VirtualMrcStack, whose file handles are opened
+    lazily in each DataLoader worker rather than shared across processes.
+
+    Parameters
+    ----------
+    paths : str or list of str
+        File names of the .mrc(s) files, or a glob pattern matching them.
+    transform : callable, default = None
+        Function applied to each frame tensor.
+    **kwargs
+        Arguments of VirtualMrcStack.
+    """
+
+    def __init__(self, paths, transform=None, **kwargs):
+        self.stack = VirtualMrcStack(paths, **kwargs)
+        self.transform = transform
+
+    def __len__(self):
+        """Return the number of frames."""
+        return len(self.stack)
+
+    def __getitem__(self, index):
+        """Return a frame as a tensor of shape (ny, nx)."""
+        import torch
+
+        frame = torch.from_numpy(self.stack[index])
+        if self.transform is not None:
+            frame = self.transform(frame)
+        return frame
+
+
+def _read_mrc_frames(path):
+    """Return all frames of an .mrc file as an in-memory 3D array."""
+    with _open_mrc(path) as mrc:
+        data = np.array(mrc.data)
+    if data.ndim == 2:
+        data = data[np.newaxis, ...]
+    return data
+
+
+def _require_dataset(store, name, shape, dtype, chunks=None, compression=None):
+    """Return a dataset of an HDF5 file or Zarr group, creating it if needed."""
+    if name in store and store[name].shape != shape:
+        raise ValueError(f"Existing dataset {name} has a different shape.")
+    if isinstance(store, h5py.File):
+        return store.require_dataset(
+            name, shape=shape, dtype=dtype, chunks=chunks, compression=compression
+        )
+    return store.require_dataset(name, shape=shape, dtype=dtype, chunks=chunks)
+
+
+@instrumented(writes="out_path")
+def convert_mrc_to_hdf5(
+    paths,
+    out_path,
+    dataset_name="micrographs",
+    n_jobs=None,
+    chunk_frames=1,
+    compression="gzip",
+    max_in_flight=None,
+    resume=True,
+    callback=None,
+):
+    """Stream frames of many .mrc files into a single chunked dataset.
+
+    Files are read by a pool of threads and written as they complete,
+    with at most max_in_flight files held in memory at once. The offsets
+    of each file in the dataset and the list of converted files are stored
+    alongside it, so that an interrupted conversion can be resumed.
+
+    Parameters
+    ----------
+    paths : str or list of str
+        File names of the .mrc files, or a glob pattern matching them.
+    out_path : str
+        Path to the output .hdf5 file, or to a Zarr directory store
+        if it ends with ".zarr" (requires the zarr package).
+    dataset_name : str, default = "micrographs"
+        Name of the dataset holding the frames,
+        of shape (n_frames, ny, nx).
+    n_jobs : int, default = None
+        Number of reading threads. If None, use the ThreadPoolExecutor default.
+    chunk_frames : int, default = 1
+        Number of frames per chunk of the dataset.
+    compression : str, default = "gzip"
+        HDF5 compression filter. Ignored for Zarr stores,
+        which use their default compressor.
+    max_in_flight : int, default = None
+        Maximum number of files read but not yet written.
+        If None, twice the number of threads.
+    resume : bool, default = True
+        If True and out_path exists, skip the files already converted.
+        Otherwise, out_path is overwritten.
+    callback : callable, default = None
+        Function called with the path of each file once it is written,
+        e.g. to report progress.
+
+    Returns
+    -------
+    offsets : numpy.ndarray of int
+        Index of the first frame of each file in the dataset,
+        followed by the total number of frames.
+    """
+    headers = _check_headers(scan_mrc_headers(paths, n_jobs=n_jobs))
+    if len(headers) == 0:
+        raise FileNotFoundError("No mrc file to convert!")
+    frame_shapes = set(zip(headers["ny"], headers["nx"]))
+    if len(frame_shapes) != 1:
+        raise ValueError("All mrc files must have the same frame shape.")
+    paths = list(headers["path"])
+    offsets = np.concatenate([[0], np.cumsum(headers["n_frames"])])
+    frame_shape = frame_shapes.pop()
+    shape = (int(offsets[-1]),) + frame_shape
+    dtype = np.result_type(*headers["dtype"])
+
+    if out_path.endswith(".zarr"):
+        import zarr
+
+        store = zarr.open_group(out_path, mode="a" if resume else "w")
+    else:
+        store = h5py.File(out_path, "a" if resume else "w")
+
+    try:
+        encoded_paths = np.array([os.fsencode(path) for path in paths])
+        recorded_paths = _require_dataset(
+            store, dataset_name + "_paths", encoded_paths.shape, encoded_paths.dtype
+        )
+        recorded = recorded_paths[:]
+        # Reductions such as any() are not defined on bytes arrays in NumPy 1.x.
+        if (recorded != b"").any() and (recorded != encoded_paths).any():
+            raise ValueError(f"{out_path} was converted from different files.")
+        recorded_paths[:] = encoded_paths
+        _require_dataset(store, dataset_name + "_offsets", offsets.shape, np.int64)[
+            :
+        ] = offsets
+        done = _require_dataset(store, dataset_name + "_done", (len(paths),), bool)
+        data = _require_dataset(
+            store,
+            dataset_name,
+            shape,
+            dtype,
+            chunks=(max(1, min(chunk_frames, shape[0])),) + frame_shape,
+            compression=compression,
+        )
+
+        def _write(futures):
+            for future in futures:
+                i_file = pending.pop(future)
+                data[offsets[i_file] : offsets[i_file + 1]] = future.result()
+                done[i_file] = True
+                if callback is not None:
+                    callback(paths[i_file])
+
+        n_jobs = n_jobs or min(32, (os.cpu_count() or 1) + 4)
+        max_in_flight = max_in_flight or 2 * n_jobs
+        pending = {}
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for i_file in np.flatnonzero(~done[:]):
+                future = executor.submit(_read_mrc_frames, paths[i_file])
+                pending[future] = i_file
+                if len(pending) >= max_in_flight:
+                    _write(wait(pending, return_when=FIRST_COMPLETED).done)
+            _write(list(pending))
+    finally:
+        if isinstance(store, h5py.File):
+            store.close()
+
+    return offsets
+
+
+class MrcsWriter:
+    """Write a stack of images to an .mrcs file in successive batches.
+
+    The first batch creates the file with mrcfile. Later batches are
+    appended to the end of the file, and the header is updated in place
+    with the new number of images and data statistics.
+
+    Parameters
+    ----------
+    path : str
+        File name of the .mrcs file.
+    dtype : str or numpy.dtype, default = "float32"
+        Data type of the stored images.
+    overwrite : bool, default = True
+        If True, overwrite an existing file.
+    """
+
+    def __init__(self, path, dtype="float32", overwrite=True):
+        if os.path.exists(path) and not overwrite:
+            raise FileExistsError(f"{path} already exists!")
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.n_images = 0
+        self.image_shape = None
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._min = np.inf
+        self._max = -np.inf
+
+    @instrumented()
+    def append(self, images):
+        """Append a batch of images to the stack.
+
+        Parameters
+        ----------
+        images : numpy.ndarray
+            Images of shape (n_images, ny, nx).
+        """
+        images = np.ascontiguousarray(images, dtype=self.dtype)
+        if images.ndim != 3:
+            raise ValueError("Images should be of shape (n_images, ny, nx).")
+        if len(images) == 0:
+            return
+
+        if self.image_shape is None:
+            with mrcfile.new(self.path, overwrite=True) as mrc:
+                mrc.set_data(images)
+                mrc.set_image_stack()
+            self.image_shape = images.shape[1:]
+        else:
+            if images.shape[1:] != self.image_shape:
+                raise ValueError("All images must have the same shape.")
+            with open(self.path, "ab") as file:
+                file.write(images.tobytes())
+        record_io(bytes_written=images.nbytes)
+
+        values = images.astype(np.float64)
+        self.n_images += len(images)
+        self._sum += values.sum()
+        self._sum_squares += (values**2).sum()
+        self._min = min(self._min, values.min())
+        self._max = max(self._max, values.max())
+        self._update_header()
+
+    def _update_header(self):
+        """Write the number of images and data statistics in the header."""
+        header_dtype = mrcfile.dtypes.HEADER_DTYPE.newbyteorder("=")
+        header = np.memmap(self.path, dtype=header_dtype, mode="r+", shape=(1,))
+        n_values = self.n_images * self.image_shape[0] * self.image_shape[1]
+        mean = self._sum / n_values
+        # Image stacks keep mz = 1, as written by mrcfile for the first batch.
+        header["nz"] = self.n_images
+        header["dmin"] = self._min
+        header["dmax"] = self._max
+        header["dmean"] = mean
+        header["rms"] = np.sqrt(max(self._sum_squares / n_values - mean**2, 0.0))
+        header.flush()
+        del header
+
+
+def extract_particles(micrograph, coordinates, box_size, normalize=False):
+    """Cut square boxes centered on particle coordinates out of a micrograph.
+
+    Boxes are gathered with a single fancy-indexing operation on a strided
+    view of the micrograph, so that memory-mapped micrographs are only read
+    where boxes lie. Boxes crossing the edges are padded with the mean
+    of the micrograph.
+
+    Parameters
+    ----------
+    micrograph : numpy.ndarray
+        Micrograph of shape (ny, nx).
+    coordinates : numpy.ndarray
+        Coordinates (x, y) of the box centers in pixels, of shape (n, 2),
+        following the relion rlnCoordinateX/Y convention.
+    box_size : int
+        Side of the boxes in pixels.
+    normalize : bool, default = False
+        If True, set each box to zero mean and unit standard deviation.
+
+    Returns
+    -------
+    boxes : numpy.ndarray
+        Boxes of shape (n, box_size, box_size), as float32.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    ny, nx = micrograph.shape
+    x_starts = np.round(coordinates[:, 0]).astype(np.int64) - box_size // 2
+    y_starts = np.round(coordinates[:, 1]).astype(np.int64) - box_size // 2
+    if (
+        (x_starts < -box_size).any()
+        or (y_starts < -box_size).any()
+        or (x_starts > nx).any()
+        or (y_starts > ny).any()
+    ):
+        raise ValueError("Particle coordinates lie outside the micrograph.")
+
+    inside = (
+        (x_starts >= 0)
+        & (y_starts >= 0)
+        & (x_starts + box_size <= nx)
+        & (y_starts + box_size <= ny)
+    )
+    boxes = np.empty((len(coordinates), box_size, box_size), dtype=np.float32)
+    if box_size <= min(ny, nx):
+        windows = np.lib.stride_tricks.sliding_window_view(
+            micrograph, (box_size, box_size)
+        )
+        boxes[inside] = windows[y_starts[inside], x_starts[inside]]
+    if not inside.all():
+        # Pad each box crossing the edges, rather than the whole micrograph.
+        fill_value = micrograph.mean()
+        for i_box in np.flatnonzero(~inside):
+            x_start, y_start = x_starts[i_box], y_starts[i_box]
+            x_low, y_low = max(x_start, 0), max(y_start, 0)
+            x_high = min(x_start + box_size, nx)
+            y_high = min(y_start + box_size, ny)
+            boxes[i_box] = fill_value
+            boxes[
+                i_box,
+                y_low - y_start : y_high - y_start,
+                x_low - x_start : x_high - x_start,
+            ] = micrograph[y_low:y_high, x_low:x_high]
+
+    if normalize:
+        mean = boxes.mean(axis=(1, 2), keepdims=True)
+        std = boxes.std(axis=(1, 2), keepdims=True)
+        boxes = (boxes - mean) / np.where(std > 0, std, 1)
+    return boxes
+
+
+@instrumented()
+def extract_particles_to_mrcs(
+    coordinates,
+    box_size,
+    path,
+    stack_filename="particles.mrcs",
+    star_filename="particles.star",
+    root="",
+    normalize=False,
+):
+    """Extract particles from micrographs to an .mrcs stack and a starfile.
+
+    Micrographs are memory-mapped one at a time, and their particles are
+    extracted with extract_particles and appended to the stack.
+
+    Parameters
+    ----------
+    coordinates : pandas.DataFrame
+        Particle coordinates, with relion columns rlnMicrographName,
+        rlnCoordinateX and rlnCoordinateY, optionally prefixed with
+        underscores.
+    box_size : int
+        Side of the boxes in pixels.
+    path : str
+        Output directory.
+    stack_filename : str, default = "particles.mrcs"
+        File name of the output stack.
+    star_filename : str, default = "particles.star"
+        File name of the output starfile.
+    root : str, default = ""
+        Directory against which micrograph names are resolved.
+    normalize : bool, default = False
+        If True, set each box to zero mean and unit standard deviation.
+
+    Returns
+    -------
+    metadata : pandas.DataFrame
+        Metadata written to the starfile, with one row per particle.
+    """
+    columns = [
+        particle_metadata.find_metadata_column(coordinates, name)
+        for name in ["rlnMicrographName", "rlnCoordinateX", "rlnCoordinateY"]
+    ]
+    names, xs, ys = (coordinates[column].to_numpy() for column in columns)
+    accumulator = particle_metadata.MetadataAccumulator(
+        [
+            "__rlnImageName",
+            "__rlnMicrographName",
+            "__rlnCoordinateX",
+            "__rlnCoordinateY",
+        ],
+        capacity=len(coordinates),
+    )
+
+    writer = MrcsWriter(os.path.join(path, stack_filename))
+    for name, rows in pd.Series(names).groupby(names, sort=False).indices.items():
+        with _open_mrc(os.path.join(root, name)) as mrc:
+            micrograph = mrc.data if mrc.data.ndim == 2 else mrc.data[0]
+            boxes = extract_particles(
+                micrograph,
+                np.stack([xs[rows], ys[rows]], axis=1),
+                box_size,
+                normalize=normalize,
+            )
+        image_indices = np.arange(writer.n_images, writer.n_images + len(rows)) + 1
+        writer.append(boxes)
+        accumulator.add_batch(
+            {
+                "__rlnImageName": np.char.add(
+                    np.char.zfill(image_indices.astype(str), 6), "@" + stack_filename
+                ),
+                "__rlnMicrographName": names[rows],
+                "__rlnCoordinateX": xs[rows],
+                "__rlnCoordinateY": ys[rows],
+            }
+        )
+
+    metadata = accumulator.to_dataframe()
+    particle_metadata.write_metadata_to_starfile(path, metadata, star_filename)
+    return metadata
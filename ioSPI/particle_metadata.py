@@ -1,8 +1,38 @@
 """Format and write particle metadata."""
+import glob
+import hashlib
+import io
+import json
 import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
-import starfile
+import numpy as np
+
+from ioSPI._lazy import lazy_import
+from ioSPI.instrumentation import instrumented, record_cache, record_io
+
+mrcfile = lazy_import("mrcfile")
+pd = lazy_import("pandas")
+starfile = lazy_import("starfile")
+
+SIDECAR_EXTENSION = ".npz"
+
+METADATA_RANGES = {
+    "rlnAngleRot": (-360.0, 360.0),
+    "rlnAngleTilt": (-360.0, 360.0),
+    "rlnAnglePsi": (-360.0, 360.0),
+    "rlnOriginX": (-np.inf, np.inf),
+    "rlnOriginY": (-np.inf, np.inf),
+    "rlnDefocusU": (0.0, np.inf),
+    "rlnDefocusV": (0.0, np.inf),
+    "rlnDefocusAngle": (-360.0, 360.0),
+    "rlnVoltage": (0.0, np.inf),
+    "rlnImagePixelSize": (0.0, np.inf),
+    "rlnSphericalAberration": (0.0, np.inf),
+    "rlnAmplitudeContrast": (0.0, 1.0),
+    "rlnCtfBfactor": (-np.inf, np.inf),
+}
 
 
 def check_star_file(path):
@@ -28,12 +58,7 @@ def format_metadata_for_writing(data_list, variable_names):
     metadata : pandas.DataFrame
         Metadata ready to be outputted in a starfile.
     """
-    indices = list(range(len(data_list)))
-    return pd.DataFrame(
-        data=data_list,
-        index=indices,
-        columns=(variable_names),
-    )
+    return pd.DataFrame(data=data_list, columns=(variable_names))
 
 
 def format_metadata_for_writing_cryoem_convention(data_list, config):
@@ -58,6 +83,162 @@ def format_metadata_for_writing_cryoem_convention(data_list, config):
     return format_metadata_for_writing(data_list, get_starfile_metadata_names(config))
 
 
+class MetadataAccumulator:
+    """Accumulate particle metadata column by column.
+
+    Each column is stored in a preallocated NumPy array whose capacity grows
+    geometrically, so that batches of particles can be appended without
+    building per-particle Python rows.
+
+    Parameters
+    ----------
+    variable_names : list of str
+        Names of the metadata columns, e.g. from get_starfile_metadata_names.
+    capacity : int, default = 1024
+        Initial number of rows allocated for each column.
+    growth_factor : float, default = 2.0
+        Factor by which the capacity is multiplied when it is exceeded.
+    """
+
+    def __init__(self, variable_names, capacity=1024, growth_factor=2.0):
+        if len(set(variable_names)) != len(variable_names):
+            raise ValueError("Metadata variable names must be unique.")
+        if growth_factor <= 1:
+            raise ValueError("growth_factor must be greater than 1.")
+        self.variable_names = list(variable_names)
+        self.capacity = max(int(capacity), 1)
+        self.growth_factor = growth_factor
+        self.n_rows = 0
+        self._columns = {}
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """Create an accumulator with relion-convention column names.
+
+        Parameters
+        ----------
+        config: class
+            class containing bool values ctf and shift,
+            see get_starfile_metadata_names.
+
+        Returns
+        -------
+        accumulator : MetadataAccumulator
+        """
+        return cls(get_starfile_metadata_names(config), **kwargs)
+
+    def __len__(self):
+        """Return the number of accumulated rows."""
+        return self.n_rows
+
+    def _reserve(self, n_rows):
+        """Grow the column arrays so that they can hold n_rows rows."""
+        if n_rows <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < n_rows:
+            capacity = int(np.ceil(capacity * self.growth_factor))
+        for name, column in self._columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[: self.n_rows] = column[: self.n_rows]
+            self._columns[name] = grown
+        self.capacity = capacity
+
+    def add_batch(self, batch):
+        """Append a batch of rows.
+
+        Parameters
+        ----------
+        batch : dict of array-like, pandas.DataFrame or 2D array-like
+            Either a mapping from every variable name to a 1D array of
+            length n_rows, or an array of shape (n_rows, n_variables)
+            with columns ordered as variable_names. The type of a column
+            is promoted when a batch does not fit in it, e.g. from int to
+            float, or to object for strings.
+        """
+        if isinstance(batch, (dict, pd.DataFrame)):
+            missing = set(self.variable_names) - set(batch.keys())
+            if missing:
+                raise ValueError("Missing metadata variables: %s" % sorted(missing))
+            columns = [np.asarray(batch[name]) for name in self.variable_names]
+        else:
+            if not isinstance(batch, np.ndarray):
+                # keep the type of each value, e.g. image names next to angles
+                batch = np.asarray(batch, dtype=object)
+            if batch.ndim != 2 or batch.shape[1] != len(self.variable_names):
+                raise ValueError(
+                    "Batch should be of shape (n_rows, %d)." % len(self.variable_names)
+                )
+            if batch.dtype == object:
+                columns = [np.asarray(column.tolist()) for column in batch.T]
+            else:
+                columns = list(batch.T)
+
+        n_rows = len(columns[0])
+        if any(column.shape != (n_rows,) for column in columns):
+            raise ValueError("All metadata columns must be 1D and of equal length.")
+
+        self._reserve(self.n_rows + n_rows)
+        for name, column in zip(self.variable_names, columns):
+            dtype = object if column.dtype.kind in "OSU" else column.dtype
+            if name not in self._columns:
+                self._columns[name] = np.empty(self.capacity, dtype=dtype)
+            stored = self._columns[name]
+            if stored.dtype != object and (
+                dtype == object or not np.can_cast(dtype, stored.dtype)
+            ):
+                promoted = (
+                    object if dtype == object else np.result_type(stored.dtype, dtype)
+                )
+                self._columns[name] = stored.astype(promoted)
+            self._columns[name][self.n_rows : self.n_rows + n_rows] = column
+        self.n_rows += n_rows
+
+    def to_dict(self):
+        """Return the accumulated columns.
+
+        Returns
+        -------
+        columns : dict of numpy.ndarray
+            Views on the accumulated data, of length n_rows.
+        """
+        return {
+            name: (
+                self._columns[name][: self.n_rows]
+                if name in self._columns
+                else np.empty(0)
+            )
+            for name in self.variable_names
+        }
+
+    def to_dataframe(self):
+        """Return the accumulated metadata as a DataFrame.
+
+        Returns
+        -------
+        metadata : pandas.DataFrame
+            Metadata ready to be outputted in a starfile.
+        """
+        return pd.DataFrame(self.to_dict(), columns=self.variable_names)
+
+    def write(self, path, filename="metadata.star", write_sidecar=False):
+        """Save the accumulated metadata in a starfile.
+
+        Parameters
+        ----------
+        path: str
+            path to save starfile.
+        filename: str
+            name of the output file.
+        write_sidecar: bool
+            Optional, default: False
+            If True, also write the binary sidecar of the starfile.
+        """
+        write_metadata_to_starfile(
+            path, self.to_dataframe(), filename=filename, write_sidecar=write_sidecar
+        )
+
+
 def get_starfile_metadata_names(config):
     """Return relion-convention names of metadata for starfile.
 
@@ -103,8 +284,7 @@ def update_optics_config_from_starfile(config):
     -------
     config: class
     """
-    check_star_file(config.input_starfile_path)
-    df = starfile.read(config.input_starfile_path)
+    df = read_starfile(config.input_starfile_path)
     config.side_len = df["optics"]["rlnImageSize"][0]
     config.kv = df["optics"]["rlnVoltage"][0]
     config.pixel_size = df["optics"]["rlnImagePixelSize"][0]
@@ -116,7 +296,10 @@ def update_optics_config_from_starfile(config):
     return config
 
 
-def write_metadata_to_starfile(path, metadata, filename="metadata.star"):
+@instrumented()
+def write_metadata_to_starfile(
+    path, metadata, filename="metadata.star", write_sidecar=False, validate=False
+):
     """Save the metadata in a starfile in the output directory.
 
     Parameters
@@ -127,8 +310,701 @@ def write_metadata_to_starfile(path, metadata, filename="metadata.star"):
         metadata to be outputted.
     filename: str
         name of the output file.
+    write_sidecar: bool
+        Optional, default: False
+        If True, also write the binary sidecar of the starfile,
+        see write_starfile_sidecar.
+    validate: bool
+        Optional, default: False
+        If True, raise a ValueError if validate_metadata reports invalid rows.
+    """
+    if validate:
+        invalid_rows = validate_metadata(metadata)
+        if invalid_rows:
+            raise ValueError(
+                "Invalid metadata: "
+                + ", ".join(
+                    f"{check} ({len(rows)} rows)"
+                    for check, rows in invalid_rows.items()
+                )
+            )
+    if not filename.endswith(".star"):
+        filename = filename + ".star"
+    star_path = os.path.join(path, filename)
+    starfile.write(metadata, star_path, overwrite=True)
+    record_io(bytes_written=os.path.getsize(star_path), files=1)
+    if write_sidecar:
+        write_starfile_sidecar(star_path)
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """Return the sha256 hex digest of a file, read in chunks.
+
+    Parameters
+    ----------
+    path: str
+        path to the file.
+    chunk_size: int
+        number of bytes read at once.
+
+    Returns
+    -------
+    checksum: str
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_sidecar_path(path):
+    """Return the path of the binary sidecar associated with a starfile.
+
+    Parameters
+    ----------
+    path: str
+        path to the starfile.
+
+    Returns
+    -------
+    sidecar_path: str
+    """
+    return path + SIDECAR_EXTENSION
+
+
+@instrumented()
+def write_starfile_sidecar(path, data=None, checksum=None):
+    """Write a binary columnar companion of a starfile.
+
+    The sidecar is an uncompressed .npz archive holding one array per column
+    of each data block, together with the checksum of the starfile it was
+    built from, so that stale sidecars can be detected by read_starfile.
+
+    Parameters
+    ----------
+    path: str
+        path to the starfile.
+    data: pandas.DataFrame or dict of pandas.DataFrame
+        Optional, default: None
+        Content of the starfile, as returned by starfile.read.
+        If None, the starfile is parsed.
+    checksum: str
+        Optional, default: None
+        Checksum of the starfile. If None, it is computed.
+
+    Returns
+    -------
+    sidecar_path: str
+        path to the written sidecar.
+    """
+    check_star_file(path)
+    if data is None:
+        data = starfile.read(path)
+    single_block = isinstance(data, pd.DataFrame)
+    blocks = {"": data} if single_block else data
+
+    arrays = {}
+    layout = []
+    for i_block, (block_name, block) in enumerate(blocks.items()):
+        layout.append([block_name, [str(column) for column in block.columns]])
+        for i_column, column in enumerate(block.columns):
+            values = block[column].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            arrays[f"{i_block}/{i_column}"] = values
+
+    if checksum is None:
+        checksum = file_checksum(path)
+    header = {
+        "checksum": checksum,
+        "single_block": single_block,
+        "layout": layout,
+    }
+    sidecar_path = get_sidecar_path(path)
+    # write next to the sidecar, then rename, so that readers never see
+    # a partially written sidecar
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            np.savez(file, __header__=np.array(json.dumps(header)), **arrays)
+        os.replace(tmp_path, sidecar_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    record_io(bytes_written=os.path.getsize(sidecar_path), files=1)
+    return sidecar_path
+
+
+@instrumented()
+def read_starfile_sidecar(path, checksum=None):
+    """Read the binary sidecar of a starfile.
+
+    Parameters
+    ----------
+    path: str
+        path to the starfile (not to the sidecar).
+    checksum: str
+        Optional, default: None
+        Expected checksum of the starfile. If None, it is computed.
+
+    Returns
+    -------
+    data: pandas.DataFrame or dict of pandas.DataFrame
+        Same structure as returned by starfile.read, or None if the
+        sidecar does not exist, is stale or cannot be read.
+    """
+    sidecar_path = get_sidecar_path(path)
+    if not os.path.isfile(sidecar_path):
+        return None
+    if checksum is None:
+        checksum = file_checksum(path)
+
+    try:
+        return _load_sidecar(sidecar_path, checksum)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        return None
+
+
+def _load_sidecar(sidecar_path, checksum):
+    """Load a sidecar, or return None if it does not match the checksum."""
+    with np.load(sidecar_path, allow_pickle=False) as archive:
+        header = json.loads(str(archive["__header__"]))
+        if header["checksum"] != checksum:
+            return None
+        record_io(bytes_read=os.path.getsize(sidecar_path), files=1)
+        blocks = {}
+        for i_block, (block_name, columns) in enumerate(header["layout"]):
+            block = {}
+            for i_column, column in enumerate(columns):
+                values = archive[f"{i_block}/{i_column}"]
+                if values.dtype.kind == "U":
+                    values = values.astype(object)
+                block[column] = values
+            blocks[block_name] = pd.DataFrame(block, columns=columns)
+
+    if header["single_block"]:
+        return blocks[""]
+    return blocks
+
+
+@instrumented(reads="path")
+def read_starfile(path, use_sidecar=True, write_sidecar=False):
+    """Read a starfile, using its binary sidecar when it is fresh.
+
+    Parameters
+    ----------
+    path: str
+        path to the starfile.
+    use_sidecar: bool
+        Optional, default: True
+        If True, read the binary sidecar when its checksum matches the
+        starfile, and parse the starfile otherwise.
+    write_sidecar: bool
+        Optional, default: False
+        If True, (re)write the sidecar after parsing the starfile,
+        so that later reads are fast.
+
+    Returns
+    -------
+    data: pandas.DataFrame or dict of pandas.DataFrame
+        Content of the starfile, as returned by starfile.read.
+    """
+    check_star_file(path)
+    if not use_sidecar:
+        data = starfile.read(path)
+        if write_sidecar:
+            write_starfile_sidecar(path, data=data)
+        return data
+
+    # Only hash the starfile when its checksum is needed.
+    checksum = None
+    data = None
+    if os.path.isfile(get_sidecar_path(path)):
+        checksum = file_checksum(path)
+        data = read_starfile_sidecar(path, checksum=checksum)
+    record_cache(data is not None)
+    if data is None:
+        data = starfile.read(path)
+        if write_sidecar:
+            try:
+                write_starfile_sidecar(path, data=data, checksum=checksum)
+            except OSError:
+                pass
+    return data
+
+
+@instrumented()
+def read_starfiles(paths, n_jobs=None, block="particles", source_column="source_file"):
+    """Read many starfiles in parallel and concatenate them.
+
+    Parameters
+    ----------
+    paths: str or list of str
+        paths to the starfiles, or a glob pattern matching them.
+    n_jobs: int
+        Optional, default: None
+        Number of worker processes. If None, use the number of CPUs.
+        If 1, read the starfiles serially.
+    block: str
+        Optional, default: "particles"
+        Name of the data block to concatenate, for multi-block starfiles.
+    source_column: str
+        Optional, default: "source_file"
+        Name of the column recording the starfile each row comes from.
+
+    Returns
+    -------
+    data: pandas.DataFrame or dict of pandas.DataFrame
+        Concatenated table. For multi-block starfiles, a dict holding the
+        shared "optics" block and the concatenated block.
     """
-    if filename.endswith(".star"):
-        starfile.write(metadata, os.path.join(path, filename), overwrite=True)
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+    if len(paths) == 0:
+        raise FileNotFoundError("No star file to read!")
+
+    if n_jobs == 1:
+        contents = [read_starfile(path) for path in paths]
     else:
-        starfile.write(metadata, os.path.join(path, filename + ".star"), overwrite=True)
+        n_jobs = n_jobs or os.cpu_count() or 1
+        chunksize = max(1, len(paths) // (4 * n_jobs))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            contents = list(executor.map(read_starfile, paths, chunksize=chunksize))
+
+    optics = None
+    tables = []
+    for path, content in zip(paths, contents):
+        if isinstance(content, dict):
+            if "optics" in content:
+                if optics is None:
+                    optics = content["optics"]
+                elif not optics.equals(content["optics"]):
+                    raise ValueError(f"Optics groups of {path} do not agree.")
+            content = content[block]
+        tables.append(content.assign(**{source_column: path}))
+
+    table = pd.concat(tables, ignore_index=True)
+    if optics is None:
+        return table
+    return {"optics": optics, block: table}
+
+
+def find_metadata_column(metadata, name):
+    """Return the column of metadata matching a relion name, with any prefix.
+
+    Parameters
+    ----------
+    metadata: pandas.DataFrame
+        particle metadata.
+    name: str
+        relion name of the column, without leading underscores.
+        E.g. rlnImageName
+
+    Returns
+    -------
+    column: str
+        Name of the column in metadata, e.g. __rlnImageName.
+    """
+    for column in metadata.columns:
+        if str(column).lstrip("_") == name:
+            return column
+    raise KeyError(f"Column {name} not found in metadata.")
+
+
+def parse_image_names(image_names):
+    """Parse relion image names into file ids and frame indices.
+
+    Parameters
+    ----------
+    image_names: array-like of str
+        relion image names, of the form "index@file.mrcs",
+        where index starts at 1.
+
+    Returns
+    -------
+    file_ids: numpy.ndarray of int64
+        index of the file of each image in file_names.
+    frame_indices: numpy.ndarray of int64
+        0-based index of each image in its file.
+    file_names: list of str
+        unique file names, in order of first appearance.
+    """
+    parts = pd.Series(np.asarray(image_names, dtype=object)).str.partition("@")
+    if (parts[1] != "@").any():
+        raise ValueError("Image names should be of the form index@file.mrcs.")
+    frame_indices = pd.to_numeric(parts[0], errors="raise").to_numpy(np.int64) - 1
+    if (frame_indices < 0).any():
+        raise ValueError("Image indices in image names start at 1.")
+    file_ids, file_names = pd.factorize(parts[2])
+    return file_ids.astype(np.int64), frame_indices, list(file_names)
+
+
+class ParticleDataset:
+    """Random access to particle images referenced by a starfile.
+
+    Image names are parsed once into integer arrays, and images are read
+    through a micrographs.VirtualMrcStack over the .mrcs stacks, which
+    groups batched lookups by file and keeps at most max_open_files
+    memory-mapped stacks open, reopening them after a fork.
+
+    Parameters
+    ----------
+    metadata : str, pandas.DataFrame or dict of pandas.DataFrame
+        Path to a starfile, or its content as returned by read_starfile.
+    root : str, default = None
+        Directory against which relative file names are resolved.
+        Defaults to the directory of the starfile, or the current directory.
+    block : str, default = "particles"
+        Name of the data block holding the particles,
+        when metadata has several blocks.
+    max_open_files : int, default = 128
+        Maximum number of memory-mapped stacks kept open.
+    """
+
+    def __init__(self, metadata, root=None, block="particles", max_open_files=128):
+        from ioSPI.micrographs import VirtualMrcStack
+
+        if isinstance(metadata, str):
+            if root is None:
+                root = os.path.dirname(metadata)
+            metadata = read_starfile(metadata)
+        if isinstance(metadata, dict):
+            metadata = metadata[block]
+        self.metadata = metadata
+        self.root = "" if root is None else root
+
+        image_names = metadata[find_metadata_column(metadata, "rlnImageName")]
+        self.file_ids, self.frame_indices, self.file_names = parse_image_names(
+            image_names
+        )
+        # Stacks are indexed up to the last frame referenced in each file,
+        # so that their headers do not need to be scanned.
+        n_frames = np.zeros(len(self.file_names), dtype=np.int64)
+        np.maximum.at(n_frames, self.file_ids, self.frame_indices + 1)
+        self.stack = VirtualMrcStack(
+            [os.path.join(self.root, name) for name in self.file_names],
+            n_frames=n_frames,
+            max_open_files=max_open_files,
+        )
+
+    def __len__(self):
+        """Return the number of particles."""
+        return len(self.file_ids)
+
+    def __enter__(self):
+        """Enter the runtime context."""
+        return self
+
+    def __exit__(self, *args):
+        """Close the stacks when exiting the runtime context."""
+        self.close()
+
+    def close(self):
+        """Close all memory-mapped stacks."""
+        self.stack.close()
+
+    @instrumented()
+    def __getitem__(self, index):
+        """Return particle images.
+
+        Parameters
+        ----------
+        index : int, slice or array-like of int
+            Particle index or indices.
+
+        Returns
+        -------
+        images : numpy.ndarray
+            Image of shape (ny, nx) for an integer index,
+            images of shape (n_index, ny, nx) otherwise.
+        """
+        if np.isscalar(index):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("Particle index out of range.")
+            offset = self.stack.offsets[self.file_ids[index]]
+            return self.stack[int(offset + self.frame_indices[index])]
+
+        # Slices of the per-particle arrays are views: only the selection is read.
+        file_ids = self.file_ids[index]
+        return self.stack[self.stack.offsets[file_ids] + self.frame_indices[index]]
+
+
+def validate_metadata(metadata, ranges=None, stack_sizes=None):
+    """Find invalid rows of particle metadata.
+
+    All checks are vectorized over the rows: numeric columns are coerced
+    to float and checked to be finite and within range, and image names
+    are parsed and their indices checked to be within the stacks.
+
+    Parameters
+    ----------
+    metadata: pandas.DataFrame or dict of array-like
+        particle metadata, with relion column names,
+        optionally prefixed with underscores.
+    ranges: dict
+        Optional, default: None
+        Inclusive (min, max) range of each relion column.
+        If None, use METADATA_RANGES.
+    stack_sizes: dict
+        Optional, default: None
+        Number of images in each .mrcs file referenced by image names.
+        If None, only check that image indices are positive.
+
+    Returns
+    -------
+    invalid_rows: dict of numpy.ndarray
+        Positional indices of the offending rows for each failed check,
+        e.g. {"rlnDefocusU": array([3, 17])}. Empty if metadata is valid.
+    """
+    if not isinstance(metadata, pd.DataFrame):
+        metadata = pd.DataFrame(metadata)
+    if ranges is None:
+        ranges = METADATA_RANGES
+
+    invalid_rows = {}
+    for column in metadata.columns:
+        name = str(column).lstrip("_")
+        if name not in ranges:
+            continue
+        values = pd.to_numeric(metadata[column], errors="coerce").to_numpy(float)
+        low, high = ranges[name]
+        with np.errstate(invalid="ignore"):
+            invalid = ~(np.isfinite(values) & (values >= low) & (values <= high))
+        if invalid.any():
+            invalid_rows[name] = np.flatnonzero(invalid)
+
+    try:
+        column = find_metadata_column(metadata, "rlnImageName")
+    except KeyError:
+        return invalid_rows
+
+    parts = metadata[column].astype(str).str.partition("@")
+    indices = pd.to_numeric(parts[0], errors="coerce").to_numpy(float)
+    with np.errstate(invalid="ignore"):
+        invalid = (parts[1] != "@").to_numpy() | ~(indices >= 1)
+        if stack_sizes is not None:
+            sizes = parts[2].map(stack_sizes).to_numpy(float)
+            invalid |= ~(indices <= sizes)
+    if invalid.any():
+        invalid_rows["rlnImageName"] = np.flatnonzero(invalid)
+    return invalid_rows
+
+
+def iter_starfile_chunks(path, block="particles", chunksize=100000):
+    """Iterate over the rows of a starfile loop block in chunks.
+
+    Only chunksize rows are held in memory at once, so arbitrarily large
+    starfiles can be processed with bounded memory.
+
+    Parameters
+    ----------
+    path: str
+        path to the starfile.
+    block: str
+        Optional, default: "particles"
+        Name of the data block to read, without the "data_" prefix,
+        e.g. "" for a block named only "data_". If the starfile has
+        a single block, it is read whatever its name.
+    chunksize: int
+        Optional, default: 100000
+        Maximum number of rows per chunk.
+
+    Yields
+    ------
+    chunk: pandas.DataFrame
+        Consecutive rows of the block, with relion column names.
+    """
+    check_star_file(path)
+
+    def _parse(lines, columns):
+        return pd.read_csv(
+            io.StringIO("".join(lines)), sep=r"\s+", header=None, names=columns
+        )
+
+    with open(path) as file:
+        in_block = False
+        in_rows = False
+        blocks = []
+        columns = []
+        lines = []
+        for line in file:
+            stripped = line.strip()
+            if stripped.startswith("data_"):
+                if in_block:
+                    break
+                blocks.append(stripped[len("data_") :])
+                in_block = blocks[-1] == block
+                continue
+            if not in_block or stripped.startswith("#") or stripped == "loop_":
+                continue
+            if not stripped:
+                if in_rows:
+                    break
+                continue
+            if stripped.startswith("_"):
+                columns.append(stripped.split()[0][1:])
+                continue
+            in_rows = True
+            lines.append(line)
+            if len(lines) == chunksize:
+                yield _parse(lines, columns)
+                lines = []
+
+    if not columns and len(blocks) == 1 and blocks[0] != block:
+        yield from iter_starfile_chunks(path, block=blocks[0], chunksize=chunksize)
+        return
+    if not columns:
+        raise ValueError(f"Block {block} not found in star file!")
+    if lines:
+        yield _parse(lines, columns)
+
+
+class GroupStatistics:
+    """Single-pass group-by statistics over chunks of particle metadata.
+
+    Only per-group sums and bin counts are kept between chunks, so memory
+    does not depend on the number of particles.
+
+    Parameters
+    ----------
+    by : str, default = "rlnOpticsGroup"
+        Column defining the groups, e.g. rlnOpticsGroup or rlnMicrographName.
+    columns : list of str, default = None
+        Columns whose count, mean and standard deviation are computed.
+    histograms : dict, default = None
+        Bin edges of the histogram computed for each column,
+        e.g. {"rlnDefocusU": numpy.linspace(0, 40000, 41)}.
+    orientation_bins : tuple of int, default = None
+        Number of (rot, tilt) bins used to compute the orientation coverage,
+        the fraction of bins holding at least one particle. Tilt bins are
+        uniform in cos(tilt), so that all bins cover the same solid angle.
+    """
+
+    def __init__(
+        self, by="rlnOpticsGroup", columns=None, histograms=None, orientation_bins=None
+    ):
+        self.by = by
+        self.columns = [] if columns is None else list(columns)
+        self.histograms = {} if histograms is None else dict(histograms)
+        self.orientation_bins = orientation_bins
+        self._moments = None
+        self._histogram_counts = {column: None for column in self.histograms}
+        self._orientation_counts = None
+
+    @staticmethod
+    def _add(total, counts):
+        """Add counts to a running total, aligning on the index."""
+        if total is None:
+            return counts
+        return total.add(counts, fill_value=0)
+
+    def update(self, chunk):
+        """Accumulate the statistics of a chunk of metadata.
+
+        Parameters
+        ----------
+        chunk : pandas.DataFrame
+            Rows of particle metadata.
+        """
+        groups = chunk[self.by]
+
+        if self.columns:
+            values = chunk[self.columns].astype(float)
+            moments = pd.concat(
+                {
+                    "count": values.notna().groupby(groups).sum(),
+                    "sum": values.groupby(groups).sum(),
+                    "sum_squares": (values**2).groupby(groups).sum(),
+                },
+                axis=1,
+            )
+            self._moments = self._add(self._moments, moments)
+
+        for column, edges in self.histograms.items():
+            bins = np.digitize(chunk[column].to_numpy(float), edges) - 1
+            inside = (bins >= 0) & (bins < len(edges) - 1)
+            counts = pd.Series(1, index=[groups[inside], bins[inside]])
+            counts = counts.groupby(level=[0, 1]).sum()
+            self._histogram_counts[column] = self._add(
+                self._histogram_counts[column], counts
+            )
+
+        if self.orientation_bins is not None:
+            n_rot, n_tilt = self.orientation_bins
+            rot = np.mod(chunk["rlnAngleRot"].to_numpy(float), 360.0)
+            cos_tilt = np.cos(np.deg2rad(chunk["rlnAngleTilt"].to_numpy(float)))
+            rot_bins = np.minimum((rot / 360.0 * n_rot).astype(int), n_rot - 1)
+            tilt_bins = np.clip(
+                ((1.0 - cos_tilt) / 2.0 * n_tilt).astype(int), 0, n_tilt - 1
+            )
+            counts = pd.Series(1, index=[groups, rot_bins * n_tilt + tilt_bins])
+            counts = counts.groupby(level=[0, 1]).sum()
+            self._orientation_counts = self._add(self._orientation_counts, counts)
+
+    def result(self):
+        """Return the accumulated statistics.
+
+        Returns
+        -------
+        statistics : dict
+            "count", "mean" and "std" DataFrames indexed by group
+            with one column per statistics column,
+            "histograms" dict of DataFrames indexed by group
+            with one column per bin, and
+            "orientation_coverage" Series indexed by group.
+        """
+        statistics = {}
+        if self._moments is not None:
+            count = self._moments["count"]
+            mean = self._moments["sum"] / count
+            variance = self._moments["sum_squares"] / count - mean**2
+            statistics["count"] = count.astype(np.int64)
+            statistics["mean"] = mean
+            statistics["std"] = np.sqrt(variance.clip(lower=0))
+
+        statistics["histograms"] = {}
+        for column, counts in self._histogram_counts.items():
+            n_bins = len(self.histograms[column]) - 1
+            if counts is None:
+                histogram = pd.DataFrame(columns=range(n_bins), dtype=np.int64)
+            else:
+                histogram = counts.unstack(fill_value=0)
+                histogram = histogram.reindex(columns=range(n_bins), fill_value=0)
+            statistics["histograms"][column] = histogram.astype(np.int64)
+
+        if self.orientation_bins is not None and self._orientation_counts is not None:
+            n_bins = self.orientation_bins[0] * self.orientation_bins[1]
+            occupied = self._orientation_counts.groupby(level=0).size()
+            statistics["orientation_coverage"] = occupied / n_bins
+        return statistics
+
+
+@instrumented(reads="path")
+def aggregate_starfile(path, block="particles", chunksize=100000, **kwargs):
+    """Compute group-by statistics of a starfile in a single streaming pass.
+
+    Parameters
+    ----------
+    path: str
+        path to the starfile.
+    block: str
+        Optional, default: "particles"
+        Name of the data block to aggregate, see iter_starfile_chunks.
+    chunksize: int
+        Optional, default: 100000
+        Maximum number of rows held in memory at once.
+    **kwargs
+        Arguments of GroupStatistics.
+
+    Returns
+    -------
+    statistics : dict
+        See GroupStatistics.result.
+    """
+    statistics = GroupStatistics(**kwargs)
+    for chunk in iter_starfile_chunks(path, block=block, chunksize=chunksize):
+        statistics.update(chunk)
+    return statistics.result()
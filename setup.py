@@ -15,6 +15,7 @@ setuptools.setup(
     url="https://github.com/compSPI/ioSPI.git",
     packages=setuptools.find_packages(),
     install_requires=requirements,
+    entry_points={"console_scripts": ["iospi=ioSPI.cli:main"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
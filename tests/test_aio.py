@@ -0,0 +1,228 @@
+"""Unit tests for the asynchronous I/O API."""
+
+import asyncio
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+from ioSPI import aio
+
+
+def test_awaitable_file_io(tmp_path):
+    """Test that file I/O wrappers can be awaited concurrently."""
+    micrographs_ = [np.full((1, 4, 4), i, dtype=np.float32) for i in range(8)]
+
+    async def main():
+        await asyncio.gather(
+            *(
+                aio.write_micrograph_to_mrc(str(tmp_path), micrograph, i)
+                for i, micrograph in enumerate(micrographs_)
+            )
+        )
+        return await asyncio.gather(
+            *(
+                aio.read_micrograph_from_mrc(str(tmp_path / f"{i:04d}.mrcs"))
+                for i in range(8)
+            )
+        )
+
+    aio.set_max_workers(4)
+    try:
+        for i, data in enumerate(asyncio.run(main())):
+            np.testing.assert_array_equal(data, micrographs_[i])
+    finally:
+        aio.set_max_workers(aio.DEFAULT_MAX_WORKERS)
+    assert aio.read_micrograph_from_mrc.__name__ == "read_micrograph_from_mrc"
+
+
+class FakeOSF:
+    """In-memory OSF storage served with the layout of the OSF API."""
+
+    page_size = 2
+
+    def __init__(self):
+        self.nodes = {"root": {"name": "", "kind": "folder", "parent": None}}
+        self.ids = itertools.count()
+        self.active = 0
+        self.max_active = 0
+        self.base_url = None
+
+    def add(self, parent, name, kind, content=b""):
+        """Add a file or folder, and return its id."""
+        node_id = str(next(self.ids))
+        self.nodes[node_id] = {
+            "name": name,
+            "kind": kind,
+            "parent": parent,
+            "content": content,
+        }
+        return node_id
+
+    def entry(self, node_id):
+        """Return the API entry of a file or folder."""
+        node = self.nodes[node_id]
+        return {
+            "attributes": {"name": node["name"], "kind": node["kind"]},
+            "links": {
+                "download": f"{self.base_url}/download/{node_id}",
+                "upload": f"{self.base_url}/upload/{node_id}",
+                "delete": f"{self.base_url}/delete/{node_id}",
+            },
+            "relationships": {
+                "files": {
+                    "links": {"related": {"href": f"{self.base_url}/list/{node_id}"}}
+                }
+            },
+        }
+
+    def application(self):
+        """Return the web application serving the storage."""
+        from aiohttp import web
+
+        async def list_folder(request):
+            node_id = request.match_info.get("id", "root")
+            page = int(request.query.get("page", 0))
+            children = [
+                key for key, node in self.nodes.items() if node["parent"] == node_id
+            ]
+            start = page * self.page_size
+            next_url = None
+            if start + self.page_size < len(children):
+                next_url = f"{request.url.with_query({'page': page + 1})}"
+            return web.json_response(
+                {
+                    "data": [
+                        self.entry(key)
+                        for key in children[start : start + self.page_size]
+                    ],
+                    "links": {"next": next_url},
+                }
+            )
+
+        async def download(request):
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            await asyncio.sleep(0.01)
+            self.active -= 1
+            content = self.nodes[request.match_info["id"]]["content"]
+            if content is None:
+                # interrupt the transfer after a partial response
+                response = web.StreamResponse(headers={"Content-Length": "100"})
+                await response.prepare(request)
+                await response.write(b"partial")
+                request.transport.close()
+                return response
+            return web.Response(body=content)
+
+        async def upload(request):
+            node_id = request.match_info.get("id", "root")
+            content = await request.read()
+            if self.nodes[node_id]["kind"] == "file":
+                self.nodes[node_id]["content"] = content
+            else:
+                self.add(node_id, request.query["name"], request.query["kind"], content)
+            return web.json_response({})
+
+        async def delete(request):
+            del self.nodes[request.match_info["id"]]
+            return web.Response(status=204)
+
+        app = web.Application()
+        app.router.add_get("/api/nodes/abcde/files/osfstorage/", list_folder)
+        app.router.add_get("/list/{id}", list_folder)
+        app.router.add_get("/download/{id}", download)
+        app.router.add_put("/files/resources/abcde/providers/osfstorage/", upload)
+        app.router.add_put("/upload/{id}", upload)
+        app.router.add_delete("/delete/{id}", delete)
+        return app
+
+
+def run_with_osf(fake, scenario):
+    """Run a scenario against a fake OSF server."""
+    test_utils = pytest.importorskip("aiohttp.test_utils")
+    # built outside of the event loop running the scenario
+    project = aio.AsyncOSFProject(token="token", project_id="abcde", max_concurrency=2)
+
+    async def main():
+        async with test_utils.TestServer(fake.application()) as server:
+            fake.base_url = str(server.make_url("")).rstrip("/")
+            project.api_url = fake.base_url + "/api"
+            project.files_url = fake.base_url + "/files"
+            async with project:
+                return await scenario(project)
+
+    return asyncio.run(main())
+
+
+def test_async_osf_project_ls_and_download(tmp_path):
+    """Test listing with pagination and concurrency-limited downloads."""
+    fake = FakeOSF()
+    folder = fake.add("root", "sim", "folder")
+    for i in range(5):
+        fake.add(folder, f"{i}.txt", "file", f"content {i}".encode())
+    fake.add("root", "README", "file", b"readme")
+
+    async def scenario(project):
+        paths = await project.ls()
+        local_paths = await project.download_many(
+            [f"sim/{i}.txt" for i in range(5)], local_dir=str(tmp_path)
+        )
+        return paths, local_paths
+
+    paths, local_paths = run_with_osf(fake, scenario)
+    assert paths == ["osfstorage/README"] + [
+        f"osfstorage/sim/{i}.txt" for i in range(5)
+    ]
+    for i, local_path in enumerate(local_paths):
+        with open(local_path, "rb") as file:
+            assert file.read() == f"content {i}".encode()
+    assert fake.max_active == 2
+
+
+def test_async_osf_project_interrupted_download(tmp_path):
+    """Test that an interrupted download leaves no partial file."""
+    fake = FakeOSF()
+    fake.add("root", "broken.txt", "file", None)
+    local_path = str(tmp_path / "broken.txt")
+
+    async def scenario(project):
+        import aiohttp
+
+        with pytest.raises(aiohttp.ClientError):
+            await project.download("broken.txt", local_path)
+
+    run_with_osf(fake, scenario)
+    assert os.listdir(tmp_path) == []
+
+
+def test_async_osf_project_upload_and_remove(tmp_path):
+    """Test that uploads create folders and replace existing files."""
+    fake = FakeOSF()
+    local_path = str(tmp_path / "data.txt")
+    with open(local_path, "wb") as file:
+        file.write(b"first")
+
+    async def scenario(project):
+        await project.upload(local_path, "new/folder/data.txt")
+        with open(local_path, "wb") as file:
+            file.write(b"second")
+        await project.upload(local_path, "new/folder/data.txt")
+        paths = await project.ls()
+        await project.download("new/folder/data.txt", str(tmp_path / "copy.txt"))
+        await project.remove("new/folder/data.txt")
+        with pytest.raises(FileNotFoundError):
+            await project.download("new/folder/data.txt", local_path)
+        return paths
+
+    assert run_with_osf(fake, scenario) == ["osfstorage/new/folder/data.txt"]
+    with open(tmp_path / "copy.txt", "rb") as file:
+        assert file.read() == b"second"
+    assert [node["name"] for node in fake.nodes.values()] == ["", "new", "folder"]
+
+
+def test_async_osf_project_requires_token():
+    """Test that a token must be provided."""
+    with pytest.raises(TypeError):
+        aio.AsyncOSFProject()
@@ -3,15 +3,24 @@
 import os
 
 import gemmi
+import mrcfile
 import numpy as np
 import pytest
 
 from ioSPI.atomic_models import (
+    POTENTIAL_PREFACTOR,
+    build_potential_map,
+    coarse_grain,
+    euler_angles_to_rotation_matrices,
     extract_atomic_parameter,
     extract_gemmi_atoms,
+    extract_residue_indices,
+    iter_transform_coordinates,
     read_atomic_model,
+    transform_coordinates,
     write_atomic_model,
     write_cartesian_coordinates,
+    write_potential_map,
 )
 
 DATA = "tests/data"
@@ -168,3 +177,216 @@ class TestAtomicModels:
         model = read_atomic_model(path_output, assemble=False)
         os.remove(path_output)
         assert model.__class__ is gemmi.Model
+
+    def test_build_potential_map(self):
+        """Test potential map against a direct evaluation on the grid."""
+        elements = [gemmi.Element(name) for name in ["C", "N", "O"]]
+        coordinates = np.array([[10.2, 9.7, 8.1], [6.0, 12.5, 10.0], [0.4, 0.0, 1]])
+        form_factor_a = np.array([element.c4322.a for element in elements])
+        form_factor_b = np.array([element.c4322.b for element in elements])
+        shape = (16, 20, 18)
+        voxel_size = 1.2
+        origin = (-1.0, 0.5, 0.0)
+
+        potential = build_potential_map(
+            coordinates,
+            form_factor_a,
+            form_factor_b,
+            shape,
+            voxel_size=voxel_size,
+            origin=origin,
+            tolerance=1e-8,
+            chunk_size=2,
+        )
+        assert potential.shape == shape
+
+        grid = np.stack(np.indices(shape)[::-1], axis=-1) * voxel_size + origin
+        expected = np.zeros(shape)
+        for position, a, b in zip(coordinates, form_factor_a, form_factor_b):
+            squared_distances = ((grid - position) ** 2).sum(axis=-1)
+            for a_i, b_i in zip(a, b):
+                expected += (
+                    POTENTIAL_PREFACTOR
+                    * a_i
+                    * (4 * np.pi / b_i) ** 1.5
+                    * np.exp(-4 * np.pi**2 * squared_distances / b_i)
+                )
+        np.testing.assert_allclose(potential, expected, atol=1e-5 * expected.max())
+
+        potential = build_potential_map(
+            coordinates[:1],
+            form_factor_a[:1],
+            form_factor_b[:1],
+            (40, 40, 40),
+            voxel_size=0.5,
+            b_factor=20.0,
+        )
+        integral = potential.sum() * 0.5**3
+        assert integral == pytest.approx(
+            POTENTIAL_PREFACTOR * sum(form_factor_a[0]), rel=1e-3
+        )
+
+        path = "test_potential.mrc"
+        write_potential_map(path, potential, voxel_size=0.5, origin=origin)
+        with mrcfile.open(path) as mrc:
+            assert mrc.data.shape == (40, 40, 40)
+            assert mrc.voxel_size.x == pytest.approx(0.5)
+            assert mrc.header.origin.x == pytest.approx(origin[0])
+        os.remove(path)
+
+    def test_euler_angles_to_rotation_matrices(self):
+        """Test that rotation matrices compose relion ZYZ rotations."""
+
+        def rotation_z(angle):
+            c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+            return np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+
+        def rotation_y(angle):
+            c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+            return np.array([[c, 0, -s], [0, 1, 0], [s, 0, c]])
+
+        angles = np.random.uniform(-180, 180, (5, 3))
+        rotations = euler_angles_to_rotation_matrices(angles)
+        for (rot, tilt, psi), rotation in zip(angles, rotations):
+            expected = rotation_z(psi) @ rotation_y(tilt) @ rotation_z(rot)
+            np.testing.assert_allclose(rotation, expected, atol=1e-12)
+        np.testing.assert_allclose(
+            rotations @ rotations.transpose(0, 2, 1),
+            np.tile(np.eye(3), (5, 1, 1)),
+            atol=1e-12,
+        )
+
+    def test_transform_coordinates(self):
+        """Test batched transforms against a loop over poses."""
+        coordinates = np.random.rand(7, 3)
+        angles = np.random.uniform(-180, 180, (5, 3))
+        shifts = np.random.rand(5, 2)
+        rotations = euler_angles_to_rotation_matrices(angles)
+
+        transformed = transform_coordinates(
+            coordinates, angles=angles, shifts=shifts, chunk_size=2
+        )
+        assert transformed.shape == (5, 7, 3)
+        projected = transform_coordinates(
+            coordinates, rotations, shifts=shifts, project=True, dtype="float32"
+        )
+        assert projected.shape == (5, 7, 2)
+        assert projected.dtype == np.float32
+        for i_pose, rotation in enumerate(rotations):
+            expected = coordinates @ rotation.T
+            expected[:, :2] += shifts[i_pose]
+            np.testing.assert_allclose(transformed[i_pose], expected, atol=1e-12)
+            np.testing.assert_allclose(projected[i_pose], expected[:, :2], atol=1e-5)
+
+        with pytest.raises(ValueError):
+            transform_coordinates(np.zeros((3, 2)), angles=angles)
+        with pytest.raises(ValueError):
+            transform_coordinates(coordinates)
+        with pytest.raises(ValueError):
+            transform_coordinates(coordinates, rotations, angles=angles)
+        with pytest.raises(ValueError):
+            transform_coordinates(coordinates, angles)
+
+        # three poses of Euler angles, and a single rotation matrix
+        transformed = transform_coordinates(coordinates, angles=angles[:3])
+        for i_pose, rotation in enumerate(rotations[:3]):
+            np.testing.assert_allclose(transformed[i_pose], coordinates @ rotation.T)
+        transformed = transform_coordinates(coordinates, rotations[0])
+        assert transformed.shape == (1, 7, 3)
+        np.testing.assert_allclose(transformed[0], coordinates @ rotations[0].T)
+
+        out = np.zeros((5, 7, 2), dtype=np.float32)
+        assert (
+            transform_coordinates(
+                coordinates, rotations, shifts=shifts, project=True, out=out
+            )
+            is out
+        )
+        np.testing.assert_allclose(out, projected, atol=1e-6)
+        with pytest.raises(ValueError):
+            transform_coordinates(coordinates, rotations, out=out)
+
+        chunks = list(
+            iter_transform_coordinates(
+                coordinates, angles=angles, shifts=shifts, chunk_size=2
+            )
+        )
+        assert [start for start, _ in chunks] == [0, 2, 4]
+        assert max(len(chunk) for _, chunk in chunks) == 2
+        np.testing.assert_allclose(
+            np.concatenate([chunk for _, chunk in chunks]),
+            transform_coordinates(coordinates, rotations, shifts),
+        )
+
+    def test_extract_residue_indices(self):
+        """Check residue indices and atom names of a model built in memory."""
+        model = gemmi.Model("model")
+        for chain_name, residue_sizes in [("A", [3, 2]), ("B", [4])]:
+            chain = gemmi.Chain(chain_name)
+            for size in residue_sizes:
+                residue = gemmi.Residue()
+                for name in ["N", "CA", "C", "O"][:size]:
+                    atom = gemmi.Atom()
+                    atom.name = name
+                    residue.add_atom(atom)
+                chain.add_residue(residue)
+            model.add_chain(chain)
+
+        residue_indices = extract_residue_indices(model)
+        np.testing.assert_array_equal(residue_indices, [0, 0, 0, 1, 1, 2, 2, 2, 2])
+        np.testing.assert_array_equal(
+            extract_residue_indices(model, chains=["B"]), [0, 0, 0, 0]
+        )
+        atom_names = extract_atomic_parameter(extract_gemmi_atoms(model), "atom_name")
+        assert atom_names[:5] == ["N", "CA", "C", "N", "CA"]
+
+    def test_coarse_grain(self):
+        """Check bead positions and summed form factors of each method."""
+        coordinates = np.array(
+            [[0.0, 0, 0], [1, 0, 0], [2, 0, 0], [10, 0, 0], [11, 0, 0], [10.5, 3, 0]]
+        )
+        residue_indices = np.array([5, 5, 5, 7, 7, 7])
+        atom_names = np.array(["N", "CA", "C", "N", "CB", "O"])
+        elements = [gemmi.Element(name) for name in ["N", "C", "C", "N", "C", "O"]]
+        form_factor_a = np.array([element.c4322.a for element in elements])
+        form_factor_b = np.array([element.c4322.b for element in elements])
+
+        beads, bead_a, bead_b, labels = coarse_grain(
+            coordinates,
+            "centroid",
+            residue_indices,
+            form_factor_a=form_factor_a,
+            form_factor_b=form_factor_b,
+        )
+        np.testing.assert_allclose(beads, [[1, 0, 0], [10.5, 1, 0]])
+        np.testing.assert_array_equal(labels, [0, 0, 0, 1, 1, 1])
+        np.testing.assert_allclose(bead_a.sum(axis=0), form_factor_a.sum(axis=0))
+        assert np.all(bead_b > form_factor_b.min(axis=0))
+
+        # the CA of residue 5 is off its centroid, residue 7 has no CA
+        ca_coordinates = coordinates.copy()
+        ca_coordinates[1] = [1, 2, 0]
+        beads, bead_a, bead_b, _ = coarse_grain(
+            ca_coordinates, "ca", residue_indices, atom_names
+        )
+        np.testing.assert_allclose(beads, [[1, 2, 0], [10.5, 1, 0]])
+        assert bead_a is None and bead_b is None
+
+        beads, _, _, labels = coarse_grain(coordinates, "grid", grid_size=2.5)
+        np.testing.assert_array_equal(labels, [0, 0, 0, 1, 1, 2])
+        np.testing.assert_allclose(beads, [[1, 0, 0], [10.5, 0, 0], [10.5, 3, 0]])
+
+        # atoms at the same position keep their widths
+        _, bead_a, bead_b, _ = coarse_grain(
+            np.zeros((2, 3)),
+            "grid",
+            form_factor_a=form_factor_a[[1, 2]],
+            form_factor_b=form_factor_b[[1, 2]],
+        )
+        np.testing.assert_allclose(bead_a[0], 2 * form_factor_a[1])
+        np.testing.assert_allclose(bead_b[0], form_factor_b[1])
+
+        with pytest.raises(ValueError):
+            coarse_grain(coordinates, "centroid")
+        with pytest.raises(ValueError):
+            coarse_grain(coordinates, "kmeans", residue_indices)
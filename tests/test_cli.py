@@ -0,0 +1,111 @@
+"""Unit tests for the iospi command-line interface."""
+
+import csv
+import io
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from ioSPI import atomic_models, cli, micrographs, particle_metadata
+
+
+@pytest.fixture
+def mrc_paths(tmp_path):
+    """Write three .mrcs stacks and return their paths."""
+    paths = []
+    for i_stack in range(3):
+        micrographs.write_micrograph_to_mrc(
+            str(tmp_path), np.full((2, 4, 4), i_stack, dtype=np.float32), i_stack
+        )
+        paths.append(os.path.join(str(tmp_path), f"{i_stack:04d}.mrcs"))
+    return paths
+
+
+def test_inspect(mrc_paths, tmp_path, capsys):
+    """Test that inspect prints one CSV row per file and reports progress."""
+    status = cli.main(["inspect", os.path.join(str(tmp_path), "*.mrcs"), "--jobs", "2"])
+    captured = capsys.readouterr()
+    rows = list(csv.DictReader(io.StringIO(captured.out)))
+    assert [row["path"] for row in rows] == mrc_paths
+    assert all(row["n_frames"] == "2" for row in rows)
+    assert "[3/3]" in captured.err
+    assert status == 0
+
+    # unreadable files get an error row, in input order
+    broken_path = os.path.join(str(tmp_path), "broken.mrc")
+    with open(broken_path, "wb") as file:
+        file.write(b"MAP ")
+    status = cli.main(["inspect", broken_path, *mrc_paths[::-1]])
+    rows = list(csv.DictReader(io.StringIO(capsys.readouterr().out)))
+    assert [row["path"] for row in rows] == [broken_path] + mrc_paths[::-1]
+    assert rows[0]["error"] and rows[0]["n_frames"] == ""
+    assert rows[1]["n_frames"] == "2" and rows[1]["error"] == ""
+    assert status == 1
+
+
+def test_mrc2hdf5(mrc_paths, tmp_path, capsys):
+    """Test that mrc2hdf5 stacks the frames of all files."""
+    out_path = os.path.join(str(tmp_path), "stack.hdf5")
+    cli.main(["mrc2hdf5", *mrc_paths, "--output", out_path, "-j", "2"])
+    with h5py.File(out_path, "r") as file:
+        data = file["micrographs"][()]
+    assert data.shape == (6, 4, 4)
+    np.testing.assert_array_equal(data[::2, 0, 0], [0, 1, 2])
+    assert "[3/3]" in capsys.readouterr().err
+
+
+def test_pdb2npy(tmp_path):
+    """Test that pdb2npy saves the coordinates of each atomic model."""
+    coordinates = np.random.rand(10, 3).round(2) * 10
+    pdb_path = os.path.join(str(tmp_path), "model.pdb")
+    atomic_models.write_cartesian_coordinates(pdb_path, coordinates)
+    output_dir = os.path.join(str(tmp_path), "npy")
+    cli.main(
+        ["pdb2npy", pdb_path, "--output-dir", output_dir, "--no-clean", "--no-assemble"]
+    )
+    saved = np.load(os.path.join(output_dir, "model.npy"))
+    np.testing.assert_allclose(saved, coordinates, atol=1e-3)
+
+    other_path = os.path.join(str(tmp_path), "other", "model.pdb")
+    os.makedirs(os.path.dirname(other_path))
+    atomic_models.write_cartesian_coordinates(other_path, coordinates)
+    with pytest.raises(ValueError):
+        cli.main(["pdb2npy", pdb_path, other_path, "--output-dir", output_dir])
+
+
+def test_star_merge_and_split(tmp_path):
+    """Test that merging then splitting starfiles recovers their rows."""
+    for i_file in range(2):
+        metadata = pd.DataFrame(
+            {
+                "rlnMicrographName": [f"micrograph_{i_file}.mrc"] * 3,
+                "rlnDefocusU": np.arange(3) + 10.0 * i_file,
+            }
+        )
+        particle_metadata.write_metadata_to_starfile(
+            str(tmp_path), metadata, f"part_{i_file}.star"
+        )
+    merged_path = os.path.join(str(tmp_path), "merged.star")
+    cli.main(
+        [
+            "star-merge",
+            os.path.join(str(tmp_path), "part_*.star"),
+            "--output",
+            merged_path,
+            "--jobs",
+            "1",
+        ]
+    )
+    merged = particle_metadata.read_starfile(merged_path, use_sidecar=False)
+    assert len(merged) == 6
+
+    split_dir = os.path.join(str(tmp_path), "split")
+    cli.main(["star-split", merged_path, "--output-dir", split_dir])
+    assert sorted(os.listdir(split_dir)) == ["micrograph_0.star", "micrograph_1.star"]
+    split = particle_metadata.read_starfile(
+        os.path.join(split_dir, "micrograph_1.star"), use_sidecar=False
+    )
+    np.testing.assert_array_equal(split["rlnDefocusU"], [10.0, 11.0, 12.0])
@@ -0,0 +1,85 @@
+"""Unit tests for the content-addressed store."""
+
+import hashlib
+import os
+
+import h5py
+import numpy as np
+
+from ioSPI import content_store, micrographs
+
+
+def test_hash_array_is_independent_of_memory_layout():
+    """Test that equal arrays hash equally, whatever their strides."""
+    array = np.random.rand(4, 5, 6)
+    strided = np.asfortranarray(array)
+
+    def hex_digest(data):
+        digest = hashlib.sha256()
+        content_store.hash_array(data, digest, chunk_size=7)
+        return digest.hexdigest()
+
+    assert hex_digest(array) == hex_digest(strided)
+    assert hex_digest(array) == hex_digest(array[:, :, :])
+    assert hex_digest(array) != hex_digest(array.astype(np.float32))
+    assert hex_digest(array) != hex_digest(array.reshape(5, 4, 6))
+
+
+def test_write_micrograph_to_mrc_deduplicates(tmp_path):
+    """Test that identical micrographs are stored once and read back."""
+    store = content_store.ContentStore(str(tmp_path / "store"))
+    micrograph = np.random.rand(2, 8, 8).astype(np.float32)
+    for run in range(3):
+        os.makedirs(tmp_path / f"run_{run}")
+        micrographs.write_micrograph_to_mrc(
+            str(tmp_path / f"run_{run}"), micrograph, 0, store=store
+        )
+    micrographs.write_micrograph_to_mrc(
+        str(tmp_path / "run_2"), micrograph + 1, 1, store=store
+    )
+
+    stats = store.stats()
+    assert stats["objects"] == 2
+    assert stats["references"] == 4
+    assert stats["referenced_bytes"] > stats["stored_bytes"]
+    for run in range(3):
+        data = micrographs.read_micrograph_from_mrc(
+            str(tmp_path / f"run_{run}" / "0000.mrcs")
+        )
+        np.testing.assert_array_equal(data, micrograph)
+
+
+def test_overwriting_a_reference_keeps_the_object(tmp_path):
+    """Test that writing without the store does not modify stored objects."""
+    store = content_store.ContentStore(str(tmp_path / "store"))
+    data = {"images": np.ones((2, 3)), "seed": 0}
+    paths = [str(tmp_path / f"data_{i}.hdf5") for i in range(2)]
+    for path in paths:
+        micrographs.write_data_dict_to_hdf5(path, data, store=store)
+    assert len(store.keys()) == 1
+
+    micrographs.write_data_dict_to_hdf5(paths[0], {"images": np.zeros((2, 3))})
+    with h5py.File(paths[0], "r") as file:
+        np.testing.assert_array_equal(file["data/images"][()], 0)
+    with h5py.File(paths[1], "r") as file:
+        np.testing.assert_array_equal(file["data/images"][()], 1)
+
+
+def test_upload_sends_each_object_once(tmp_path):
+    """Test that upload skips objects uploaded before."""
+
+    class Project:
+        remote_paths = []
+
+        def upload(self, local_path=None, remote_path=None):
+            self.remote_paths.append(remote_path)
+
+    store = content_store.ContentStore(str(tmp_path / "store"))
+    for i in range(3):
+        micrographs.write_data_dict_to_hdf5(
+            str(tmp_path / f"data_{i}.hdf5"), {"seed": i % 2}, store=store
+        )
+    project = Project()
+    assert len(store.upload(project, n_jobs=2)) == 2
+    assert store.upload(project) == []
+    assert sorted(project.remote_paths) == ["objects/" + key for key in store.keys()]
@@ -0,0 +1,102 @@
+"""Unit tests for dataset manifests and the Dataset object."""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ioSPI import datasets, micrographs, particle_metadata
+
+
+class LocalProject:
+    """Stand-in for an OSF project whose storage is a local directory."""
+
+    def __init__(self, storage_root):
+        self.storage_root = storage_root
+        self.downloads = []
+
+    def download(self, remote_path=None, local_path=None):
+        """Copy a file from the storage directory."""
+        self.downloads.append(remote_path)
+        shutil.copyfile(os.path.join(self.storage_root, remote_path), local_path)
+
+
+@pytest.fixture
+def dataset_root(tmp_path):
+    """Write a small dataset with a stack, a starfile and an HDF5 file."""
+    root = str(tmp_path / "dataset")
+    os.makedirs(os.path.join(root, "stacks"))
+    micrographs.write_micrograph_to_mrc(
+        os.path.join(root, "stacks"), np.ones((3, 4, 4), dtype=np.float32), 0
+    )
+    particle_metadata.write_metadata_to_starfile(
+        root, pd.DataFrame({"rlnDefocusU": [1.0, 2.0], "rlnImageName": ["a", "b"]})
+    )
+    micrographs.write_data_dict_to_hdf5(
+        os.path.join(root, "data.hdf5"), {"images": np.zeros((2, 4, 4))}
+    )
+    return root
+
+
+def test_dataset_create_and_open(dataset_root):
+    """Test that the manifest records sizes, frame counts and schemas."""
+    dataset = datasets.Dataset.create(dataset_root, n_jobs=2)
+    assert sorted(dataset) == ["data.hdf5", "metadata.star", "stacks/0000.mrcs"]
+
+    reopened = datasets.Dataset.open(dataset_root)
+    assert reopened.files == dataset.files
+    stack = reopened.files["stacks/0000.mrcs"]
+    assert stack["kind"] == "micrographs"
+    assert stack["header"]["n_frames"] == 3
+    assert stack["size"] == os.path.getsize(
+        os.path.join(dataset_root, "stacks", "0000.mrcs")
+    )
+    columns = reopened.files["metadata.star"]["blocks"][""]["columns"]
+    assert set(columns) == {"rlnDefocusU", "rlnImageName"}
+    assert reopened.files["data.hdf5"]["datasets"]["data/images"]["shape"] == [2, 4, 4]
+    assert reopened.select(kind="metadata") == ["metadata.star"]
+    np.testing.assert_array_equal(
+        reopened.load("data.hdf5")["images"], np.zeros((2, 4, 4))
+    )
+    assert reopened.select(pattern="stacks/*") == ["stacks/0000.mrcs"]
+
+
+def test_dataset_verify(dataset_root):
+    """Test that verify reports missing and modified files."""
+    dataset = datasets.Dataset.create(dataset_root)
+    assert dataset.verify(n_jobs=2) == {}
+
+    os.remove(os.path.join(dataset_root, "data.hdf5"))
+    with open(os.path.join(dataset_root, "metadata.star"), "r+b") as file:
+        file.seek(-2, os.SEEK_END)
+        file.write(b"c")
+    assert dataset.verify() == {
+        "data.hdf5": "missing",
+        "metadata.star": "checksum mismatch",
+    }
+    assert dataset.verify(checksum=False) == {"data.hdf5": "missing"}
+
+
+def test_dataset_lazy_fetch(dataset_root, tmp_path):
+    """Test that only the files a job needs are fetched from the project."""
+    datasets.Dataset.create(dataset_root, remote_root="sim")
+    storage_root = str(tmp_path / "storage")
+    shutil.copytree(dataset_root, os.path.join(storage_root, "sim"))
+
+    local_root = str(tmp_path / "local")
+    os.makedirs(local_root)
+    shutil.copy(os.path.join(dataset_root, datasets.MANIFEST_FILENAME), local_root)
+    project = LocalProject(storage_root)
+    dataset = datasets.Dataset.open(local_root, project=project)
+
+    stack = dataset.load("stacks/0000.mrcs")
+    assert stack.shape == (3, 4, 4)
+    assert project.downloads == ["sim/stacks/0000.mrcs"]
+    dataset.load("stacks/0000.mrcs")
+    assert len(project.downloads) == 1
+    assert dataset.verify(checksum=False) == {
+        "data.hdf5": "missing",
+        "metadata.star": "missing",
+    }
@@ -0,0 +1,41 @@
+"""Unit tests for the lazy imports of ioSPI."""
+
+import subprocess
+import sys
+
+from ioSPI._lazy import lazy_import
+
+HEAVY_MODULES = ["gemmi", "h5py", "mrcfile", "pandas", "starfile", "torch"]
+
+
+def test_import_does_not_load_heavy_dependencies():
+    """Check that importing all submodules defers heavy dependencies."""
+    code = (
+        "import sys, ioSPI; "
+        "from ioSPI import atomic_models, datasets, micrographs, particle_metadata; "
+        f"print([name for name in {HEAVY_MODULES} if name in sys.modules])"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        text=True,
+        stdout=subprocess.PIPE,
+    ).stdout
+    assert output.strip() == "[]"
+
+
+def test_lazy_import():
+    """Check that a lazy module is imported on first attribute access."""
+    json = lazy_import("json")
+    assert json.__dict__["_module"] is None
+    assert json.loads("[1]") == [1]
+    assert json.__dict__["_module"] is sys.modules["json"]
+    assert "dumps" in dir(json)
+
+
+def test_submodules_are_attributes():
+    """Check that submodules are accessible from the ioSPI namespace."""
+    import ioSPI
+
+    assert ioSPI.particle_metadata.__name__ == "ioSPI.particle_metadata"
+    assert "micrographs" in dir(ioSPI)
@@ -0,0 +1,72 @@
+"""Unit tests for the instrumentation of ioSPI functions."""
+
+import logging
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from ioSPI import instrumentation, micrographs, particle_metadata
+
+
+def test_instrumentation_disabled():
+    """Test that no event is recorded when instrumentation is off."""
+    instrumentation.reset_counters()
+    with tempfile.TemporaryDirectory() as root:
+        micrographs.write_micrograph_to_mrc(root, np.zeros((2, 4, 4)), 0)
+    assert not instrumentation.is_enabled()
+    assert instrumentation.get_counters() == {}
+
+
+def test_instrumentation_counters(caplog):
+    """Test that bytes, files, cache hits and errors are recorded."""
+    instrumentation.reset_counters()
+    data = np.random.rand(3, 4, 4).astype(np.float32)
+    with tempfile.TemporaryDirectory() as root, instrumentation.enabled():
+        with caplog.at_level(logging.DEBUG, logger="ioSPI.instrumentation"):
+            micrographs.write_micrograph_to_mrc(root, data, 0)
+            path = os.path.join(root, "0000.mrcs")
+            micrographs.read_micrograph_from_mrc(path)
+            micrographs.read_micrograph_from_mrc(path)
+            header = micrographs.read_mrc_header(path)
+            with micrographs.VirtualMrcStack([path]) as stack:
+                stack[[0, 1]]
+                stack[2]
+            with pytest.raises(FileNotFoundError):
+                micrographs.read_micrograph_from_mrc(os.path.join(root, "missing"))
+            metadata = particle_metadata.format_metadata_for_writing([[1]], ["a"])
+            particle_metadata.write_metadata_to_starfile(root, metadata)
+            particle_metadata.read_starfile(
+                os.path.join(root, "metadata.star"), write_sidecar=True
+            )
+            particle_metadata.read_starfile(os.path.join(root, "metadata.star"))
+    assert not instrumentation.is_enabled()
+
+    counters = instrumentation.get_counters()
+    write = counters["micrographs.write_micrograph_to_mrc"]
+    assert write["calls"] == 1
+    assert write["bytes_written"] >= data.nbytes
+    assert write["files"] == 1
+    assert write["wall_time"] > 0
+
+    read = counters["micrographs.read_micrograph_from_mrc"]
+    assert read["calls"] == 3
+    assert read["errors"] == 1
+    assert read["bytes_read"] == 2 * write["bytes_written"]
+
+    read_header = counters["micrographs.read_mrc_header"]
+    # read directly, and by the header scan of VirtualMrcStack
+    assert read_header["calls"] == 2
+    assert read_header["bytes_read"] == 2 * 1024
+    assert header["n_frames"] == 3
+
+    stack = counters["micrographs.VirtualMrcStack.__getitem__"]
+    assert (stack["cache_hits"], stack["cache_misses"]) == (1, 1)
+
+    star = counters["particle_metadata.read_starfile"]
+    assert (star["cache_hits"], star["cache_misses"]) == (1, 1)
+
+    events = [record.iospi_event for record in caplog.records]
+    assert events[0]["name"] == "micrographs.write_micrograph_to_mrc"
+    assert any(event["error"] for event in events)
@@ -1,14 +1,18 @@
 """Unit tests for tem wrapper I/O helper functions."""
 
 import os
+import pickle
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import h5py
 import mrcfile
 import numpy as np
+import pandas as pd
+import pytest
 import torch
 
-from ioSPI import micrographs
+from ioSPI import micrographs, particle_metadata
 
 
 def test_populate_hdf5_with_dict():
@@ -23,7 +27,8 @@ def test_populate_hdf5_with_dict():
             micrographs._populate_hdf5_with_dict(f, "", data)
         with h5py.File(tmp.name, "r") as f:
             assert f["a"][()] == 1.0
-            assert f["b"].asstr()[()] == "None"
+            assert "b" not in f
+            assert isinstance(f.attrs["b"], h5py.Empty)
             assert f["c/d"][()] == 1
     finally:
         os.unlink(tmp.name)
@@ -59,6 +64,104 @@ def test_read_micrograph_from_mrc_large():
         os.unlink(tmp_mrc.name)
 
 
+def test_write_micrograph_to_mrc_reduced_precision():
+    """Test float16 and quantized writing, and compressed reading."""
+    projections = torch.randn(4, 1, 5, 5)
+    expected = projections.numpy()
+
+    with tempfile.TemporaryDirectory() as output_path:
+        micrographs.write_micrograph_to_mrc(output_path, projections, 0, "float16")
+        path = os.path.join(output_path, "0000.mrcs")
+        assert micrographs.read_mrc_header(path)["mode"] == 12
+        out_data = micrographs.read_micrograph_from_mrc(path)
+        assert out_data.dtype == np.float16
+        np.testing.assert_allclose(out_data, expected, atol=1e-2)
+
+        for dtype, atol in [("int8", 0.05), ("int16", 1e-3)]:
+            micrographs.write_micrograph_to_mrc(
+                output_path, projections, 1, dtype, compression="gzip"
+            )
+            path = os.path.join(output_path, "0001.mrcs.gz")
+            assert micrographs.read_mrc_header(path)["dtype"] == dtype
+            out_data = micrographs.read_micrograph_from_mrc(path)
+            assert out_data.dtype == dtype
+            out_data = micrographs.read_micrograph_from_mrc(path, dtype="float32")
+            assert out_data.dtype == np.float32
+            np.testing.assert_allclose(out_data, expected, atol=atol)
+            out_data = micrographs.read_micrograph_from_mrc(
+                path, roi=(0, 5, 0, 5), dtype="float32"
+            )
+            np.testing.assert_allclose(out_data, expected, atol=atol)
+
+        micrographs.write_micrograph_to_mrc(
+            output_path, projections, 2, compression="bzip2"
+        )
+        out_data = micrographs.read_micrograph_from_mrc(
+            os.path.join(output_path, "0002.mrcs.bz2")
+        )
+        assert (out_data == expected).all()
+
+        with pytest.raises(ValueError):
+            micrographs.write_micrograph_to_mrc(output_path, projections, 3, "int32")
+
+
+def test_add_label():
+    """Test that labels are appended, and overwrite the last one when full."""
+    header = np.zeros((), dtype=mrcfile.dtypes.HEADER_DTYPE).view(np.recarray)
+    micrographs._add_label(header, b"first")
+    assert header.nlabl == 1 and header.label[0] == b"first"
+
+    header.nlabl = 10
+    micrographs._add_label(header, b"last")
+    assert header.nlabl == 10 and header.label[9] == b"last"
+
+
+def test_read_micrograph_from_mrc_options(monkeypatch):
+    """Test read-time cropping, binning, Fourier cropping and casting."""
+    tmp_mrc = tempfile.NamedTemporaryFile(delete=False, suffix=".mrc")
+    tmp_mrc.close()
+    data = np.random.rand(2, 8, 6).astype(np.float32)
+
+    try:
+        with mrcfile.new(tmp_mrc.name, overwrite=True) as mrc:
+            mrc.set_data(data)
+
+        out_data = micrographs.read_micrograph_from_mrc(
+            tmp_mrc.name, roi=(1, 7, 2, 6), dtype="float16"
+        )
+        assert out_data.dtype == np.float16
+        assert (out_data == data[:, 1:7, 2:6].astype(np.float16)).all()
+
+        # casting alone is done frame by frame from the memory map
+        with monkeypatch.context() as patch:
+            patch.setattr(mrcfile, "open", None)
+            out_data = micrographs.read_micrograph_from_mrc(
+                tmp_mrc.name, dtype="float16"
+            )
+        assert (out_data == data.astype(np.float16)).all()
+
+        out_data = micrographs.read_micrograph_from_mrc(tmp_mrc.name, bin_factor=4)
+        assert out_data.shape == (2, 2, 1)
+        np.testing.assert_allclose(out_data[1, 1, 0], data[1, 4:8, 0:4].mean())
+
+        out_data = micrographs.read_micrograph_from_mrc(tmp_mrc.name, fourier_crop=4)
+        assert out_data.shape == (2, 4, 4)
+        assert out_data.dtype == np.float32
+        np.testing.assert_allclose(
+            out_data.mean(axis=(1, 2)), data.mean(axis=(1, 2)), rtol=1e-5
+        )
+
+        out_data = micrographs.read_micrograph_from_mrc(
+            tmp_mrc.name, fourier_crop=(8, 6), dtype="float64"
+        )
+        np.testing.assert_allclose(out_data, data, atol=1e-6)
+
+        with pytest.raises(ValueError):
+            micrographs.read_micrograph_from_mrc(tmp_mrc.name, fourier_crop=10)
+    finally:
+        os.unlink(tmp_mrc.name)
+
+
 def test_write_data_dict_to_hdf5():
     """Test write_data_dict_to_hdf5 helper with a simple hdf5 file."""
     tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".hdf5")
@@ -77,6 +180,62 @@ def test_write_data_dict_to_hdf5():
         os.unlink(tmp.name)
 
 
+def test_data_dict_round_trip_through_hdf5(tmp_path):
+    """Test that scalars, None, lists and nested dicts are read back."""
+    path = str(tmp_path / "data.hdf5")
+    ragged = [np.arange(6).reshape(2, 3), np.arange(4).reshape(4, 1)]
+    data = {
+        "float32": np.float32(1.5),
+        "flag": True,
+        "uint8": np.uint8(7),
+        "name": "test",
+        "none": None,
+        "numbers": [1.0, 2.0, 3.0],
+        "names": ["a", "bb"],
+        "coordinates": [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]],
+        "nones": [None, None],
+        "images": [np.full((2, 2), i, dtype=np.float32) for i in range(5)],
+        "ragged": ragged,
+        "particles": [{"defocus": float(i), "shift": np.ones(2) * i} for i in range(4)],
+        "nested": {"seed": 0, "none": None},
+    }
+    micrographs.write_data_dict_to_hdf5(path, data)
+
+    with h5py.File(path, "r") as f:
+        assert f["data/images"].shape == (5, 2, 2)
+        assert f["data/particles/shift"].shape == (4, 2)
+        assert len(f["data/ragged"]) == 3
+
+    out = micrographs.read_data_dict_from_hdf5(path)
+    assert out["float32"] == 1.5 and out["float32"].dtype == np.float32
+    assert out["flag"] is np.True_
+    assert out["uint8"].dtype == np.uint8
+    assert out["name"] == "test"
+    assert out["none"] is None and out["nested"]["none"] is None
+    assert out["nested"]["seed"] == 0
+    np.testing.assert_array_equal(out["numbers"], data["numbers"])
+    assert list(out["names"]) == ["a", "bb"]
+    np.testing.assert_array_equal(out["coordinates"], data["coordinates"])
+    assert out["nones"] == [None, None]
+    np.testing.assert_array_equal(out["images"], np.stack(data["images"]))
+    for array, expected in zip(out["ragged"], ragged):
+        np.testing.assert_array_equal(array, expected)
+    np.testing.assert_array_equal(out["particles"]["defocus"], np.arange(4.0))
+    np.testing.assert_array_equal(out["particles"]["shift"][:, 0], np.arange(4.0))
+
+
+@pytest.mark.parametrize(
+    "mixed",
+    [[np.ones(2), 1.0], ["a", 1.0], [b"a", 1], [[1.0, 2.0], [3.0]], [None, 1.0]],
+)
+def test_write_data_dict_to_hdf5_rejects_mixed_lists(tmp_path, mixed):
+    """Test that lists mixing types, or ragged nested lists, raise a ValueError."""
+    with pytest.raises(ValueError):
+        micrographs.write_data_dict_to_hdf5(
+            str(tmp_path / "data.hdf5"), {"mixed": mixed}
+        )
+
+
 def test_write_micrograph_to_mrc():
     """Test if the saved mrcs file exists."""
     projections = torch.randn(4, 1, 5, 5)
@@ -86,3 +245,291 @@ def test_write_micrograph_to_mrc():
     expected_file = os.path.join(output_path, str(iterations).zfill(4) + ".mrcs")
     assert os.path.isfile(expected_file)
     os.remove(expected_file)
+
+
+def test_virtual_mrc_stack():
+    """Test global frame indexing across several .mrcs files."""
+    stacks = [
+        np.arange(n_frames * 4 * 3, dtype=np.float32).reshape(n_frames, 4, 3) + i
+        for i, n_frames in enumerate([2, 1, 3])
+    ]
+    expected = np.concatenate(stacks)
+
+    with tempfile.TemporaryDirectory() as root:
+        for i, data in enumerate(stacks):
+            # compressed files cannot be memory-mapped
+            name, compression = (
+                (f"{i:04d}.mrcs.gz", "gzip") if i == 2 else (f"{i:04d}.mrcs", None)
+            )
+            with mrcfile.new(os.path.join(root, name), compression=compression) as mrc:
+                mrc.set_data(data[0] if len(data) == 1 else data)
+
+        with micrographs.VirtualMrcStack(
+            os.path.join(root, "*.mrcs*"), max_open_files=1
+        ) as stack:
+            assert len(stack) == len(expected)
+            assert list(stack.n_frames) == [2, 1, 3]
+            file_ids, local_indices = stack.locate([0, 2, 5])
+            assert list(file_ids) == [0, 1, 2]
+            assert list(local_indices) == [0, 0, 2]
+            assert (stack[3] == expected[3]).all()
+            assert (stack[-1] == expected[-1]).all()
+            assert (stack[[5, 0, 2, 1]] == expected[[5, 0, 2, 1]]).all()
+            assert (stack[:] == expected).all()
+            assert (stack[4:1:-2] == expected[4:1:-2]).all()
+            mask = np.arange(len(expected)) % 2 == 0
+            assert (stack[mask] == expected[mask]).all()
+            assert stack[[]].shape == (0, 4, 3)
+            assert stack[[]].dtype == np.float32
+            assert len(stack._handles) == 1
+
+            index_path = os.path.join(root, "index.npz")
+            stack.save_index(index_path)
+
+        with micrographs.VirtualMrcStack.from_index(index_path) as stack:
+            assert (stack[::2] == expected[::2]).all()
+            assert stack[5:5].shape == (0, 4, 3)
+            with pytest.raises(IndexError):
+                stack[len(expected)]
+
+        # frames of files with different modes are promoted, not cast
+        paths = [os.path.join(root, name) for name in ["int8.mrcs", "float.mrcs"]]
+        with mrcfile.new(paths[0]) as mrc:
+            mrc.set_data(np.ones((2, 4, 3), dtype=np.int8))
+        with mrcfile.new(paths[1]) as mrc:
+            mrc.set_data(np.full((2, 4, 3), 0.7, dtype=np.float32))
+        for n_frames in [None, [2, 2]]:
+            with micrographs.VirtualMrcStack(paths, n_frames=n_frames) as stack:
+                frames = stack[[0, 2, 3]]
+                assert frames.dtype == np.float32
+                assert (frames[0] == 1).all()
+                assert (frames[1:] == np.float32(0.7)).all()
+
+
+def test_scan_mrc_headers():
+    """Test header-only inspection of .mrc files."""
+    with tempfile.TemporaryDirectory() as root:
+        with mrcfile.new(os.path.join(root, "a.mrc")) as mrc:
+            mrc.set_data(np.zeros((6, 5), dtype=np.int16))
+            mrc.voxel_size = 1.5
+        with mrcfile.new(os.path.join(root, "b.mrc")) as mrc:
+            mrc.set_data(np.zeros((3, 6, 5), dtype=np.float32))
+            mrc.set_extended_header(np.zeros(10, dtype=np.int32))
+
+        headers = micrographs.scan_mrc_headers(os.path.join(root, "*.mrc"), n_jobs=2)
+        assert list(headers["n_frames"]) == [1, 3]
+        assert list(headers["nx"]) == [5, 5]
+        assert list(headers["ny"]) == [6, 6]
+        assert list(headers["dtype"]) == ["int16", "float32"]
+        assert headers["voxel_size_x"][0] == pytest.approx(1.5)
+        assert list(headers["extended_header_size"]) == [0, 40]
+
+        assert headers["error"].isna().all()
+
+        with open(os.path.join(root, "c.mrc"), "wb") as file:
+            file.write(b"MAP ")
+        with pytest.raises(ValueError):
+            micrographs.read_mrc_header(os.path.join(root, "c.mrc"))
+        headers = micrographs.scan_mrc_headers(os.path.join(root, "*.mrc"))
+        assert list(headers["n_frames"][:2]) == [1, 3]
+        assert headers["error"][2].startswith("ValueError")
+        with pytest.raises(ValueError):
+            micrographs.VirtualMrcStack(os.path.join(root, "*.mrc"))
+
+        # zero machine stamps, in little- and big-endian files
+        for name, byte_order in [("d.mrc", "<"), ("e.mrc", ">")]:
+            path = os.path.join(root, name)
+            with mrcfile.new(path) as mrc:
+                mrc.set_data(np.zeros((2, 6, 5), dtype=byte_order + "f4"))
+            with open(path, "r+b") as file:
+                file.seek(212)
+                file.write(bytes(4))
+            header = micrographs.read_mrc_header(path)
+            assert (header["n_frames"], header["ny"], header["nx"]) == (2, 6, 5)
+            assert header["dtype"] == "float32"
+
+
+def test_convert_mrc_to_hdf5():
+    """Test conversion of .mrc files into a single dataset, with resuming."""
+    stacks = [
+        np.full((n_frames, 4, 3), i, dtype=np.float32)
+        for i, n_frames in enumerate([2, 3, 1])
+    ]
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for i, data in enumerate(stacks):
+            paths.append(os.path.join(root, f"{i:04d}.mrc" + (".bz2" if i else "")))
+            with mrcfile.new(paths[-1], compression="bzip2" if i else None) as mrc:
+                mrc.set_data(data)
+        out_path = os.path.join(root, "micrographs.hdf5")
+
+        offsets = micrographs.convert_mrc_to_hdf5(
+            paths[:2] + [paths[0]], out_path, n_jobs=2, max_in_flight=1
+        )
+        assert list(offsets) == [0, 2, 5, 7]
+        with pytest.raises(ValueError):
+            micrographs.convert_mrc_to_hdf5(paths, out_path)
+
+        offsets = micrographs.convert_mrc_to_hdf5(
+            paths, out_path, chunk_frames=2, resume=False
+        )
+        assert list(offsets) == [0, 2, 5, 6]
+        with h5py.File(out_path, "r") as f:
+            assert (f["micrographs"][:] == np.concatenate(stacks)).all()
+            assert f["micrographs"].chunks == (2, 4, 3)
+            assert f["micrographs_done"][:].all()
+
+        with h5py.File(out_path, "a") as f:
+            f["micrographs_done"][1] = False
+            f["micrographs"][:] = -1
+        micrographs.convert_mrc_to_hdf5(paths, out_path)
+        with h5py.File(out_path, "r") as f:
+            assert (f["micrographs"][2:5] == stacks[1]).all()
+            assert (f["micrographs"][:2] == -1).all()
+
+
+def test_mrcs_writer():
+    """Test appending batches of images to an .mrcs file."""
+    batches = [np.random.rand(n_images, 4, 5) for n_images in [3, 1, 2]]
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "particles.mrcs")
+        writer = micrographs.MrcsWriter(path)
+        for batch in batches:
+            writer.append(batch)
+        with pytest.raises(ValueError):
+            writer.append(np.zeros((1, 5, 4)))
+
+        expected = np.concatenate(batches).astype(np.float32)
+        with mrcfile.open(path) as mrc:
+            assert mrc.is_image_stack()
+            assert (mrc.header.nz, mrc.header.mz) == (len(expected), 1)
+            assert (mrc.data == expected).all()
+            assert mrc.header.dmax == pytest.approx(expected.max())
+            assert mrc.header.dmean == pytest.approx(expected.mean())
+            assert mrc.header.rms == pytest.approx(expected.std(), rel=1e-4)
+        assert mrcfile.validate(path)
+
+        with pytest.raises(FileExistsError):
+            micrographs.MrcsWriter(path, overwrite=False)
+
+
+def test_extract_particles():
+    """Test extraction of boxes, including boxes crossing the edges."""
+    micrograph = np.arange(10 * 12, dtype=np.float32).reshape(10, 12)
+    coordinates = np.array([[6, 5], [0, 0], [11.2, 9]])
+    boxes = micrographs.extract_particles(micrograph, coordinates, 4)
+    assert boxes.shape == (3, 4, 4)
+    assert (boxes[0] == micrograph[3:7, 4:8]).all()
+    assert (boxes[1][2:, 2:] == micrograph[:2, :2]).all()
+    assert (boxes[1][:2] == micrograph.mean()).all()
+    assert (boxes[2][:3, :3] == micrograph[7:, 9:]).all()
+    assert (boxes[2][3:] == micrograph.mean()).all()
+    assert (boxes[2][:, 3:] == micrograph.mean()).all()
+
+    # boxes larger than the micrograph are padded on all sides
+    boxes = micrographs.extract_particles(micrograph, [[6, 5]], 14)
+    assert (boxes[0][2:12, 1:13] == micrograph).all()
+    assert (boxes[0][:2] == micrograph.mean()).all()
+
+    boxes = micrographs.extract_particles(micrograph, coordinates, 4, normalize=True)
+    np.testing.assert_allclose(boxes.mean(axis=(1, 2)), 0, atol=1e-5)
+    np.testing.assert_allclose(boxes.std(axis=(1, 2)), 1, atol=1e-5)
+
+    with pytest.raises(ValueError):
+        micrographs.extract_particles(micrograph, [[20, 5]], 4)
+
+
+def test_extract_particles_to_mrcs():
+    """Test extraction of particles to an .mrcs stack and a starfile."""
+    data = [np.random.rand(16, 16).astype(np.float32) for _ in range(2)]
+    coordinates = pd.DataFrame(
+        {
+            "rlnMicrographName": ["a.mrc", "b.mrc", "a.mrc"],
+            "rlnCoordinateX": [8.0, 4.0, 10.0],
+            "rlnCoordinateY": [8.0, 6.0, 12.0],
+        }
+    )
+    with tempfile.TemporaryDirectory() as root:
+        for name, micrograph in zip(["a.mrc", "b.mrc"], data):
+            with mrcfile.new(os.path.join(root, name)) as mrc:
+                mrc.set_data(micrograph)
+
+        metadata = micrographs.extract_particles_to_mrcs(
+            coordinates, 6, root, root=root
+        )
+        assert list(metadata["__rlnImageName"]) == [
+            "000001@particles.mrcs",
+            "000002@particles.mrcs",
+            "000003@particles.mrcs",
+        ]
+        assert list(metadata["__rlnMicrographName"]) == ["a.mrc", "a.mrc", "b.mrc"]
+        assert os.path.isfile(os.path.join(root, "particles.star"))
+
+        with particle_metadata.ParticleDataset(
+            os.path.join(root, "particles.star")
+        ) as dataset:
+            assert (dataset[1] == data[0][9:15, 7:13]).all()
+            assert (dataset[2] == data[1][3:9, 1:7]).all()
+
+
+def test_read_micrograph_to_tensor():
+    """Test that the tensor is backed by a copy-on-write memory map."""
+    data = np.random.rand(3, 4, 5).astype(np.float32)
+    with tempfile.TemporaryDirectory() as root:
+        micrographs.write_micrograph_to_mrc(root, torch.from_numpy(data), 0)
+        path = os.path.join(root, "0000.mrcs")
+        micrograph = micrographs.read_micrograph_to_tensor(path)
+        assert isinstance(micrograph, torch.Tensor)
+        assert (micrograph.numpy() == data).all()
+
+        micrograph[0] = 0
+        del micrograph
+        assert (micrographs.read_micrograph_from_mrc(path) == data).all()
+
+
+def test_micrograph_dataset():
+    """Test loading frames with a multi-worker DataLoader."""
+    data = np.random.rand(5, 4, 4).astype(np.float32)
+    with tempfile.TemporaryDirectory() as root:
+        micrographs.write_micrograph_to_mrc(root, data[:2], 0)
+        micrographs.write_micrograph_to_mrc(root, data[2:], 1)
+        dataset = micrographs.MicrographDataset(
+            os.path.join(root, "*.mrcs"), transform=lambda frame: 2 * frame
+        )
+        assert len(dataset) == 5
+        assert (dataset[3].numpy() == 2 * data[3]).all()
+
+        loader = torch.utils.data.DataLoader(dataset, batch_size=2, num_workers=2)
+        frames = torch.cat(list(loader))
+        assert (frames.numpy() == 2 * data).all()
+
+
+def test_hdf5_reader():
+    """Test batched reads from threads and across pickling."""
+    images = np.random.rand(10, 3, 3)
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "data.hdf5")
+        micrographs.write_data_dict_to_hdf5(path, {"images": images})
+
+        with micrographs.Hdf5Reader(path) as reader:
+            assert reader.shape("data/images") == images.shape
+            assert (reader.read("data/images") == images).all()
+            assert (reader.read("data/images", 4) == images[4]).all()
+            assert (reader.read("data/images", slice(2, 5)) == images[2:5]).all()
+            indices = [7, 1, 2, 3, 7, -1]
+            assert (reader.read("data/images", indices) == images[indices]).all()
+
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                batches = list(
+                    executor.map(
+                        lambda i: reader.read("data/images", [i, 0]), range(10)
+                    )
+                )
+            for i, batch in enumerate(batches):
+                assert (batch == images[[i, 0]]).all()
+            assert len(reader._files) >= 2
+
+            clone = pickle.loads(pickle.dumps(reader))
+            assert (clone.read("data/images", [3]) == images[[3]]).all()
+            clone.close()
+        assert reader._files == []
@@ -1,17 +1,34 @@
 """Contain test functions for particle_metadata.py."""
 
 import os
+import pickle
+import tempfile
 
+import mrcfile
 import numpy as np
+import pandas as pd
 import pytest
+import starfile
 
 from ioSPI.particle_metadata import (
+    GroupStatistics,
+    MetadataAccumulator,
+    ParticleDataset,
+    aggregate_starfile,
     check_star_file,
     format_metadata_for_writing,
     format_metadata_for_writing_cryoem_convention,
+    get_sidecar_path,
     get_starfile_metadata_names,
+    iter_starfile_chunks,
+    parse_image_names,
+    read_starfile,
+    read_starfile_sidecar,
+    read_starfiles,
     update_optics_config_from_starfile,
+    validate_metadata,
     write_metadata_to_starfile,
+    write_starfile_sidecar,
 )
 
 
@@ -108,3 +125,298 @@ def test_write_metadata_to_starfile_cryoem_convention():
     expected_file = os.path.join(output_path, "metadata.star")
     assert os.path.isfile(expected_file)
     os.remove(expected_file)
+
+
+def test_read_starfile_sidecar(monkeypatch):
+    """Test that the sidecar round-trips the starfile and detects staleness."""
+    path = "tests/data/test_sidecar.star"
+    with open("tests/data/test.star") as in_file, open(path, "w") as out_file:
+        out_file.write(in_file.read())
+
+    try:
+        expected = read_starfile(path, use_sidecar=False)
+        assert read_starfile_sidecar(path) is None
+
+        # without a sidecar, the starfile is not hashed
+        checksums = []
+        with monkeypatch.context() as patch:
+            patch.setattr(
+                "ioSPI.particle_metadata.file_checksum",
+                lambda *args: checksums.append(args),
+            )
+            read_starfile(path)
+        assert checksums == []
+
+        write_starfile_sidecar(path)
+        actual = read_starfile_sidecar(path)
+        assert actual is not None
+        for block in expected:
+            pd.testing.assert_frame_equal(actual[block], expected[block])
+
+        with open(path, "a") as out_file:
+            out_file.write("\n")
+        assert read_starfile_sidecar(path) is None
+        read_starfile(path)
+        assert read_starfile_sidecar(path) is None
+        actual = read_starfile(path, write_sidecar=True)
+        assert read_starfile_sidecar(path) is not None
+        for block in expected:
+            pd.testing.assert_frame_equal(actual[block], expected[block])
+
+        # an interrupted sidecar write falls back to the starfile
+        with open(get_sidecar_path(path), "r+b") as sidecar:
+            sidecar.truncate(100)
+        assert read_starfile_sidecar(path) is None
+        actual = read_starfile(path)
+        for block in expected:
+            pd.testing.assert_frame_equal(actual[block], expected[block])
+    finally:
+        os.remove(path)
+        if os.path.isfile(get_sidecar_path(path)):
+            os.remove(get_sidecar_path(path))
+
+
+def test_write_metadata_to_starfile_sidecar():
+    """Test that the sidecar of a single-block starfile returns a DataFrame."""
+    output_path = "tests/data/"
+    metadata = format_metadata_for_writing([[1, 2.0, "a"]], ["a", "b", "c"])
+    write_metadata_to_starfile(output_path, metadata, "temp", write_sidecar=True)
+    expected_file = os.path.join(output_path, "temp.star")
+    try:
+        actual = read_starfile_sidecar(expected_file)
+        assert isinstance(actual, pd.DataFrame)
+        assert list(actual.columns) == ["a", "b", "c"]
+        assert actual["c"][0] == "a"
+    finally:
+        os.remove(expected_file)
+        os.remove(get_sidecar_path(expected_file))
+
+
+def test_metadata_accumulator():
+    """Test that batches accumulate into the expected DataFrame."""
+
+    class Config:
+        """Class to instantiate the config object."""
+
+        ctf = False
+        shift = False
+
+    accumulator = MetadataAccumulator.from_config(Config, capacity=2)
+    names = accumulator.variable_names
+    n_rows = 5
+    for i_batch in range(3):
+        batch = {name: np.arange(n_rows, dtype=float) for name in names}
+        batch["__rlnImageName"] = [f"{i + 1}@{i_batch:04d}.mrcs" for i in range(n_rows)]
+        accumulator.add_batch(batch)
+    accumulator.add_batch(np.zeros((1, len(names))))
+
+    assert len(accumulator) == 3 * n_rows + 1
+    assert accumulator.capacity >= len(accumulator)
+
+    metadata = accumulator.to_dataframe()
+    assert list(metadata.columns) == names
+    assert len(metadata) == 3 * n_rows + 1
+    assert metadata["__rlnImageName"][n_rows] == "1@0001.mrcs"
+    assert metadata["__rlnAngleRot"][3 * n_rows - 1] == n_rows - 1
+
+    with pytest.raises(ValueError):
+        accumulator.add_batch({"__rlnImageName": ["1@a.mrcs"]})
+    with pytest.raises(ValueError):
+        accumulator.add_batch(np.zeros((1, 2)))
+
+    accumulator.write("tests/data/", "temp")
+    expected_file = os.path.join("tests/data/", "temp.star")
+    assert os.path.isfile(expected_file)
+    os.remove(expected_file)
+
+
+def test_metadata_accumulator_promotes_dtypes():
+    """Test that later batches promote the type of columns instead of casting."""
+    accumulator = MetadataAccumulator(["a"])
+    accumulator.add_batch({"a": np.array([1, 2])})
+    accumulator.add_batch({"a": np.array([1.5, 2.7])})
+    np.testing.assert_array_equal(accumulator.to_dict()["a"], [1, 2, 1.5, 2.7])
+
+    accumulator = MetadataAccumulator(["name", "angle"])
+    accumulator.add_batch([["1@a.mrcs", 1.5], ["2@a.mrcs", 2]])
+    accumulator.add_batch([["1@b.mrcs", 3.5]])
+    columns = accumulator.to_dict()
+    assert columns["angle"].dtype == np.float64
+    np.testing.assert_array_equal(columns["angle"], [1.5, 2.0, 3.5])
+    assert list(columns["name"]) == ["1@a.mrcs", "2@a.mrcs", "1@b.mrcs"]
+
+
+def test_parse_image_names():
+    """Test parsing of relion image names."""
+    file_ids, frame_indices, file_names = parse_image_names(
+        ["1@a.mrcs", "3@b.mrcs", "2@a.mrcs"]
+    )
+    assert list(file_ids) == [0, 1, 0]
+    assert list(frame_indices) == [0, 2, 1]
+    assert file_names == ["a.mrcs", "b.mrcs"]
+
+    with pytest.raises(ValueError):
+        parse_image_names(["a.mrcs"])
+    with pytest.raises(ValueError):
+        parse_image_names(["0@a.mrcs"])
+
+
+def test_particle_dataset():
+    """Test random and batched access to particles in .mrcs stacks."""
+    stacks = {
+        "0000.mrcs": np.arange(3 * 4 * 4, dtype=np.float32).reshape(3, 4, 4),
+        "0001.mrcs.gz": -np.arange(2 * 4 * 4, dtype=np.float32).reshape(2, 4, 4),
+    }
+    image_names = ["2@0001.mrcs.gz", "1@0000.mrcs", "3@0000.mrcs", "1@0001.mrcs.gz"]
+    expected = np.stack(
+        [stacks["0001.mrcs.gz"][1], stacks["0000.mrcs"][0]]
+        + [stacks["0000.mrcs"][2], stacks["0001.mrcs.gz"][0]]
+    )
+
+    with tempfile.TemporaryDirectory() as root:
+        for name, data in stacks.items():
+            compression = "gzip" if name.endswith(".gz") else None
+            with mrcfile.new(os.path.join(root, name), compression=compression) as mrc:
+                mrc.set_data(data)
+        metadata = format_metadata_for_writing(
+            [[name, 0.0] for name in image_names], ["__rlnImageName", "__rlnAngleRot"]
+        )
+        write_metadata_to_starfile(root, metadata)
+
+        with ParticleDataset(
+            os.path.join(root, "metadata.star"), max_open_files=1
+        ) as dataset:
+            assert len(dataset) == len(image_names)
+            assert (dataset[2] == expected[2]).all()
+            assert (dataset[-1] == expected[-1]).all()
+            with pytest.raises(IndexError):
+                dataset[len(image_names)]
+            assert (dataset[::-1] == expected[::-1]).all()
+            assert (dataset[[3, 0, 1]] == expected[[3, 0, 1]]).all()
+            assert (dataset[:] == expected).all()
+            assert dataset[[]].shape == (0, 4, 4)
+            assert len(dataset.stack._handles) == 1
+
+            copy = pickle.loads(pickle.dumps(dataset))
+            assert (copy[[1, 0]] == expected[[1, 0]]).all()
+
+
+def test_read_starfiles():
+    """Test parallel reading and concatenation of starfiles."""
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for i_file in range(3):
+            path = os.path.join(root, f"{i_file}.star")
+            with open("tests/data/test.star") as in_file, open(path, "w") as out_file:
+                out_file.write(in_file.read())
+            paths.append(path)
+
+        expected = read_starfile(paths[0], use_sidecar=False)
+        n_particles = len(expected["particles"])
+        for n_jobs in [1, 2]:
+            data = read_starfiles(os.path.join(root, "*.star"), n_jobs=n_jobs)
+            pd.testing.assert_frame_equal(data["optics"], expected["optics"])
+            assert len(data["particles"]) == 3 * n_particles
+            assert list(data["particles"]["source_file"][::n_particles]) == paths
+
+        starfile.write(
+            {
+                "optics": expected["optics"].assign(rlnVoltage=200.0),
+                "particles": expected["particles"],
+            },
+            paths[1],
+        )
+        with pytest.raises(ValueError):
+            read_starfiles(paths, n_jobs=1)
+
+        with pytest.raises(FileNotFoundError):
+            read_starfiles(os.path.join(root, "*.mrcs"))
+
+
+def test_validate_metadata():
+    """Test that invalid rows are reported for each check."""
+    metadata = pd.DataFrame(
+        {
+            "__rlnImageName": ["1@a.mrcs", "0@a.mrcs", "a.mrcs", "3@a.mrcs"],
+            "__rlnAngleRot": [0.0, np.nan, 10.0, 20.0],
+            "__rlnDefocusU": [1.0, 2.0, -1.0, "x"],
+            "__rlnOther": [np.nan] * 4,
+        }
+    )
+    invalid_rows = validate_metadata(metadata)
+    assert list(invalid_rows["rlnAngleRot"]) == [1]
+    assert list(invalid_rows["rlnDefocusU"]) == [2, 3]
+    assert list(invalid_rows["rlnImageName"]) == [1, 2]
+    assert "rlnOther" not in invalid_rows
+
+    invalid_rows = validate_metadata(metadata, stack_sizes={"a.mrcs": 2})
+    assert list(invalid_rows["rlnImageName"]) == [1, 2, 3]
+
+    assert validate_metadata(metadata.iloc[[0]]) == {}
+    with pytest.raises(ValueError):
+        write_metadata_to_starfile("tests/data/", metadata, "temp", validate=True)
+
+
+def test_iter_starfile_chunks():
+    """Test that chunks cover the block of the starfile."""
+    path = "tests/data/test.star"
+    expected = read_starfile(path, use_sidecar=False)
+    chunks = list(iter_starfile_chunks(path, chunksize=100))
+    assert max(len(chunk) for chunk in chunks) == 100
+    particles = pd.concat(chunks, ignore_index=True)
+    pd.testing.assert_frame_equal(particles, expected["particles"])
+
+    optics = pd.concat(iter_starfile_chunks(path, block="optics"))
+    pd.testing.assert_frame_equal(optics, expected["optics"])
+
+    with pytest.raises(ValueError):
+        list(iter_starfile_chunks(path, block="micrographs"))
+
+    with tempfile.TemporaryDirectory() as root:
+        single_path = os.path.join(root, "single.star")
+        starfile.write(expected["particles"], single_path)
+        for block in ["particles", ""]:
+            particles = pd.concat(
+                iter_starfile_chunks(single_path, block=block), ignore_index=True
+            )
+            pd.testing.assert_frame_equal(particles, expected["particles"])
+        statistics = aggregate_starfile(
+            single_path, by="rlnMicrographName", columns=["rlnDefocusU"]
+        )
+        assert statistics["count"]["rlnDefocusU"].sum() == len(particles)
+
+
+def test_aggregate_starfile():
+    """Test that streaming statistics match in-memory statistics."""
+    path = "tests/data/test.star"
+    particles = read_starfile(path, use_sidecar=False)["particles"]
+    by = "rlnMicrographName"
+    edges = np.linspace(0, 40000, 11)
+    statistics = aggregate_starfile(
+        path,
+        chunksize=64,
+        by=by,
+        columns=["rlnDefocusU", "rlnAngleTilt"],
+        histograms={"rlnDefocusU": edges},
+        orientation_bins=(4, 2),
+    )
+
+    grouped = particles.groupby(by)
+    np.testing.assert_allclose(
+        statistics["mean"]["rlnDefocusU"], grouped["rlnDefocusU"].mean()
+    )
+    np.testing.assert_allclose(
+        statistics["std"]["rlnAngleTilt"],
+        grouped["rlnAngleTilt"].std(ddof=0),
+        atol=1e-6,
+    )
+    assert (statistics["count"]["rlnDefocusU"] == grouped.size()).all()
+
+    histogram = statistics["histograms"]["rlnDefocusU"]
+    assert histogram.shape[1] == len(edges) - 1
+    assert (histogram.sum(axis=1) == grouped.size()).all()
+
+    coverage = statistics["orientation_coverage"]
+    assert ((coverage > 0) & (coverage <= 1)).all()
+
+    assert GroupStatistics(columns=["rlnDefocusU"]).result()["histograms"] == {}